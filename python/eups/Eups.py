@@ -1,6 +1,8 @@
 """
 The Eups class
 """
+import atexit
+import contextlib
 import glob
 import re
 import os
@@ -21,6 +23,84 @@ from .Product    import Product
 from .Uses       import Uses
 from .utils      import cmp_or_key, xrange, cmp
 from . import hooks
+from . import lock
+from . import timing
+
+class _ProductStacks(dict):
+    """
+    The ProductStacks for the directories on EUPS_PATH, indexed by directory.
+
+    A stack that's been deferred with defer() is only read (by calling
+    load(dataDir, neededFlavors)) when it's first looked up; testing whether
+    a directory is present doesn't read its stack.
+    """
+
+    def __init__(self, load):
+        dict.__init__(self)
+        self._load = load
+        self._pending = {}              # flavors needed by the stacks that we haven't yet read
+
+    def defer(self, dataDir, neededFlavors):
+        """Arrange for dataDir's stack to be read when it's first needed"""
+        dict.pop(self, dataDir, None)
+        self._pending[dataDir] = neededFlavors
+
+    def isLoaded(self, dataDir):
+        """Return True iff dataDir's stack has been read"""
+        return dict.__contains__(self, dataDir)
+
+    def _resolve(self, dataDir):
+        if dataDir in self._pending:
+            neededFlavors = self._pending.pop(dataDir)
+            dict.__setitem__(self, dataDir, self._load(dataDir, neededFlavors))
+
+    def _resolveAll(self):
+        for dataDir in list(self._pending):
+            self._resolve(dataDir)
+
+    def __contains__(self, dataDir):
+        return dataDir in self._pending or dict.__contains__(self, dataDir)
+
+    def __getitem__(self, dataDir):
+        self._resolve(dataDir)
+        return dict.__getitem__(self, dataDir)
+
+    def __setitem__(self, dataDir, stack):
+        self._pending.pop(dataDir, None)
+        dict.__setitem__(self, dataDir, stack)
+
+    def __delitem__(self, dataDir):
+        if self._pending.pop(dataDir, None) is None:
+            dict.__delitem__(self, dataDir)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, dataDir, default=None):
+        return self[dataDir] if dataDir in self else default
+
+    def keys(self):
+        return list(dict.keys(self)) + [k for k in self._pending if not dict.__contains__(self, k)]
+
+    def values(self):
+        self._resolveAll()
+        return dict.values(self)
+
+    def items(self):
+        self._resolveAll()
+        return dict.items(self)
+
+#
+# The Eups objects with stack caches waiting to be saved (see Eups.flushAllCaches)
+#
+try:
+    type(_writeBehind)
+except NameError:
+    _writeBehind = []
+    atexit.register(lambda: Eups.flushAllCaches())
 
 class Eups:
     """
@@ -44,6 +124,9 @@ class Eups:
     #  managed software stack
     ups_db = "ups_db"
 
+    # the number of times to read a database that's changing under us (see config.site.snapshotReads)
+    _snapshotTries = 3
+
     @staticmethod
     def setEupsPath(path=None, dbz=None):
         if not path:
@@ -142,19 +225,7 @@ class Eups:
         self.verboseUnsetup = False     # used by unsetup{Required,Optional} in table files
 
         if not shell:
-            try:
-                shell = os.environ["EUPS_SHELL"]
-            except KeyError:
-                raise EupsException("I cannot guess what shell you're running as $EUPS_SHELL isn't set")
-
-            if re.search(r"(^|/)(bash|ksh|sh)$", shell):
-                shell = "sh"
-            elif re.search(r"(^|/)(csh|tcsh)$", shell):
-                shell = "csh"
-            elif re.search(r"(^|/)(zsh)$", shell):
-                shell = "zsh"
-            else:
-                raise EupsException("Unknown shell type %s" % shell)
+            shell = utils.determineShell()
 
         self.shell = shell
 
@@ -306,7 +377,9 @@ class Eups:
         #   read the cached version of product info
         # N.b. we'll do the same for user directories (e.g. ~/.eups) later
         #
-        self.versions = {}
+        # The stacks are only read when first used
+        #
+        self.versions = _ProductStacks(self._readProductStack)
         neededFlavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
         if readCache:
           for p in self.path:
@@ -328,7 +401,8 @@ class Eups:
            hooks.config.Eups.globalTags.count(user) == 0:
             hooks.config.Eups.userTags.append(user)
 
-        self.tags = Tags()
+        self._tags = Tags()             # see the tags property
+        self._tagsLoaded = False
         self.commandLineTagNames = []   # names of tags specified on the command line; set in selectVRO
 
         for tags, group in [
@@ -342,14 +416,14 @@ class Eups:
                 tags = tags.split()
             for tag in tags:
                 try:
-                    self.tags.registerTag(tag, group)
+                    self._tags.registerTag(tag, group)
                 except RuntimeError as e:
                     raise RuntimeError("Unable to process tag %s: %s" % (tag, e))
-
-        self._loadServerTags()
-        self._loadUserTags()
         #
-        # Handle preferred tags; this is a list where None means hooks.config.Eups.preferredTags
+        # The tags cached in the stacks are loaded when self.tags is first used
+        #
+        # Handle preferred tags; this is a list where None means hooks.config.Eups.preferredTags;
+        # they are checked against the known tags when first used (see the preferredTags property)
         #
         if preferredTags is None:
             preferredTags = [None]
@@ -364,9 +438,8 @@ class Eups:
             for t in tags:
                 preferredTags.append(t)
 
-        q = utils.Quiet(self)
-        self._kindlySetPreferredTags(preferredTags)
-        del q
+        self._preferredTags = None
+        self._pendingPreferredTags = preferredTags
         #
         # Find which tags are reserved to the installation
         #
@@ -388,34 +461,102 @@ class Eups:
         for k in ["commandLine", "keep", "type", "version", "version!", "versionExpr", "warn"]:
             self._internalTags.append(k)
         #
-        # Check that nobody's used an internal tag by mistake (setup -t keep would be bad...)
-        #
-        for t in self.tags.getTags():
-            if (t.isUser() or t.isGlobal()) and self.isInternalTag(t, True):
-                pass
-        #
-        # Find locally-setup products in the environment
+        # Locally-setup products in the environment are found when first needed
         #
-        self.localVersions = {}
-
-        q = utils.Quiet(self)
-        for product in self.getSetupProducts():
-            try:
-                if product.version.startswith(Product.LocalVersionPrefix):
-                    try:
-                        pdir = os.environ[self._envarDirName(product.name)]
-                    except KeyError:    # they explicitly envUnset PRODUCT_DIR
-                        pdir = product.dir
-                    self.localVersions[product.name] = pdir
-            except TypeError:
-                pass
+        self._localVersions = None
         #
-        # Always search for products in user's datadir (it's where anonymous tags go)
+        # Always search for products in user's datadir (it's where anonymous tags go).
+        # N.b. tag owners are only set by the configuration, so we needn't load the tags
         #
         self.includeUserDataDirInPath()
-        for user in self.tags.owners.values():
+        for user in self._tags.owners.values():
             self.includeUserDataDirInPath(utils.defaultUserDataDir(user))
         #
+        # We'll check for the defaultProduct when we first need it
+        #
+        self._defaultProductChecked = False
+        #
+        # Allow us to control repetitive warning messages
+        #
+        self._warned = {}
+        #
+        # The stacks being updated by an open transaction(), if any
+        #
+        self._transaction = None
+        #
+        # The updates to stacks whose caches haven't yet been saved, indexed by directory
+        # (see hooks.config.Eups.writeBehindCache)
+        #
+        self._pendingSaves = {}
+        #
+        # The products and dependencies found within batchedResolution(), if any
+        #
+        self._resolutions = None
+
+    @property
+    def tags(self):
+        """The known Tags, including those cached in the product stacks (which are loaded on first use)"""
+        if not self._tagsLoaded:
+            self._tagsLoaded = True
+            with timing.span("Eups.loadTags"):
+                self._loadServerTags()
+                self._loadUserTags()
+            #
+            # Check that nobody's used an internal tag by mistake (setup -t keep would be bad...)
+            #
+            for t in self._tags.getTags():
+                if (t.isUser() or t.isGlobal()) and self.isInternalTag(t, True):
+                    pass
+
+        return self._tags
+
+    @property
+    def preferredTags(self):
+        """The tags to prefer when selecting products; see setPreferredTags()"""
+        if self._pendingPreferredTags is not None:
+            preferredTags, self._pendingPreferredTags = self._pendingPreferredTags, None
+            q = utils.Quiet(self)
+            self._kindlySetPreferredTags(preferredTags)
+            del q
+
+        return self._preferredTags
+
+    @preferredTags.setter
+    def preferredTags(self, tags):
+        self._pendingPreferredTags = None
+        self._preferredTags = tags
+
+    @property
+    def localVersions(self):
+        """The directories of products that were setup with setup -r, indexed by product name"""
+        if self._localVersions is None:
+            self._localVersions = {}
+
+            q = utils.Quiet(self)
+            for product in self.getSetupProducts():
+                try:
+                    if product.version.startswith(Product.LocalVersionPrefix):
+                        try:
+                            pdir = os.environ[self._envarDirName(product.name)]
+                        except KeyError:    # they explicitly envUnset PRODUCT_DIR
+                            pdir = product.dir
+                        self._localVersions[product.name] = pdir
+                except TypeError:
+                    pass
+            del q
+
+        return self._localVersions
+
+    def checkDefaultProduct(self):
+        """
+        Check that hooks.config.Eups.defaultProduct is declared.  This is done
+        the first time that the defaultProduct may be needed (e.g. by setup, or
+        when a table file is read for us)
+        """
+        if self._defaultProductChecked:
+            return
+        self._defaultProductChecked = True
+        #
         # We just changed the default defaultProduct from "toolchain" to "implicitProducts";
         # include a back-door for toolchain.  This hack should be deleted at some point.
         #
@@ -427,10 +568,18 @@ class Eups:
                     print("Using name \"toolchain\" for default product, not \"%s\"" % \
                         defaultProduct, file=utils.stdwarn)
                 hooks.config.Eups.defaultProduct["name"] = "toolchain"
-        #
-        # Allow us to control repetitive warning messages
-        #
-        self._warned = {}
+
+    def preload(self):
+        """
+        Do the work that's otherwise put off until it's first needed:  read the product stacks and
+        tags, find the products that were setup with setup -r, and check the defaultProduct.  Call
+        this before sharing an Eups between threads, as none of these is done under a lock
+        """
+        self.versions.values()
+        self.tags
+        self.preferredTags
+        self.localVersions
+        self.checkDefaultProduct()
 
     def pushStack(self, what, value=None):
         """Push some state onto a stack; see also popStack() and dropStack()
@@ -607,29 +756,37 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if tag.isUser() and not self.tags.isRecognized(tag):
                     self.tags.registerUserTag(tag.name)
         #
-        # Now see if we need to read some other user's tags
+        # Other users' tags are added to each stack as it's read; see _readProductStack
         #
-        db = Database(self.getUpsDB(path))
 
-        for tag, owner in self.tags.owners.items():
-            for p in self.path:
-                userCacheDir = utils.userStackCacheFor(p, userDataDir=utils.defaultUserDataDir(owner))
-                extraDb = Database(self.getUpsDB(p), userCacheDir, owner=owner)
+    def _addOtherUsersTags(self, dataDir, stack):
+        """
+        Add the tags belonging to other users (e.g. "rhl:best") in dataDir to its stack.
 
-                db.addUserTagDb(userCacheDir, p, userId=owner)
+        Each owner's assignments are indexed in our cache directory for dataDir, so we
+        only need to read the chain files when they've changed
+        """
+        tagsByOwner = {}
+        for tag, owner in self._tags.owners.items():
+            tagsByOwner.setdefault(owner, []).append(tag)
 
-                if p not in self.versions:
-                    continue
+        cacheDir = utils.userStackCacheFor(dataDir)
+        for owner, tags in tagsByOwner.items():
+            userCacheDir = utils.userStackCacheFor(dataDir, userDataDir=utils.defaultUserDataDir(owner))
+            extraDb = Database(self.getUpsDB(dataDir), userCacheDir, owner=owner)
 
-                for productName in extraDb.findProductNames():
-                    for etag, versionName, flavor in extraDb.getTagAssignments(productName, glob=False):
-                        if Tag(etag) != tag:
-                            continue
+            indexFile = None
+            if cacheDir and os.path.isdir(cacheDir):
+                indexFile = os.path.join(cacheDir, "%s.userTagIndex" % owner)
 
-                        try:
-                            self.versions[p].lookup[flavor][productName].tags[etag] = versionName
-                        except KeyError:
-                            continue
+            for productName, etag, versionName, flavor in extraDb.getUserTagAssignments(indexFile):
+                if not [t for t in tags if Tag(etag) == t]:
+                    continue
+
+                try:
+                    stack.lookup[flavor][productName].assignTag(etag, versionName)
+                except (KeyError, ProductNotFound):
+                    continue
 
     def setPreferredTags(self, tags):
         """
@@ -753,7 +910,8 @@ The what argument tells us what sort of state is expected (allowed values are de
 
             try:
                 productDir = environ[self._envarDirName(productName)]
-                if productDir and not tablefile:
+                # If we're deferring table lookups, leave tablefile as None (i.e. the default if it exists)
+                if productDir and not tablefile and not hooks.config.Eups.deferTableLookup:
                     tablefile = os.path.join(productDir,"ups",productName+".table")
                     if not os.path.exists(tablefile):
                         tablefile = "none"
@@ -774,6 +932,52 @@ The what argument tells us what sort of state is expected (allowed values are de
         return utils.dirEnvNameFor(productName)
 
 
+    @contextlib.contextmanager
+    def batchedResolution(self):
+        """
+        A context manager within which the products chosen by findProductFromVRO() and findSetupProduct(),
+        and the dependencies listed by getDependentProducts(), are remembered and reused:
+
+            with myeups.batchedResolution():
+                for productName, versionName in products:
+                    ... myeups.getDependentProducts(myeups.findProduct(productName, versionName)) ...
+
+        so that expanding many table files (e.g. in eups distrib create) resolves each of their shared
+        dependencies once, and reads each table file once.  Declaring products, or changing the
+        environment (e.g. by setting up a product), forgets what's been found.  Batches may be nested
+        """
+        if self._resolutions is not None:
+            yield self
+            return
+
+        self._resolutions = {}
+        try:
+            yield self
+        finally:
+            self._resolutions = None
+
+    def _forgetResolutions(self):
+        """Forget the products found within batchedResolution(), as they may have changed"""
+        if self._resolutions:
+            self._resolutions.clear()
+
+    def _resolve(self, key, resolve):
+        """Return resolve(), or the value that it returned for key earlier in this batchedResolution()"""
+        if self._resolutions is None:
+            return resolve()
+
+        try:
+            return self._resolutions[key]
+        except KeyError:
+            pass
+        except TypeError:               # unhashable arguments; don't remember them
+            return resolve()
+
+        timing.count("resolutions")
+        value = self._resolutions[key] = resolve()
+        return value
+
+    @timing.timed("Eups.findProductFromVRO")
     def findProductFromVRO(self, name, version=None, versionExpr=None, eupsPathDirs=None, flavor=None,
                            noCache=False, recursionDepth=0, vro=None, optional=False):
         """
@@ -801,6 +1005,21 @@ The what argument tells us what sort of state is expected (allowed values are de
                                 to the extent it is available.
         @param recursionDepth Recursion depth (0 => top, so e.g. keep should be ignored)
         """
+        if self._resolutions is None:
+            return self._findProductFromVRO(name, version, versionExpr, eupsPathDirs, flavor,
+                                            noCache, recursionDepth, vro, optional)
+
+        key = ("findProductFromVRO", name, (type(version), str(version)) if version is not None else None,
+               versionExpr, tuple(eupsPathDirs) if isinstance(eupsPathDirs, list) else eupsPathDirs,
+               flavor or self.flavor, noCache, recursionDepth,
+               tuple(str(t) for t in (vro or self.getPreferredTags())), optional)
+        return self._resolve(key, lambda: self._findProductFromVRO(name, version, versionExpr, eupsPathDirs,
+                                                                   flavor, noCache, recursionDepth, vro,
+                                                                   optional))
+
+    def _findProductFromVRO(self, name, version, versionExpr, eupsPathDirs, flavor, noCache, recursionDepth,
+                            vro, optional):
+        """The guts of findProductFromVRO()"""
 
         if not flavor:
             flavor = self.flavor
@@ -1304,19 +1523,18 @@ The what argument tells us what sort of state is expected (allowed values are de
             else:
                 # consult the cache
                 try:
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers.sort(**cmp_or_key(self.version_cmp))
-                    if len(vers) == 0:
+                    latest = self.versions[root].getLatestVersion(name, flavor)
+                    if latest is None:
                         continue
 
                     # is latest version in this stack newer than minimum version?
-                    if minver and self.version_cmp(vers[-1], minver) < 0:
+                    if minver and self.version_cmp(latest, minver) < 0:
                         continue
 
-                    if out == None or self.version_cmp(vers[-1],
+                    if out == None or self.version_cmp(latest,
                                                         out.version) > 0:
                         # latest one in this stack is latest one seen
-                        out = self.versions[root].getProduct(name, vers[-1], flavor)
+                        out = self.versions[root].getProduct(name, latest, flavor)
 
                 except ProductNotFound:
                     continue
@@ -1473,8 +1691,12 @@ The what argument tells us what sort of state is expected (allowed values are de
                 self._setProductStack_fromCache(dataDir, [self.flavor])
 
     def _setProductStack_fromCache(self, dataDir, neededFlavors):
-        # the product cache.  If cache is non-existent or out of date, the product info will be refreshed from
-        # the database
+        # the product cache.  It's read when first needed (by _readProductStack)
+        self.versions.defer(dataDir, neededFlavors)
+
+    def _readProductStack(self, dataDir, neededFlavors):
+        # read the product cache.  If cache is non-existent or out of date, the product info will be
+        # refreshed from the database
         dbpath = self.getUpsDB(dataDir)
         cacheDir = dbpath
         userCacheDir = self._makeUserCacheDir(dataDir)
@@ -1482,11 +1704,43 @@ The what argument tells us what sort of state is expected (allowed values are de
             # use a user-writable alternate location for the cache
             cacheDir = userCacheDir
 
-        self.versions[dataDir] = ProductStack.fromCache(dbpath, neededFlavors,
-                                                        persistDir=cacheDir,
-                                                        userTagDir=userCacheDir,
-                                                        updateCache=True, autosave=False,
-                                                        verbose=self.verbose)
+        if not (hooks.config.site.snapshotReads or hooks.config.site.productLocks):
+            stack = ProductStack.fromCache(dbpath, neededFlavors,
+                                           persistDir=cacheDir,
+                                           userTagDir=userCacheDir,
+                                           updateCache=True, autosave=False,
+                                           verbose=self.verbose)
+        else:
+            #
+            # The database may not be locked against writers, so check that its generation didn't change
+            # while we were reading it (in which case we may have seen a partial update), and if it did try again.
+            # Unless the stack's locked against writers we don't write the caches, as what we read may be broken;
+            # the writers keep them up to date
+            #
+            updateCache = lock.holdsExclusiveLock(dataDir)
+            db = Database(dbpath)
+            for i in range(self._snapshotTries):
+                generation = db.getGeneration()
+                try:
+                    stack = ProductStack.fromCache(dbpath, neededFlavors,
+                                                   persistDir=cacheDir,
+                                                   userTagDir=userCacheDir,
+                                                   updateCache=updateCache, autosave=False,
+                                                   verbose=self.verbose, generation=generation)
+                except Exception:
+                    if db.getGeneration() == generation or i == self._snapshotTries - 1:
+                        raise
+                else:
+                    if db.getGeneration() == generation:
+                        break
+
+                timing.count("snapshot retries")
+                if self.verbose > 1:
+                    print("%s changed while it was being read; rereading" % dbpath, file=utils.stdinfo)
+
+        self._addOtherUsersTags(dataDir, stack)
+
+        return stack
 
     def getSetupProducts(self, requestedProductName=None):
         """Return a list of all Products that are currently setup (or just the specified product)"""
@@ -1540,6 +1794,14 @@ The what argument tells us what sort of state is expected (allowed values are de
         return a Product instance for a currently setup product.  None is
         returned if a product with the given name is not currently setup.
         """
+        if environ is None and self._resolutions is not None:
+            return self._resolve(("findSetupProduct", productName),
+                                 lambda: self._findSetupProduct(productName, environ))
+
+        return self._findSetupProduct(productName, environ)
+
+    def _findSetupProduct(self, productName, environ):
+        """The guts of findSetupProduct()"""
         versionName, eupsPathDir, productDir, tablefile, flavor = \
             self.findSetupVersion(productName, environ)
         if versionName is None:
@@ -1561,12 +1823,14 @@ The what argument tells us what sort of state is expected (allowed values are de
         if val == None:
             val = ""
         os.environ[key] = val
+        self._forgetResolutions()
 
     def unsetEnv(self, key):
         """Unset an environmental variable"""
 
         if key in os.environ:
             del os.environ[key]
+            self._forgetResolutions()
 
     def setAlias(self, key, val):
         """Set an alias.  The value is in sh syntax --- we'll mangle it for csh later"""
@@ -1752,6 +2016,7 @@ The what argument tells us what sort of state is expected (allowed values are de
     def _isValidSetupType(self, setupType):
         return setupType in self._validSetupTypes
 
+    @timing.timed("setup", "productName")
     def setup(self, productName, versionName=None, fwd=True, recursionDepth=0,
               setupToplevel=True, noRecursion=False,
               productRoot=None, tablefile=None, versionExpr=None, optional=False,
@@ -1793,6 +2058,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param implicitProduct  True iff product is setup due to being specified in implicitProducts
         """
 
+        self.checkDefaultProduct()
+
         if utils.is_string(versionName) and versionName.startswith(Product.LocalVersionPrefix):
             productRoot = versionName[len(Product.LocalVersionPrefix):]
 
@@ -1935,7 +2202,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 self.alreadySetupProducts[product.name] = (product, vroReason)
 
         try:
-            table = product.getTable(quiet=not fwd, verbose=self.verbose)
+            table = product.getTable(quiet=not fwd, verbose=self.verbose, eupsenv=self)
         except TableFileNotFound as e:
             if fwd:
                 raise
@@ -2074,7 +2341,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         # Did we want to use the dependencies from an installed table, but use a different directory?
         #
         if localProduct:
-            localTable = localProduct.getTable(quiet=True)
+            localTable = localProduct.getTable(quiet=True, eupsenv=self)
             if localTable:
                 localActions = localTable.actions(setupFlavor, setupType=self.setupType, verbose=verbose)
             else:
@@ -2103,6 +2370,170 @@ The what argument tells us what sort of state is expected (allowed values are de
         return self.setup(productName, versionName, fwd=False, optional=optional,
                           recursionDepth=recursionDepth, noRecursion=noRecursion)
 
+    def _updateStack(self, eupsPathDir, productName, updateDatabase, updateCache, flavor=None, note="Warning"):
+        """
+        Change productName's entry in the database for eupsPathDir by calling updateDatabase(), and
+        then the stack's cache (if in use) by calling updateCache(stack);  return the value
+        returned by updateDatabase().  If updateCache returns False the cache isn't saved; otherwise
+        the cache of flavor (a flavor or list of flavors; default: self.flavor) is.
+
+        The product is locked (see lock.lockProduct), and other processes holding product locks
+        on eupsPathDir are prevented from changing it at the same time.  Within a transaction()
+        the cache is saved, and the database's generation published, when the transaction ends;
+        if hooks.config.Eups.writeBehindCache is set the cache isn't saved until flushCaches()
+        """
+        self._forgetResolutions()
+
+        if self._transaction is None:
+            lock.lockProduct(eupsPathDir, productName)
+            with lock.updatingStack(eupsPathDir):
+                update = self._startStackUpdate(eupsPathDir)
+                result = updateDatabase()
+                self._applyStackUpdate(update, updateCache, flavor, note)
+                self._saveStackUpdate(update)
+
+            return result
+
+        updates, databases, locks, productNames = self._transaction
+        update = updates.get(eupsPathDir)
+        if update is None:
+            # we hold the stack's update lock until the transaction ends, so lock its products first
+            lock.lockProducts(eupsPathDir, productNames + [productName])
+            locks.enter_context(lock.updatingStack(eupsPathDir))
+            databases.enter_context(Database(self.getUpsDB(eupsPathDir)).transaction())
+            update = updates[eupsPathDir] = self._startStackUpdate(eupsPathDir)
+
+        lock.lockProduct(eupsPathDir, productName) # fails if it wasn't passed to transaction()
+        result = updateDatabase()
+        self._applyStackUpdate(update, updateCache, flavor, note)
+
+        return result
+
+    def _startStackUpdate(self, eupsPathDir):
+        """Return the state needed by _applyStackUpdate and _saveStackUpdate to update eupsPathDir's cache"""
+        update = self._pendingSaves.get(eupsPathDir)
+        if update is not None:          # carry on from the changes that haven't been saved yet
+            update["current"] = update["current"] and \
+                update["stack"].generation == update["db"].getGeneration()
+            return update
+
+        update = dict(root=eupsPathDir, stack=None, db=None, current=False, synced=False, flavors=set(),
+                      note=None)
+        if eupsPathDir in self.versions and self.versions[eupsPathDir]:
+            stack = update["stack"] = self.versions[eupsPathDir]
+            db = update["db"] = Database(stack.getDbPath())
+            # are we up to date with the database?  If so the cache will be too after our changes
+            update["current"] = stack.generation is not None and stack.cacheIsInSync() and \
+                stack.generation == db.getGeneration()
+
+        return update
+
+    def _applyStackUpdate(self, update, updateCache, flavor, note):
+        """Update the in-memory stack, remembering which flavor's cache needs to be saved"""
+        stack = update["stack"]
+        if not stack:
+            return
+
+        if not update["synced"]:        # reloading would lose the updates made earlier in a transaction
+            stack.ensureInSync(verbose=self.verbose)
+            update["synced"] = True
+
+        if updateCache(stack) is not False:
+            update["flavors"].update(flavor if isinstance(flavor, list) else [flavor if flavor else self.flavor])
+            update["note"] = note
+
+    def _saveStackUpdate(self, update):
+        """Save the caches of the flavors changed by _applyStackUpdate (or leave it to flushCaches())"""
+        stack = update["stack"]
+        if not stack or not update["flavors"]:
+            return
+
+        stack.generation = update["db"].getGeneration() if update["current"] else None
+        if hooks.config.Eups.writeBehindCache:
+            self._pendingSaves[update["root"]] = update
+            if not any(e is self for e in _writeBehind):
+                _writeBehind.append(self)
+            return
+
+        self._pendingSaves.pop(update["root"], None)
+        self._writeStackUpdate(update)
+
+    def _writeStackUpdate(self, update):
+        """
+        Write the caches saved by _saveStackUpdate, merging in the changes that other processes have
+        saved since we read them;  if that's not possible, reread the stack from its database
+        """
+        stack = update["stack"]
+        try:
+            stack.save(sorted(update["flavors"]), merge=True)
+            stack.recordGeneration()    # the other flavors' caches are still current
+        except CacheOutOfSync as e:
+            if self.quiet <= 0:
+                print("%s: %s" % (update["note"], e), file=utils.stdwarn)
+                print("Correcting...", file=utils.stdwarn)
+            timing.count("stack cache refreshes")
+            stack.refreshFromDatabase()
+
+    @contextlib.contextmanager
+    def transaction(self, products=[]):
+        """
+        A context manager that batches calls to declare(), undeclare(), assignTag() and unassignTag():
+
+            with myeups.transaction([p[0] for p in products]):
+                for productName, versionName, productDir in products:
+                    myeups.declare(productName, versionName, productDir)
+
+        The version and chain files are written as usual, but each stack's cache is only saved (and its
+        database's generation published) once, when the transaction ends.  While it's open the stacks
+        being changed are locked against other processes' updates (see lock.updatingStack).
+
+        If we're using product locks (see lock.lockProduct) the names of the products to be changed
+        must be listed in products, as they're locked before the stacks are
+
+        Changes made before an exception are kept, and the caches are saved to match them.  Transactions
+        may be nested;  the outermost one does the work
+        """
+        if self._transaction is not None:
+            yield self
+            return
+
+        updates = {}
+        databases, locks = contextlib.ExitStack(), contextlib.ExitStack()
+        self._transaction = (updates, databases, locks, list(products))
+        try:
+            yield self
+        finally:
+            self._transaction = None
+            with locks:
+                databases.close()       # publishes the databases' generations
+                for update in updates.values():
+                    self._saveStackUpdate(update)
+
+    def flushCaches(self):
+        """
+        Save the stacks' caches that are waiting to be written because hooks.config.Eups.writeBehindCache
+        is set, merging in the changes that other processes have saved in the meantime.  The eups command
+        calls this (via flushAllCaches) as it exits;  it may not be called within a transaction()
+        """
+        if self._transaction is not None:
+            raise RuntimeError("Eups.flushCaches() may not be called within a transaction")
+
+        while self._pendingSaves:
+            eupsPathDir, update = self._pendingSaves.popitem()
+            with lock.updatingStack(eupsPathDir):
+                stack = update["stack"]
+                if stack.generation is not None and stack.generation != update["db"].getGeneration():
+                    stack.generation = None     # someone else has changed the database since
+                self._writeStackUpdate(update)
+
+        _writeBehind[:] = [e for e in _writeBehind if e is not self]
+
+    @staticmethod
+    def flushAllCaches():
+        """Call flushCaches() for every Eups with stack caches waiting to be saved"""
+        while _writeBehind:
+            _writeBehind[0].flushCaches()
+
     def assignTag(self, tag, productName, versionName, eupsPathDir=None, eupsPathDirForRead=None):
         """
         assign the given tag to a product.  The product that it will be
@@ -2122,7 +2553,40 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         product = self.getProduct(productName, versionName, eupsPathDirForRead)
         root = product.stackRoot()
+        writeableDB = self._writeableDBForTag(tag, product)
+
+        # update the database and the cache.  If it's a user tag,
+        db = Database(product.db, self._userStackCache(root))
+        self._updateStack(root, productName,
+                          lambda: db.assignTag(tag, productName, versionName, self.flavor,
+                                               writeableDB=writeableDB),
+                          lambda stack: stack.assignTag(tag, productName, versionName, self.flavor))
+
+    def setTaggedVersion(self, tag, product, flavors):
+        """
+        assign the given tag to the given flavors of a product found by e.g. findProducts(),
+        replacing the version that it was assigned to for those flavors.  Unlike assignTag(),
+        the product isn't looked up again, and its chain file is written just once
+        @param tag           the tag to assign as tag name or Tag instance
+        @param product       the Product to tag
+        @param flavors       the flavors to tag it for
+        """
+        tag = self.tags.getTag(tag)
+        root = product.stackRoot()
+        writeableDB = self._writeableDBForTag(tag, product)
+
+        db = Database(product.db, self._userStackCache(root))
+        self._updateStack(root, product.name,
+                          lambda: db.setTaggedVersion(tag, product.name, product.version, flavors,
+                                                      writeableDB=writeableDB),
+                          lambda stack: stack.assignTag(tag, product.name, product.version, flavors),
+                          flavor=flavors)
 
+    def _writeableDBForTag(self, tag, product):
+        """
+        Return the database that tag's assignment to product should be written to:  product's own, or
+        (if tag is global and we can't write there) the first writeable one on EUPS_PATH
+        """
         writeableDB = product.db
         if tag.isGlobal() and not utils.isDbWritable(product.db):
             #
@@ -2147,21 +2611,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if self.verbose > 2 or self._warned[warningName] == 0:
                     print("%s; writing to %s" % (msg, writeableDB), file=utils.stdwarn)
 
-        # update the database.  If it's a user tag,
-        db = Database(product.db, self._userStackCache(root))
-        db.assignTag(tag, productName, versionName, self.flavor, writeableDB=writeableDB)
-
-        # update the cache
-        if root in self.versions and self.versions[root]:
-            self.versions[root].ensureInSync(verbose=self.verbose)
-            self.versions[root].assignTag(tag, productName, versionName, self.flavor)
-            try:
-                self.versions[root].save(self.flavor)
-            except CacheOutOfSync as e:
-                if self.quiet <= 0:
-                    print("Warning: " + str(e), file=utils.stdwarn)
-                    print("Correcting...", file=utils.stdwarn)
-                self.versions[root].refreshFromDatabase()
+        return writeableDB
 
     def unassignTag(self, tag, productName, versionName=None, eupsPathDir=None, eupsPathDirForRead=None):
         """
@@ -2236,28 +2686,23 @@ The what argument tells us what sort of state is expected (allowed values are de
             print("eups undeclare --tag %s %s" % (tag.name, productName), file=sys.stderr)
             return
 
-        # update the database
-        if not self._databaseFor(eupsPathDir,dbpath).unassignTag(str(tag), productName, self.flavor):
+        def updateCache(stack):
+            if stack.unassignTag(str(tag), productName, self.flavor):
+                return True
+            elif self.verbose:
+                print("Tag %s not assigned to %s %s" % \
+                    (tag, productName, versionName), file=utils.stdwarn)
+            return False
+
+        # update the database and the cache
+        if not self._updateStack(eupsPathDir, productName,
+                                 lambda: self._databaseFor(eupsPathDir,dbpath).unassignTag(str(tag), productName,
+                                                                                          self.flavor),
+                                 updateCache):
             if self.verbose:
                 print("Tag %s is not assigned to %s %s" % \
                     (tag, productName, versionName), file=utils.stdwarn)
 
-        # update the cache
-        if eupsPathDir in self.versions and self.versions[eupsPathDir]:
-            self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
-            if self.versions[eupsPathDir].unassignTag(str(tag), productName, self.flavor):
-                try:
-                    self.versions[eupsPathDir].save(self.flavor)
-                except CacheOutOfSync as e:
-                    if self.quiet <= 0:
-                        print("Warning: " + str(e), file=utils.stdwarn)
-                        print("Correcting...", file=utils.stdwarn)
-                    self.versions[eupsPathDir].refreshFromDatabase()
-
-            elif self.verbose:
-                print("Tag %s not assigned to %s %s" % \
-                    (productName, versionName), file=utils.stdwarn)
-
 
     def declare(self, productName, versionName, productDir=None, eupsPathDir=None, tablefile=None,
                 tag=None, externalFileList=[], declareCurrent=None):
@@ -2526,7 +2971,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         #
         # Are there any declaration options in the table file?
         #
-        declareOptions = Table(full_tablefile).getDeclareOptions(self.flavor, self.setupType)
+        declareOptions = Table(full_tablefile, eupsenv=self).getDeclareOptions(self.flavor, self.setupType)
         try:
             self.flavor = declareOptions["flavor"]
         except KeyError:
@@ -2657,22 +3102,10 @@ The what argument tells us what sort of state is expected (allowed values are de
                 product = Product(productName, versionName, self.flavor, productDir,
                                   tablefile, tag, dbpath, ups_dir=ups_dir)
 
-                # update the database
-                self._databaseFor(eupsPathDir, dbpath).declare(product)
-
-                # update the cache (if in use)
-                if eupsPathDir in self.versions and self.versions[eupsPathDir]:
-
-                    self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
-                    self.versions[eupsPathDir].addProduct(product)
-
-                    try:
-                        self.versions[eupsPathDir].save(self.flavor)
-                    except CacheOutOfSync as e:
-                        if self.quiet <= 0:
-                            print("Note: " + str(e), file=utils.stdwarn)
-                            print("Correcting...", file=utils.stdwarn)
-                        self.versions[eupsPathDir].refreshFromDatabase()
+                # update the database and the cache (if in use)
+                self._updateStack(eupsPathDir, productName,
+                                  lambda: self._databaseFor(eupsPathDir, dbpath).declare(product),
+                                  lambda stack: stack.addProduct(product), note="Note")
 
         if tag:
             # we just want to update the tag
@@ -2816,24 +3249,14 @@ The what argument tells us what sort of state is expected (allowed values are de
         if self.noaction:
             return True
 
-        if not self._databaseFor(eupsPathDir).undeclare(product):
-            # this should not happen
-            raise ProductNotFound(product.name, product.version, product.flavor, product.db)
+        def updateDatabase():
+            if not self._databaseFor(eupsPathDir).undeclare(product):
+                # this should not happen
+                raise ProductNotFound(product.name, product.version, product.flavor, product.db)
 
-        if eupsPathDir in self.versions and self.versions[eupsPathDir]:
-
-            self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
-            self.versions[eupsPathDir].removeProduct(product.name,
-                                                     product.flavor,
-                                                     product.version)
-
-            try:
-                self.versions[eupsPathDir].save(product.flavor)
-            except CacheOutOfSync as e:
-                if self.quiet <= 0:
-                    print("Warning: " + str(e), file=utils.stdwarn)
-                    print("Correcting...", file=utils.stdwarn)
-                self.versions[eupsPathDir].refreshFromDatabase()
+        self._updateStack(eupsPathDir, product.name, updateDatabase,
+                          lambda stack: stack.removeProduct(product.name, product.flavor, product.version),
+                          flavor=product.flavor)
 
         return True
 
@@ -2957,13 +3380,12 @@ The what argument tells us what sort of state is expected (allowed values are de
                                     out.append(prod)
 
                     # select out matched versions
-                    vers = stack.getVersions(pname, flavor)
+                    vers = stack.getVersions(pname, flavor, sort=True)
                     if version:
                         if self.isLegalRelativeVersion(version): # version is actually an expression
                             vers = [v for v in vers if self.version_match(v, version)]
                         else:
                             vers = list(fnmatch.filter(vers, version))
-                    vers.sort(**cmp_or_key(self.version_cmp))
 
                     # only include latest if it passes the version constraint
                     if latest is not None and latest.version not in vers:
@@ -3046,7 +3468,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         N.b. the dependencies are not calculated recursively"""
         dependencies = []
         if utils.isRealFilename(tablefile):
-            for vals in Table(tablefile).dependencies(self, eupsPathDirs):
+            for vals in Table(tablefile, eupsenv=self).dependencies(self, eupsPathDirs):
                 dependencies += [vals]
 
         return dependencies
@@ -3069,11 +3491,26 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         See also getDependencies()
         """
-
+        if productDictionary is None and self._resolutions is not None:
+            key = ("getDependentProducts", topProduct.name, topProduct.version, topProduct.flavor,
+                   topProduct.dir, setup, shouldRaise, followExact, topological, checkCycles,
+                   tuple(sorted(requiredVersions.items())), self.exact_version,
+                   tuple(str(t) for t in self.getPreferredTags()))
+            dependentProducts = self._resolve(key, lambda: self._getDependentProducts(
+                topProduct, setup, shouldRaise, followExact, productDictionary, topological, checkCycles,
+                requiredVersions))
+            return [list(dep) for dep in dependentProducts] # the caller may change them
+
+        return self._getDependentProducts(topProduct, setup, shouldRaise, followExact, productDictionary,
+                                          topological, checkCycles, requiredVersions)
+
+    def _getDependentProducts(self, topProduct, setup, shouldRaise, followExact, productDictionary,
+                              topological, checkCycles, requiredVersions):
+        """The guts of getDependentProducts()"""
         dependentProducts = []
 
         try:
-            prodtbl = topProduct.getTable()
+            prodtbl = topProduct.getTable(eupsenv=self)
         except TableFileNotFound as e:
             print(e, file=utils.stdwarn)
             prodtbl = None
@@ -3134,13 +3571,13 @@ The what argument tells us what sort of state is expected (allowed values are de
                     defaultProduct = prods[0]
 
                     if defaultProduct:
-                        ptable = defaultProduct.getTable()
+                        ptable = defaultProduct.getTable(eupsenv=self)
                         if ptable:
                             pdir[defaultProduct] = \
                                                  set([p[0] for p in ptable.dependencies(self, recursive=True)])
 
                     if topProduct in \
-                           (e[0] for e in defaultProduct.getTable().dependencies(self, recursive=True)):
+                           (e[0] for e in defaultProduct.getTable(eupsenv=self).dependencies(self, recursive=True)):
                         del productDictionary[defaultProduct]
                         pdir[defaultProduct] = set()
                 else:
@@ -3295,6 +3732,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                         shutil.rmtree(dir)
                     except OSError as e:
                         raise RuntimeError(e)
+                    utils.clearStatCache()
 
             removedDirs[dir] = 1
 
@@ -3307,7 +3745,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         product = self.getProduct(productName, versionName)  # can raise ProductNotFound
         deps = [[product, False, 0]]
         if recursive:
-            tbl = product.getTable()
+            tbl = product.getTable(eupsenv=self)
             if tbl:
                 deps += tbl.dependencies(self)
 
@@ -3634,16 +4072,16 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if isinstance(vro, dict):
             if dbz in vro:
-                self._vro = vro[dbz]
+                self._vro = list(vro[dbz])
             elif "default" in vro:
-                self._vro = vro["default"]
+                self._vro = list(vro["default"])
                 if versionName:
                     self._vro[0:0] = ["commandLine"]
             else:
                 raise RuntimeError("Unable to find entry for %s in VRO dictionary for tag %s" %
                                      (dbz, vroTag))
         else:
-            self._vro = vro
+            self._vro = list(vro)           # we're about to modify it
 
         if self.keep:
             self._vro[0:0] = ["keep"]
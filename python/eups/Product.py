@@ -4,7 +4,9 @@ import re
 from configparser import ConfigParser
 
 from . import table as mod_table
+from . import hooks
 from . import utils
+from . import timing
 from .exceptions import ProductNotFound, TableFileNotFound
 
 macrore = { "PROD_ROOT": re.compile(r"^\$PROD_ROOT\b"),
@@ -13,6 +15,26 @@ macrore = { "PROD_ROOT": re.compile(r"^\$PROD_ROOT\b"),
             "UPS_DIR":   re.compile(r"^\$UPS_DIR\b"),
             "UPS_DB":    re.compile(r"^\$UPS_DB\b")     }
 
+class _DefaultTablefile:
+    """
+    The value of a Product's tablefile while it is yet to be determined whether
+    the default table file, <dir>/ups/<name>.table, exists
+    """
+    def __repr__(self):
+        return "_DEFAULT_TABLEFILE"
+
+    def __reduce__(self):
+        return "_DEFAULT_TABLEFILE"
+
+_DEFAULT_TABLEFILE = _DefaultTablefile()
+
+def _tableExists(path):
+    # When deferring table lookups, use the per-process cache of existing paths
+    if hooks.config.Eups.deferTableLookup:
+        return utils.pathExists(path)
+    timing.count("files stat'ed")
+    return os.path.exists(path)
+
 class Product:
     """
     a description of a Product as stored in the stack database.
@@ -45,10 +67,21 @@ class Product:
     Finally, the tableFileName() returns the assumed path to the table file.
     Normally, this is the value of the tablefile attribute; however, if the
     attribute is None, a default name is returned based on the dir attribute.
+
+    If no table is given when a Product is created, the default table file
+    is used if it exists.  If hooks.config.Eups.deferTableLookup is True,
+    the check for its existence is put off until the tablefile attribute
+    (or the table) is needed.
     """
 
     LocalVersionPrefix = "LOCAL:"
 
+    # Many Products are created while querying a stack, so keep them compact.
+    # __dict__ is retained so that callers may still attach their own
+    # attributes (it is only allocated if they do).
+    __slots__ = ("name", "version", "flavor", "dir", "ups_dir", "_tablefile", "db",
+                 "_table", "_tags", "_prodStack", "__dict__")
+
     def __init__(self, name, version, flavor=None, dir=None, table=None,
                  tags=None, db=None, noInit=None, ups_dir=None):
         if (name and not utils.is_string(name)) or isinstance(dir,bool) or noInit is not None:
@@ -79,9 +112,12 @@ class Product:
         self.dir = dir
 
         if not table and dir and name:
-            tablefile = os.path.join(dir,"ups",name+".table");
-            if os.path.exists(tablefile):
-                table = tablefile
+            if hooks.config.Eups.deferTableLookup:
+                table = _DEFAULT_TABLEFILE
+            else:
+                tablefile = os.path.join(dir,"ups",name+".table");
+                if os.path.exists(tablefile):
+                    table = tablefile
         self.tablefile = None
         self._table = None
         if isinstance(table, mod_table.Table):
@@ -116,6 +152,25 @@ class Product:
     def tags(self, value):
         self._tags = value
 
+    @property
+    def tablefile(self):
+        #
+        # The existence of the default table file may not have been checked yet
+        #
+        if self._tablefile is _DEFAULT_TABLEFILE:
+            tablefile = None
+            if self.dir and self.name:
+                tablefile = os.path.join(self.dir, "ups", self.name + ".table")
+                if not _tableExists(tablefile):
+                    tablefile = None
+            self._tablefile = tablefile
+
+        return self._tablefile
+
+    @tablefile.setter
+    def tablefile(self, value):
+        self._tablefile = value
+
     def __hash__(self):                 # needed for set operations (such as toplogicalSort)
         return (hash(self.name) ^
                 hash(self.version) ^
@@ -235,9 +290,9 @@ class Product:
                     if root:
                         n2table = os.path.join(root, self.tablefile)
 
-                    if os.path.exists(ntable):
+                    if _tableExists(ntable):
                         self.tablefile = ntable
-                    elif root and os.path.exists(n2table):
+                    elif root and _tableExists(n2table):
                         self.tablefile = n2table
                     else:
                         self.tablefile = ntable # Hack for now to make tests pass when table file doesn't exist
@@ -347,7 +402,7 @@ class Product:
         return a copy of this product
         """
         out = Product(self.name, self.version, self.flavor, self.dir,
-                      self.tablefile, self.tags, self.db, ups_dir=self.ups_dir)
+                      self._tablefile, self.tags, self.db, ups_dir=self.ups_dir)
         if self._table:
             out._table = self._table
         return out
@@ -395,7 +450,7 @@ class Product:
                 return clone.tablefile
         return self.tablefile
 
-    def getTable(self, addDefaultProduct=None, quiet=False, verbose=0):
+    def getTable(self, addDefaultProduct=None, quiet=False, verbose=0, eupsenv=None):
         """
         return an in-memory instance of the product table.  This will be
         loaded from the path returned by tableFileName() (and cached for
@@ -403,7 +458,8 @@ class Product:
         is known not to have a table file.  A TableError is raised if the
         table file cannot be loaded:  if it cannot be found, a
         TableFileNotFound is raised; if it contains unparsable errors, a
-        BadTableContent is raised.
+        BadTableContent is raised.  eupsenv is the Eups instance that the
+        table's read for (see Table)
         """
         if quiet:
             verbose -= 2
@@ -413,12 +469,12 @@ class Product:
             if tablepath is None:
                 return None
 
-            if not os.path.exists(tablepath):
+            if not _tableExists(tablepath):
                 raise TableFileNotFound(tablepath, self.name, self.version,
                                         self.flavor)
             self._table = mod_table.Table(tablepath, self,
                                           addDefaultProduct=addDefaultProduct, verbose=verbose,
-                                          ).expandEupsVariables(self, quiet)
+                                          eupsenv=eupsenv).expandEupsVariables(self, quiet)
 
             if self._prodStack and self.name and self.version and self.flavor:
                 # pass the loaded table back to the cache
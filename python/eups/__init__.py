@@ -1,15 +1,38 @@
 from .exceptions import *
-from .tags       import Tags, Tag, TagNotRecognized
+from .tags       import Tags, Tag, TagNotRecognized, checkTagsList
 from .Product    import Product
 from .Eups       import Eups
-from .cmd        import commandCallbacks
+from .stack      import ProductStack, persistVersionName as cacheVersion
 
 from . import utils
 
-from .utils      import debug, version, Quiet, dirEnvNameFor, setupEnvNameFor
+from .utils      import debug, version, Quiet, dirEnvNameFor, setupEnvNameFor, cmp_or_key
 from .utils      import determineFlavor as flavor
 
-from .app        import *
+#
+# The command-line machinery (eups.cmd) and the high-level functions in
+# eups.app (which are available as eups.setup, eups.declare, ...) are only
+# imported when first used, so that e.g. the setup command doesn't pay to
+# import the code that only the eups command and eups distrib need
+#
+_appNames = ["printProducts", "printUses", "getDependencies", "expandBuildFile", "expandTableFile",
+             "declare", "undeclare", "clearCache", "listCache", "verify", "Current", "osetup", "setup",
+             "setupProducts", "unsetup", "writeLockfile", "setupFromLockfile", "findProduct", "productDir", "getSetupVersion", "enableLocking"]
 
+def __getattr__(name):
+    import importlib
+    if name == "commandCallbacks":
+        return importlib.import_module(".cmdline", __name__).commandCallbacks
+    elif name in _appNames:
+        value = getattr(importlib.import_module(".app", __name__), name)
+        globals()[name] = value
+        return value
+    elif name in ("app", "cmd", "distrib"):
+        return importlib.import_module("." + name, __name__)
+    elif name == "builder":             # used to be imported by eups.app
+        return importlib.import_module(".distrib.builder", __name__)
 
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
+def __dir__():
+    return sorted(set(globals()) | set(_appNames) | {"commandCallbacks", "app", "cmd", "distrib", "builder"})
@@ -6,14 +6,14 @@ import fnmatch
 import re
 import os
 import pickle
-from .distrib import builder
 from .Eups           import Eups
 from .exceptions     import ProductNotFound
 from .tags           import Tag, checkTagsList
 from .Product import Product
+from .db             import Database, VersionFile
 from .VersionParser  import VersionParser
 from .stack          import ProductStack, persistVersionName as cacheVersion
-from . import utils, table, hooks
+from . import utils, table, hooks, timing
 from .exceptions import EupsException
 from .utils import cmp_or_key
 
@@ -420,6 +420,7 @@ def expandBuildFile(ofd, ifd, product, version, svnroot=None, cvsroot=None, repo
     if svnroot:
         builderVars["SVNROOT"] = svnroot
 
+    from .distrib import builder
     builder.expandBuildFile(ofd, ifd, product, version, verbose, builderVars,
                                     repoVersionName=repoVersion)
 
@@ -446,8 +447,9 @@ def expandTableFile(ofd, ifd, productList, versionRegexp=None, eupsenv=None, for
         eupsenv = Eups()
 
     try:
-        table.expandTableFile(eupsenv, ofd, ifd, productList, versionRegexp, force,
-                              expandVersions, addExactBlock, toplevelName)
+        with eupsenv.batchedResolution():
+            table.expandTableFile(eupsenv, ofd, ifd, productList, versionRegexp, force,
+                                  expandVersions, addExactBlock, toplevelName)
     except ProductNotFound:
         raise
 
@@ -644,6 +646,121 @@ def listCache(path=None, verbose=0, flavor=None):
 
             print("  " + msg)
 
+verifyStateFile = "verified.pickle"     # remembers which version files were found to be OK
+
+def verify(path=None, jobs=None, trust=False, full=False, verbose=0):
+    """
+    Check that every declared product's directory and table file exist.
+
+    Each version file's declarations are remembered (in the user's cache
+    directory for the stack) along with the file's modification time, so
+    a rerun only needs to read the version files that have changed since
+    the last run; the product directories and table files of the others are
+    still checked, unless trust is True.
+    @param path     the stacks to check.  This can be given either
+                        as a python list or a colon-delimited string.  If
+                        None (default), EUPS_PATH will be used.
+    @param jobs     the number of threads to check declarations with; if None,
+                        let concurrent.futures choose
+    @param trust    don't check the declarations in unchanged version files
+                        which were OK last time
+    @param full     ignore what was remembered from previous runs
+    @param verbose  chattiness
+    @return a list of (eupsPathDir, productName, versionName, flavor, problem)
+                        for each broken declaration
+    """
+    import concurrent.futures
+
+    if path is None:
+        path = os.environ["EUPS_PATH"]
+    if utils.is_string(path):
+        path = path.split(":")
+
+    broken = []
+    for p in path:
+        dbpath = os.path.join(p, Eups.ups_db)
+        if not os.path.isdir(dbpath):
+            continue
+
+        stateFile = utils.userStackCacheFor(p)
+        if stateFile:
+            stateFile = os.path.join(stateFile, verifyStateFile)
+
+        verified = {}
+        if stateFile and not full:
+            try:
+                with open(stateFile, "rb") as fd:
+                    verified = pickle.load(fd)
+            except Exception:
+                pass
+
+        def check(versionFile):
+            """Return (stamp, declarations, problems) for a version file"""
+            productName, versionName, fileName = versionFile
+            try:
+                st = os.stat(fileName)
+            except OSError:             # it's been undeclared since we looked
+                return None, None, []
+            stamp = (st.st_mtime_ns, st.st_size)
+
+            prev = verified.get(fileName)
+            if prev and prev[0] == stamp:
+                declarations, ok = prev[1:]
+                if trust and ok:
+                    return stamp, declarations, []
+            else:
+                timing.count("version files verified")
+                declarations = []
+                try:
+                    vfile = VersionFile(fileName, productName, versionName)
+                    for flavor in vfile.getFlavors():
+                        product = vfile.makeProduct(flavor, p, dbpath)
+                        tablefile = None
+                        if vfile.info[flavor].get("table_file"):
+                            tablefile = product.tablefile
+                        declarations.append((flavor, product.dir, tablefile))
+                except Exception as e:
+                    return stamp, None, [(None, "unable to read %s: %s" % (fileName, e))]
+
+            problems = []
+            for flavor, productDir, tablefile in declarations:
+                if utils.isRealFilename(productDir) and not os.path.isdir(productDir):
+                    problems.append((flavor, "product directory %s does not exist" % productDir))
+                elif utils.isRealFilename(tablefile) and not os.path.isfile(tablefile):
+                    problems.append((flavor, "table file %s does not exist" % tablefile))
+
+            return stamp, declarations, problems
+
+        versionFiles = Database(dbpath, defStackRoot=p).findVersionFiles()
+        if jobs == 1:
+            results = [check(vf) for vf in versionFiles]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                results = list(executor.map(check, versionFiles))
+
+        state = {}
+        for (productName, versionName, fileName), (stamp, declarations, problems) in zip(versionFiles, results):
+            broken += [(p, productName, versionName, flavor, problem) for flavor, problem in problems]
+            if declarations is not None:
+                state[fileName] = (stamp, declarations, not problems)
+
+        if verbose:
+            unchanged = [f for f in state if f in verified and verified[f][0] == state[f][0]]
+            print("Verified %d version files in %s (%d unchanged)" % (len(versionFiles), p, len(unchanged)),
+                  file=utils.stdinfo)
+
+        if stateFile:
+            try:
+                os.makedirs(os.path.dirname(stateFile), exist_ok=True)
+                with utils.AtomicFile(stateFile, "wb") as fd:
+                    pickle.dump(state, fd, protocol=4)
+            except OSError as e:
+                if verbose:
+                    print("Unable to save verification state to %s: %s" % (stateFile, e), file=utils.stdwarn)
+
+    broken.sort()
+    return broken
+
 def Current():
     """
     a deprecated means of specifying a preferred tag.  This will return
@@ -698,26 +815,235 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         if version:
             eupsenv.selectVRO(versionName=version)
 
-    if utils.is_string(prefTags):
-        prefTags = prefTags.split()
-    elif isinstance(prefTags, Tag):
-        prefTags = [prefTags]
+    prefTags, postTags = _tagsList(eupsenv, prefTags), _tagsList(eupsenv, postTags)
+
+    ok, version, reason = _setupProduct(eupsenv, productName, version, prefTags, postTags,
+                                        productRoot, fwd, tablefile)
+    if not ok:
+        return ["false"]                # as in /bin/false
+
+    return _environmentCommands(eupsenv, fwd, [productName])
+
+def setupProducts(products, prefTags=None, eupsenv=None, fwd=True, exact_version=False, postTags=[],
+                  vroOptions=None):
+    """
+    Return a set of shell commands which, when sourced, will setup several products.
+    (If fwd is false, unset them up.)
+
+    The resulting environment is the same as that from sourcing the commands returned
+    by setup() for each product in turn, but all the products are resolved by the same
+    Eups instance, so the product stacks, tags, and table files are only read once.  If
+    a product (or one of its dependencies) can't be setup its changes are discarded, the
+    remaining products are setup, and the commands end with "false".
+
+    @param products        a list of (productName, version) pairs; version may be None
+    @param prefTags        the list of requested tags (n.b. the VRO already knows about them)
+    @param eupsenv         the Eups instance to use to do the setup.  If
+                             None, one will be created for it.
+    @param fwd             If False, actually do an unsetup.
+    @param postTags        the list of requested post-tags (n.b. the VRO already knows about them)
+    @param vroOptions      a dict of arguments for eupsenv.selectVRO(), which is called with
+                             each product's version before it's setup.  If None, the VRO is only
+                             reselected if eupsenv was created by this function
+    """
+    if not eupsenv:
+        eupsenv = Eups(readCache=False, exact_version=exact_version)
+        if vroOptions is None:
+            vroOptions = {}
+
+    prefTags, postTags = _tagsList(eupsenv, prefTags), _tagsList(eupsenv, postTags)
+
+    failed = False
+    for productName, version in products:
+        if vroOptions is not None:
+            eupsenv.selectVRO(versionName=version, **vroOptions)
+
+        environ, aliases = os.environ.copy(), eupsenv.aliases.copy()
+        alreadySetupProducts = eupsenv.alreadySetupProducts.copy()
+
+        try:
+            ok, version, reason = _setupProduct(eupsenv, productName, version, prefTags, postTags,
+                                                None, fwd, None)
+        except EupsException as e:      # e.g. one of its dependencies couldn't be setup
+            print(e, file=utils.stderr)
+            ok = False
+
+        if not ok:                      # as if we'd never tried
+            os.environ.clear()
+            os.environ.update(environ)
+            eupsenv.aliases = aliases
+            eupsenv.alreadySetupProducts = alreadySetupProducts
+
+            failed = True
+
+    cmds = _environmentCommands(eupsenv, fwd, [p[0] for p in products])
+    if failed:
+        cmds += ["false"]               # as in /bin/false
+
+    return cmds
+
+lockfileFormatVersion = 1
+
+def writeLockfile(filename, eupsenv, productNames=[]):
+    """
+    Write the result of a setup done by eupsenv (the products that were setup, and the
+    changes to the environment and aliases) to a lockfile, from which setupFromLockfile()
+    can recreate the same environment without reading the product stacks or table files
+    @param filename        the file to write
+    @param eupsenv         the Eups instance that did the setup
+    @param productNames    the names of the products that were requested
+    """
+    import json
+
+    products = []
+    for name in sorted(eupsenv.alreadySetupProducts):
+        product = eupsenv.alreadySetupProducts[name][0]
+        key = utils.setupEnvNameFor(name)
+        if os.environ.get(key) == eupsenv.oldEnviron.get(key):
+            continue                    # it was setup before we started
+
+        products.append(dict(name=product.name, version=product.version, flavor=product.flavor,
+                             dir=product.dir, stackRoot=product.stackRoot()))
+
+    environ = {}
+    for key in set(os.environ) | set(eupsenv.oldEnviron):
+        old, new = eupsenv.oldEnviron.get(key), os.environ.get(key)
+        if old == new:
+            continue
+        if new is None and "eups" not in productNames and \
+                re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
+            continue                    # setup never unsets these
+
+        environ[key] = [old, new]
+
+    aliases = {}
+    for key in set(eupsenv.aliases) | set(eupsenv.oldAliases):
+        if eupsenv.aliases.get(key) != eupsenv.oldAliases.get(key):
+            aliases[key] = eupsenv.aliases.get(key)
+
+    with open(filename, "w") as fd:
+        json.dump(dict(formatVersion=lockfileFormatVersion, eupsVersion=utils.version(),
+                       requested=productNames, flavor=eupsenv.flavor, path=eupsenv.path,
+                       products=products, environ=environ, aliases=aliases),
+                  fd, indent=1, sort_keys=True)
+
+def readLockfile(filename):
+    """Return the contents of a lockfile written by writeLockfile() as a dict"""
+    import json
+
+    try:
+        with open(filename) as fd:
+            contents = json.load(fd)
+    except (IOError, OSError, ValueError) as e:
+        raise EupsException("Unable to read lockfile %s: %s" % (filename, e))
+
+    if not isinstance(contents, dict) or contents.get("formatVersion") != lockfileFormatVersion:
+        raise EupsException("Lockfile %s has an unsupported format; please recreate it" % filename)
+
+    return contents
+
+def setupFromLockfile(filename, shell=None, flavor=None, noaction=False, verbose=0, force=False):
+    """
+    Return a set of shell commands which, when sourced, will recreate the setup saved
+    to a lockfile by writeLockfile().  Neither the product stacks nor the table files
+    are read; we only check that the products' directories still exist.
+
+    Variables that the setup changed by adding to their original value (e.g. PATH) have
+    the same additions made to their current value, so the lockfile may be used in an
+    environment that differs from the one in which it was written.
+
+    @param filename   the lockfile
+    @param shell      the type of shell to generate commands for (default: $EUPS_SHELL)
+    @param flavor     the flavor that the products must have (default: the current flavor)
+    @param noaction   echo the commands rather than executing them
+    @param force      don't raise EupsException if the lockfile fails validation
+    """
+    contents = readLockfile(filename)
+    shell = utils.determineShell(shell)
+    if not flavor:
+        flavor = utils.determineFlavor()
+
+    problems = []
+    if contents["flavor"] != flavor:
+        problems.append("it was written for flavor %s, not %s" % (contents["flavor"], flavor))
+    for product in contents["products"]:
+        if product["dir"] and not os.path.isdir(product["dir"]):
+            problems.append("%s %s's directory %s is missing" %
+                            (product["name"], product["version"], product["dir"]))
+
+    if problems:
+        msg = "Lockfile %s is out of date: %s" % (filename, "; ".join(problems))
+        if not force:
+            raise EupsException(msg + "; please recreate it")
+        if verbose >= 0:
+            print(msg, file=utils.stdwarn)
+
+    # variables that belong to the products are set, never added to
+    productVariables = set()
+    for product in contents["products"]:
+        productVariables.update([utils.setupEnvNameFor(product["name"]),
+                                 utils.dirEnvNameFor(product["name"]),
+                                 utils.dirExtraEnvNameFor(product["name"])])
+
+    oldEnviron = os.environ.copy()
+    for key, (old, new) in contents["environ"].items():
+        if new is None:
+            if key in os.environ:
+                del os.environ[key]
+        elif key in productVariables:
+            os.environ[key] = new
+        else:
+            os.environ[key] = _rebaseValue(os.environ.get(key), old, new)
+
+    aliases = dict((k, v) for k, v in contents["aliases"].items() if v is not None)
+    oldAliases = dict((k, None) for k, v in contents["aliases"].items() if v is None)
+
+    return _shellCommands(shell, oldEnviron, aliases, oldAliases, noaction=noaction, verbose=verbose,
+                          unsetEupsVariables=True)
+
+def _rebaseValue(value, old, new, delim=":"):
+    """
+    Return new, where a variable that setup changed from old to new now has the value value.
+    If new was made by adding to old (e.g. prepending a directory to a path), make the
+    same additions to value;  if old was empty, new is prepended to value, separated by delim
+    (as envPrepend does)
+    """
+    if not value or value == old:
+        return new
+
+    if not old:
+        return new + delim + value
+
+    i = new.find(old)
+    if i < 0:
+        return new
 
-    if prefTags is None:
-        prefTags = []
-    if postTags is None:
-        postTags = []
+    return new[:i] + value + new[i + len(old):]
 
-    if prefTags:
-        checkTagsList(eupsenv, prefTags)
-    if postTags:
-        checkTagsList(eupsenv, postTags)
+def _tagsList(eupsenv, tags):
+    """Return tags (a string, a Tag, a list of either, or None) as a checked list"""
+    if utils.is_string(tags):
+        tags = tags.split()
+    elif isinstance(tags, Tag):
+        tags = [tags]
 
+    if tags is None:
+        tags = []
+
+    if tags:
+        checkTagsList(eupsenv, tags)
+
+    return tags
+
+def _setupProduct(eupsenv, productName, version, prefTags, postTags, productRoot, fwd, tablefile):
+    """
+    (Un)setup a product in eupsenv, reporting problems to the user.  Return the
+    (ok, version, reason) tuple from Eups.setup()
+    """
     versionRequested = version
     ok, version, reason = eupsenv.setup(productName, version, fwd,
                                         productRoot=productRoot, tablefile=tablefile)
 
-    cmds = []
     if ok:
         #
         # Check that we got the desired tag
@@ -751,121 +1077,141 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
 
                         print("No versions of %s are tagged%s %s; setup version is %s" % \
                               (productName, extra, ",".join(prefTags + postTags), version), file=utils.stdwarn)
+    elif fwd and version is None:
+        print("Unable to find an acceptable version of", productName, file=utils.stderr)
+        if eupsenv.verbose and os.path.exists(productName):
+            print("(Did you mean setup -r %s?)" % productName, file=utils.stderr)
+    else:
+        if fwd:
+            versionName = version
 
-        #
-        # Set new variables
-        #
-        for key, val in os.environ.items():
-            try:
-                if val == eupsenv.oldEnviron[key]:
-                    continue
-            except KeyError:
-                pass
+            if eupsenv.isLegalRelativeVersion(versionName):
+                versionName = ""
 
-            if val and not re.search(r"^['\"].*['\"]$", val) and \
-                   re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
-                val = "'%s'" % val
+            if versionName:
+                versionName = " " + versionName
 
-            if eupsenv.shell in ("sh", "zsh",):
-                cmd = "export %s=%s" % (key, val)
-            elif eupsenv.shell in ("csh",):
-                cmd = "setenv %s %s" % (key, val)
+            print("Failed to setup %s%s: %s" % (productName, versionName, reason), file=utils.stderr)
+        else:
+            print("Failed to unsetup %s: %s" % (productName, reason), file=utils.stderr)
 
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # these variables are an implementation detail
+    return ok, version, reason
 
-                cmd = "echo \"%s\"" % cmd
+def _environmentCommands(eupsenv, fwd, productNames):
+    """
+    Return the shell commands that take the environment (and aliases) from their
+    state when eupsenv was created to their current state
+    @param fwd            False if we unsetup the products
+    @param productNames   the names of the products that we (un)setup
+    """
+    #
+    # Extra environment variables that EUPS uses
+    #
+    if not fwd and "eups" in productNames:
+        for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
+            if k in os.environ:
+                del os.environ[k]
 
-            cmds += [cmd]
-        #
-        # Extra environment variables that EUPS uses
-        #
-        if not fwd and productName == "eups":
-            for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
-                if k in os.environ:
-                    del os.environ[k]
-        #
-        # unset ones that have disappeared
-        #
-        for key in eupsenv.oldEnviron.keys():
-            if productName != "eups":   # the world will break if we delete these
-                if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
-                    continue
+    return _shellCommands(eupsenv.shell, eupsenv.oldEnviron, eupsenv.aliases, eupsenv.oldAliases,
+                          noaction=eupsenv.noaction, verbose=eupsenv.verbose,
+                          unsetEupsVariables="eups" in productNames)
 
-            if key in os.environ:
+def _shellCommands(shell, oldEnviron, aliases, oldAliases, noaction=False, verbose=0,
+                   unsetEupsVariables=False):
+    """
+    Return the commands for the given type of shell that take the environment and
+    aliases from oldEnviron and oldAliases to os.environ and aliases
+    @param noaction            echo the commands rather than executing them
+    @param unsetEupsVariables  allow $EUPS_{DIR,PATH,PKGROOT,SHELL} to be unset
+    """
+    cmds = []
+    #
+    # Set new variables
+    #
+    for key, val in os.environ.items():
+        try:
+            if val == oldEnviron[key]:
                 continue
+        except KeyError:
+            pass
 
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unsetenv %s" % (key)
+        if val and not re.search(r"^['\"].*['\"]$", val) and \
+               re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
+            val = "'%s'" % val
 
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # an implementation detail
+        if shell in ("sh", "zsh",):
+            cmd = "export %s=%s" % (key, val)
+        elif shell in ("csh",):
+            cmd = "setenv %s %s" % (key, val)
 
-                cmd = "echo \"%s\"" % cmd
+        if noaction:
+            if verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # these variables are an implementation detail
 
-            cmds += [cmd]
-        #
-        # Now handle aliases
-        #
-        for key in eupsenv.aliases.keys():
-            value = eupsenv.aliases[key]
+            cmd = "echo \"%s\"" % cmd
 
-            try:
-                if value == eupsenv.oldAliases[key]:
-                    continue
-            except KeyError:
-                pass
+        cmds += [cmd]
+    #
+    # unset ones that have disappeared
+    #
+    for key in oldEnviron.keys():
+        if not unsetEupsVariables:   # the world will break if we delete these
+            if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
+                continue
 
-            if eupsenv.shell == "sh":
-                cmd = "%s() { %s ; }" % (key, value)
-            elif eupsenv.shell == "csh":
-                value = re.sub(r'"?\$@"?', r"\!*", value)
-                cmd = "alias %s \'%s\'" % (key, value)
+        if key in os.environ:
+            continue
 
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
+        if shell == "sh" or shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif shell == "csh":
+            cmd = "unsetenv %s" % (key)
 
-            cmds += [cmd]
-        #
-        # and unset ones that used to be present, but are now gone
-        #
-        for key in eupsenv.oldAliases.keys():
-            if key in eupsenv.aliases:
-                continue
+        if noaction:
+            if verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # an implementation detail
 
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unalias %s" % (key)
+            cmd = "echo \"%s\"" % cmd
 
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % cmd
+        cmds += [cmd]
+    #
+    # Now handle aliases
+    #
+    for key in aliases.keys():
+        value = aliases[key]
 
-            cmds += [cmd]
-    elif fwd and version is None:
-        print("Unable to find an acceptable version of", productName, file=utils.stderr)
-        if eupsenv.verbose and os.path.exists(productName):
-            print("(Did you mean setup -r %s?)" % productName, file=utils.stderr)
-        cmds += ["false"]               # as in /bin/false
-    else:
-        if fwd:
-            versionName = version
+        try:
+            if value == oldAliases[key]:
+                continue
+        except KeyError:
+            pass
 
-            if eupsenv.isLegalRelativeVersion(versionName):
-                versionName = ""
+        if shell == "sh":
+            cmd = "%s() { %s ; }" % (key, value)
+        elif shell == "csh":
+            value = re.sub(r'"?\$@"?', r"\!*", value)
+            cmd = "alias %s \'%s\'" % (key, value)
 
-            if versionName:
-                versionName = " " + versionName
+        if noaction:
+            cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
 
-            print("Failed to setup %s%s: %s" % (productName, versionName, reason), file=utils.stderr)
-        else:
-            print("Failed to unsetup %s: %s" % (productName, reason), file=utils.stderr)
+        cmds += [cmd]
+    #
+    # and unset ones that used to be present, but are now gone
+    #
+    for key in oldAliases.keys():
+        if key in aliases:
+            continue
 
-        cmds += ["false"]               # as in /bin/false
+        if shell == "sh" or shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif shell == "csh":
+            cmd = "unalias %s" % (key)
+
+        if noaction:
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
 
     return cmds
 
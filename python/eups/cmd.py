@@ -35,14 +35,16 @@ import re
 import os
 import sys
 import copy
+import time
 import optparse
+import shlex
 import eups
 from . import lock
 from . import tags
 from . import utils
-from . import distrib
 from . import hooks
-from .distrib.server import ServerConf, Mapping, importClass
+from .cmdline import EupsOptionParser, commandCallbacks
+# n.b. eups.distrib is imported by the commands that use it, as importing it is slow
 
 _errstrm = utils.stderr
 
@@ -97,7 +99,7 @@ Common"""
 
     def addOptions(self):
         self.clo.add_option("--debug", dest="debug", action="store", default="",
-                            help="turn on specified debugging behaviors (allowed: debug, profile, raise)")
+                            help="turn on specified debugging behaviors (allowed: debug, profile, raise, timing)")
         self.clo.add_option("-h", "--help", dest="help", action="store_true",
                             help="show command-line help and exit")
         self.clo.add_option("--noCallbacks", dest="noCallbacks", action="store_true",
@@ -172,7 +174,10 @@ Common"""
         except Exception:
             raise
         finally:
-            lock.giveLocks(locks, ecmd.opts.verbose)
+            try:
+                eups.Eups.flushAllCaches()  # while we still hold the locks
+            finally:
+                lock.giveLocks(locks, ecmd.opts.verbose)
 
     def __init__(self, args=None, toolname=None, cmd=None, lockType=lock.LOCK_EX):
         """
@@ -281,7 +286,7 @@ Common"""
             opts = self.opts
 
         try:
-            eups.commandCallbacks.apply(None, self.cmd, self.opts, self.args)
+            commandCallbacks.apply(None, self.cmd, self.opts, self.args)
         except eups.OperationForbidden as e:
             e.status = 255
             raise
@@ -335,7 +340,7 @@ Common"""
             myeups.includeUserDataDirInPath()
 
         try:
-            eups.commandCallbacks.apply(myeups, self.cmd, self.opts, self.args)
+            commandCallbacks.apply(myeups, self.cmd, self.opts, self.args)
         except eups.OperationForbidden as e:
             e.status = 255
             raise
@@ -345,52 +350,6 @@ Common"""
 
         return myeups
 
-#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
-
-class CommandCallbacks:
-    """Callback to allow users to customize behaviour by defining hooks in EUPS_STARTUP
-        and calling eups.commandCallbacks.add(hook)"""
-
-    callbacks = []
-
-    def __init__(self):
-        pass
-
-    def add(self, callback):
-        """
-        Add a command callback.
-
-        The arguments are the command (e.g. "admin" if you type "eups admin")
-        and sys.argv, which you may modify;  cmd == argv[1] if len(argv) > 1 otherwise None
-
-        E.g.
-        if cmd == "fetch":
-            argv[1:2] = ["distrib", "install"]
-        """
-        CommandCallbacks.callbacks += [callback]
-
-    def apply(self, myeups, cmd, opts, args):
-        """Call the command callbacks on cmd"""
-
-        if opts.noCallbacks:
-            return
-
-        for hook in CommandCallbacks.callbacks:
-            hook(myeups, cmd, opts, args)
-
-    def clear(self):
-        """Clear the list of command callbacks"""
-        CommandCallbacks.callbacks = []
-
-    def list(self):
-        for hook in CommandCallbacks.callbacks:
-            print(hook, file=sys.stderr)
-
-try:
-    type(commandCallbacks)
-except NameError:
-    commandCallbacks = CommandCallbacks()
-
 #=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-==-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
 class FlavorCmd(EupsCmd):
@@ -1170,21 +1129,19 @@ If there is no table file, give "none" to the -m option.  If the product is
 already declared, attempts to redeclare will fail unless -F is used.  If you
 only wish to assign a tag, you should use the -t option but not include
 -r.
+
+With --from-file, the declarations are read from a file (one per line, with
+the same syntax as this command's arguments, e.g. "-r /path/to/foo foo 1.0 -t
+current"; blank lines and #-comments are ignored).  Options given on the
+command line apply to every line.  All the declarations are checked before
+any is made, and the product cache is only updated once.
 """
 
     def addOptions(self):
         # these are specific to this command
-        self.clo.add_option("-r", "--root", dest="productDir", action="store",
-                            help="root directory where product is installed")
-        self.clo.add_option("-L", "--import-file", dest="externalFileList", action="append", default=[],
-                            help="Import the given file directly into $PRODUCT_DIR_EXTRA")
-        self.clo.add_option("-M", "--import-table", dest="externalTablefile", action="store",
-                            help="Import the given table file directly into the database " +
-                            "(may be \"-\" for stdin).")
-        self.clo.add_option("-m", "--table", dest="tablefile", action="store",
-                            help='table file location (may be "none" for no table file)')
-        self.clo.add_option("-t", "--tag", dest="tag", action="append",
-                            help="assign TAG to the specified product")
+        self._addDeclarationOptions(self.clo)
+        self.clo.add_option("--from-file", dest="declarationFile", action="store",
+                            help="Read declarations from this file (may be \"-\" for stdin)")
 
         # these options are used to configure the Eups instance
         self.addEupsOptions()
@@ -1195,6 +1152,20 @@ only wish to assign a tag, you should use the -t option but not include
         self.clo.add_option("-c", "--current", dest="currentTag", action="store_true", default=False,
                             help="same as --tag=current")
 
+    def _addDeclarationOptions(self, parser):
+        """Add the options that describe a single declaration to parser"""
+        parser.add_option("-r", "--root", dest="productDir", action="store",
+                          help="root directory where product is installed")
+        parser.add_option("-L", "--import-file", dest="externalFileList", action="append", default=[],
+                          help="Import the given file directly into $PRODUCT_DIR_EXTRA")
+        parser.add_option("-M", "--import-table", dest="externalTablefile", action="store",
+                          help="Import the given table file directly into the database " +
+                          "(may be \"-\" for stdin).")
+        parser.add_option("-m", "--table", dest="tablefile", action="store",
+                          help='table file location (may be "none" for no table file)')
+        parser.add_option("-t", "--tag", dest="tag", action="append",
+                          help="assign TAG to the specified product")
+
     def execute(self):
         try:
             myeups = self.createEups()
@@ -1202,99 +1173,180 @@ only wish to assign a tag, you should use the -t option but not include
             e.status = 9
             raise
 
-        externalFileList = []
-        product, version = None, None
-        if len(self.args) > 0:
-            product = self.args[0]
-        if len(self.args) > 1:
-            version = self.args[1]
+        if not self.opts.declarationFile:
+            status, declaration = self._checkDeclaration(myeups, self.opts, self.args)
+            if status:
+                return status
+            declarations = [declaration]
+        else:
+            if self.args:
+                self.err("You may not specify a product as well as --from-file")
+                return 2
 
-        if self.opts.currentTag:
-            if not self.opts.tag:
-                self.opts.tag = []
-            self.opts.tag.append("current")
-        if self.opts.tag:
-            if len(self.opts.tag) > 1:
-                self.err("You may only set one tag at a time: %s" % ", ".join(self.opts.tag))
-                return 4
+            declarations = []
+            for lineNo, opts, args in self._readDeclarations(self.opts.declarationFile):
+                if opts is None:
+                    self.err("%s:%d: %s" % (self.opts.declarationFile, lineNo, args))
+                    return 2
+
+                status, declaration = self._checkDeclaration(myeups, opts, args)
+                if status:
+                    self.err("Error at %s:%d; nothing was declared" % (self.opts.declarationFile, lineNo))
+                    return status
+                declarations.append(declaration)
+
+        try:
+            with myeups.transaction([product for product, version, kwargs in declarations]):
+                for product, version, kwargs in declarations:
+                    if self.opts.verbose:
+                        print("Declaring %s %s" % (product, version), file=utils.stdinfo)
+
+                    eups.declare(product, version, eupsenv=myeups, **kwargs)
+        except eups.EupsException as e:
+            e.status = 2
+            raise
+
+        return 0
+
+    def _readDeclarations(self, fileName):
+        """
+        Return a list of (lineNo, opts, args) for the declarations in fileName;  if a line can't be
+        parsed opts is None and args is the error message.  The values of self.opts are the defaults
+        """
+        parser = EupsOptionParser(self._errstrm, prog=self.prog)
+        self._addDeclarationOptions(parser)
+        parser.add_option("-c", "--current", dest="currentTag", action="store_true")
+
+        def error(msg):
+            raise optparse.OptParseError(msg)
+        parser.error = error
+
+        try:
+            if fileName == "-":
+                lines = sys.stdin.readlines()
+            else:
+                with open(fileName) as fd:
+                    lines = fd.readlines()
+        except OSError as e:
+            raise eups.EupsException("Unable to read declarations from %s: %s" % (fileName, e))
 
-            self.opts.tag = self.opts.tag[0]
+        declarations = []
+        for lineNo, line in enumerate(lines, 1):
+            try:
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+
+                opts, args = parser.parse_args(words, values=copy.deepcopy(self.opts))
+            except (ValueError, optparse.OptParseError) as e:
+                declarations.append((lineNo, None, e))
+                continue
+
+            declarations.append((lineNo, opts, args))
+
+        return declarations
+
+    def _checkDeclaration(self, myeups, opts, args):
+        """
+        Check a declaration given as the command's options and arguments, returning (status, declaration)
+        where declaration is (product, version, kwargs for eups.declare);  status is non-zero (and
+        declaration None) if the declaration is invalid
+        """
+        externalFileList = []
+        product, version = None, None
+        if len(args) > 0:
+            product = args[0]
+        if len(args) > 1:
+            version = args[1]
+
+        if opts.currentTag:
+            if not opts.tag:
+                opts.tag = []
+            opts.tag.append("current")
+        if opts.tag:
+            if len(opts.tag) > 1:
+                self.err("You may only set one tag at a time: %s" % ", ".join(opts.tag))
+                return 4, None
+
+            opts.tag = opts.tag[0]
 
         if not product:
-            if self.opts.tablefile == "none":
-                self.err("Unable to guess product name from table file name %s" % self.opts.tablefile)
-                return 2
-            if self.opts.externalTablefile != None:
+            if opts.tablefile == "none":
+                self.err("Unable to guess product name from table file name %s" % opts.tablefile)
+                return 2, None
+            if opts.externalTablefile != None:
                 self.err("Unable to guess product name from external table file \"%s\"" %
-                         self.opts.externalTablefile)
-                return 2
+                         opts.externalTablefile)
+                return 2, None
 
-            if not self.opts.productDir:
+            if not opts.productDir:
                 self.err("Unable to guess product name as you didn't specify a directory")
-                return 2
-            if self.opts.productDir == "none":
+                return 2, None
+            if opts.productDir == "none":
                 self.err("Unable to guess product name as product has no directory")
-                return 2
+                return 2, None
 
             try:
-                ups_dir = os.path.join(self.opts.productDir,"ups")
+                ups_dir = os.path.join(opts.productDir,"ups")
                 if not os.path.isdir(ups_dir):
                     self.err("Unable to guess product name as product has no ups directory")
-                    return 2
+                    return 2, None
                 product = utils.guessProduct(ups_dir)
             except RuntimeError as msg:
                 self.err(msg)
-                return 2
-            base, v = os.path.split(os.path.abspath(self.opts.productDir))
+                return 2, None
+            base, v = os.path.split(os.path.abspath(opts.productDir))
             base, p = os.path.split(base)
 
             if product == p:
                 if not version:
                     version = v
             else:
-                if not (version or self.opts.tag):
+                if not (version or opts.tag):
                     self.err("Guessed product %s from ups directory, but %s from path" % (product, p))
-                    return 2
+                    return 2, None
 
-        if not version and self.opts.tag:
-            version = "tag:%s" % self.opts.tag # We're declaring a tagged version so we don't need a name
+        if not version and opts.tag:
+            version = "tag:%s" % opts.tag # We're declaring a tagged version so we don't need a name
 
         if not product:
             self.err("Please specify a product name and version")
-            return 2
+            return 2, None
         if not version:
             self.err("Please also specify a product version")
-            return 2
+            return 2, None
 
-        if self.opts.tablefile and self.opts.externalTablefile:
+        if opts.tablefile and opts.externalTablefile:
             self.err("You may not specify both -m and -M")
-            return 3
+            return 3, None
+
+        if utils.isRealFilename(opts.productDir) and opts.productDir != "/dev/null" and \
+                not os.path.isdir(os.path.expanduser(opts.productDir)):
+            self.err("Product %s %s's productDir %s is not a directory" % (product, version, opts.productDir))
+            return 2, None
 
-        tablefile = self.opts.tablefile
-        if self.opts.externalTablefile:
-            if self.opts.externalTablefile == "-":
+        tablefile = opts.tablefile
+        if opts.externalTablefile:
+            if opts.externalTablefile == "-":
                 tablefile = sys.stdin
             else:
                 try:
-                    tablefile = open(self.opts.externalTablefile, "r")
+                    tablefile = open(opts.externalTablefile, "r")
                 except OSError as e:
-                    self.err("Error opening %s: %s" % (self.opts.externalTablefile, e))
-                    return 4
+                    self.err("Error opening %s: %s" % (opts.externalTablefile, e))
+                    return 4, None
 
-        if self.opts.verbose:
-            print("Declaring %s %s" % (product, version), file=utils.stdinfo)
-
-        for f0 in self.opts.externalFileList:
+        for f0 in opts.externalFileList:
             if f0 == "-":
                 print("eups declare --import-file does not interpret \"-\" as stdin; ask RHL nicely", file=_errstrm)
-                return 4
+                return 4, None
 
             f = f0.split(":")
             fileNameIn = f.pop(0)
 
             if not os.path.exists(fileNameIn):
                 print("File %s does not exist" % fileNameIn, file=_errstrm)
-                return 4
+                return 4, None
 
             dirName, fileName = "", None
             if f:
@@ -1314,32 +1366,25 @@ only wish to assign a tag, you should use the -t option but not include
 
             externalFileList.append((fileNameIn, os.path.join(dirName, fileName),))
 
-        if self.opts.tag:
+        if opts.tag:
             try:
-                tag = myeups.tags.getTag(self.opts.tag)
+                tag = myeups.tags.getTag(opts.tag)
 
                 if myeups.isReservedTag(tag):
-                    if self.opts.force:
-                        self.err("%s is a reserved tag, but proceeding anyway)" % self.opts.tag)
+                    if opts.force:
+                        self.err("%s is a reserved tag, but proceeding anyway)" % opts.tag)
                     else:
-                        self.err("%s is a reserved tag (use --force to set)" % self.opts.tag)
-                        return 1
+                        self.err("%s is a reserved tag (use --force to set)" % opts.tag)
+                        return 1, None
             except eups.TagNotRecognized:
-                self.err("%s: Unsupported tag name" % self.opts.tag)
-                return 1
+                self.err("%s: Unsupported tag name" % opts.tag)
+                return 1, None
             except eups.EupsException as e:
                 e.status = 9
                 raise
 
-        try:
-            eups.declare(product, version, self.opts.productDir,
-                         tablefile=tablefile, externalFileList=externalFileList,
-                         tag=self.opts.tag, eupsenv=myeups)
-        except eups.EupsException as e:
-            e.status = 2
-            raise
-
-        return 0
+        return 0, (product, version, dict(productDir=opts.productDir, tablefile=tablefile,
+                                          externalFileList=externalFileList, tag=opts.tag))
 
 
 class UndeclareCmd(EupsCmd):
@@ -1518,7 +1563,7 @@ where it is installed.
 
 class AdminCmd(EupsCmd):
 
-    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show] [-h|--help] [-r root]"
+    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show|verify] [-h|--help] [-r root]"
 
     # set this to True if the description is preformatted.  If false, it
     # will be automatically reformatted to fit the screen
@@ -1556,12 +1601,14 @@ that are writable by the user.
             self.err("Unrecognized admin subcommand: %s" % subcmd)
             return 10
 
-        lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
-                       ecmd.lockType, nolocks=ecmd.opts.nolocks, verbose=ecmd.opts.verbose - ecmd.opts.quiet)
-
-        return ecmd.run()
+        locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
+                               ecmd.lockType, nolocks=ecmd.opts.nolocks,
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet)
 
-        return 0
+        try:
+            return ecmd.run()
+        finally:
+            lock.giveLocks(locks, ecmd.opts.verbose)
 
 class AdminBuildCacheCmd(EupsCmd):
 
@@ -1589,7 +1636,7 @@ class AdminBuildCacheCmd(EupsCmd):
             return 1
 
         eups.clearCache(inUserDir=not self.opts.asAdmin, verbose=self.opts.verbose)
-        eups.Eups(readCache=True, asAdmin=self.opts.asAdmin)
+        eups.Eups(readCache=True, asAdmin=self.opts.asAdmin).versions.values()  # read (and so cache) the stacks
 
         return 0
 
@@ -1711,6 +1758,7 @@ class AdminClearServerCacheCmd(EupsCmd):
                             "(may be a URL or scp specification).  Default: find in $EUPS_PKGROOT")
 
     def execute(self):
+        from . import distrib
         self.args.pop(0)                # remove the "admin"
 
         if len(self.args) > 0:
@@ -1723,7 +1771,7 @@ class AdminClearServerCacheCmd(EupsCmd):
 
         myeups = eups.Eups(readCache=False)
         # FIXME: this is not clearing caches in the user's .eups dir.
-        ServerConf.clearConfigCache(myeups, pkgroots, self.opts.verbose)
+        distrib.server.ServerConf.clearConfigCache(myeups, pkgroots, self.opts.verbose)
 
         return 0
 
@@ -1892,11 +1940,57 @@ class AdminListCacheCmd(EupsCmd):
 
         return 0
 
+class AdminVerifyCmd(EupsCmd):
+
+    usage = "%prog admin verify [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Check that the product directory and table file of every declared product exist,
+listing the broken declarations.  The version files found to be OK are remembered, so
+a rerun only rereads those that have changed.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("-J", "--jobs", dest="jobs", action="store", type="int", default=None,
+                            help="Check declarations using this many threads")
+        self.clo.add_option("--full", dest="full", action="store_true", default=False,
+                            help="Forget the results of previous runs, and check everything")
+        self.clo.add_option("--trust", dest="trust", action="store_true", default=False,
+                            help="Don't recheck unchanged declarations that were OK last time")
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 2
+
+        path = self.createEups(self.opts, readCache=False).path
+        broken = eups.verify(path, jobs=self.opts.jobs, trust=self.opts.trust, full=self.opts.full,
+                             verbose=self.opts.verbose)
+
+        for eupsPathDir, productName, versionName, flavor, problem in broken:
+            msg = "%s %s" % (productName, versionName)
+            if flavor:
+                msg += " (%s)" % flavor
+            if len(path) > 1:
+                msg += " in %s" % eupsPathDir
+            print("%s: %s" % (msg, problem))
+
+        return 1 if broken else 0
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 class DistribCmd(EupsCmd):
 
-    usage = "%prog distrib [clean|create|declare|install|list|path] [-h|--help] [options] ..."
+    usage = "%prog distrib [cache|clean|create|declare|install|list|path] [-h|--help] [options] ..."
 
     # set this to True if the description is preformatted.  If false, it
     # will be automatically reformatted to fit the screen
@@ -1911,6 +2005,7 @@ An end-user uses the following sub-commands to install packages:
    path      list the distribution servers
    install   download and install a package
    clean     clean up any leftover build files from an install (that failed)
+   cache     manage the local cache of built products
 To use these, the user needs write-access to a product stack and database.
 
 A server provider uses:
@@ -1950,10 +2045,14 @@ Common """
             self.err("Unrecognized distrib subcommand: %s" % subcmd)
             return 10
 
-        lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
-                       ecmd.lockType, nolocks=ecmd.opts.nolocks, verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+        locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
+                               ecmd.lockType, nolocks=ecmd.opts.nolocks,
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet)
 
-        return ecmd.run()
+        try:
+            return ecmd.run()
+        finally:
+            lock.giveLocks(locks, ecmd.opts.verbose)
 
 class DistribDeclareCmd(EupsCmd):
 
@@ -1983,6 +2082,7 @@ If no product or version is provided, all defined tags are defined.
         EupsCmd.addOptions(self)
 
     def execute(self):
+        from . import distrib
         # get rid of sub-command arg
         self.args.pop(0)
 
@@ -2027,7 +2127,7 @@ If no product or version is provided, all defined tags are defined.
 
         server = distrib.Repository(myeups, pkgroot)
         clsname = server.distServer.getConfigProperty('DISTRIB_CLASS', 'eups.distrib.Distrib.DefaultDistrib').split(':')[-1]
-        distribClass = importClass(clsname)
+        distribClass = distrib.server.importClass(clsname)
         dist = distribClass(myeups, server.distServer, verbosity=self.opts.verbose)
 
         pl = dist.getTaggedRelease(pkgroot, tagName)
@@ -2092,6 +2192,7 @@ slowly as each product's availability will be checked.
                             help="equivalent to --server-dir (deprecated)")
 
     def execute(self):
+        from . import distrib
         myeups = eups.Eups(readCache=False)
         if self.opts.tag:
             # Note: tag may not yet be registered locally, yet; though it may be
@@ -2185,6 +2286,7 @@ tag will be installed.
 """
 
     def addOptions(self):
+        from . import distrib
         self.clo.enable_interspersed_args()
 
         self.clo.add_option("-d", "--declareAs", dest="alsoTag", action="append", metavar="TAG",
@@ -2244,6 +2346,7 @@ tag will be installed.
                             help="Make top level product current (equivalent to --tag current)")
 
     def execute(self):
+        from . import distrib
         try:
             _opts = copy.deepcopy(self.opts)
             _opts.tag = None
@@ -2438,6 +2541,7 @@ product will be fully removed, even if its installation was successful.
                             help="equivalent to --repository (deprecated)")
 
     def execute(self):
+        from . import distrib
         # get rid of sub-command arg
         self.args.pop(0)
 
@@ -2514,6 +2618,8 @@ class DistribCreateCmd(EupsCmd):
                             help="Use this manifest file for the requested product")
         self.clo.add_option("-j", "--nodepend", dest="nodepend", action="store_true", default=False,
                             help="Just create package for named product, not its dependencies")
+        self.clo.add_option("-J", "--jobs", dest="jobs", action="store", type="int", default=1,
+                            help="Create up to this many packages in parallel")
         self.clo.add_option("-r", "--repository", "--server-dir",
                             dest="repos", action="append", metavar="BASEURL",
                             help="the base URL for other repositories to consult (repeat as needed).  " +
@@ -2569,6 +2675,7 @@ class DistribCreateCmd(EupsCmd):
 
 
     def execute(self):
+        from . import distrib
         # get rid of sub-command arg
         self.args.pop(0)
 
@@ -2644,6 +2751,7 @@ class DistribCreateCmd(EupsCmd):
         dopts['noaction']   = self.opts.noaction
         dopts["allowIncomplete"] = self.opts.allowIncomplete
         dopts["exact"] = self.opts.exact_version
+        dopts["jobs"] = self.opts.jobs
         if self.opts.serverOpts:
             for opt in self.opts.serverOpts:
                 try:
@@ -2709,7 +2817,7 @@ class DistribCreateCmd(EupsCmd):
             if not topProduct:
                 raise RuntimeError("I can't find product %s %s" % (productName, version))
 
-            mapping = Mapping()
+            mapping = distrib.server.Mapping()
             mapping.add(inProduct=productName, inVersion=version,
                         outVersion=self.incrBuildVersion(myeups, productName, version))
 
@@ -2770,10 +2878,12 @@ class DistribCreateCmd(EupsCmd):
                 server = distrib.Repository(myeups, self.opts.serverDir,
                                             self.opts.useFlavor, options=dopts,
                                             verbosity=self.opts.verbose, log=log)
-                server.create(self.opts.distribTypeName, productName,
-                              version, nodepend=self.opts.nodepend, options=dopts,
-                              manifest=self.opts.manifest,
-                              packageId=self.opts.packageId, repositories=repos)
+                # the products' dependencies overlap, so only resolve each once
+                with myeups.batchedResolution():
+                    server.create(self.opts.distribTypeName, productName,
+                                  version, nodepend=self.opts.nodepend, options=dopts,
+                                  manifest=self.opts.manifest,
+                                  packageId=self.opts.packageId, repositories=repos)
 
             except eups.EupsException as e:
                 e.status = 1
@@ -2803,6 +2913,72 @@ integer argument, n, will cause just the n-th URL to be listed (where
 
         self._init("EUPS_PKGROOT", "|")
 
+class DistribCacheCmd(EupsCmd):
+
+    usage = "%prog distrib cache [-h|--help] [options] [list|clear [product [version]]|prune]"
+
+    # set this to True if the description is preformatted.  If false, it
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Manage the local cache of products built by eupspkg (enabled by setting
+hooks.config.distrib["eupspkg"]["buildCache"] to a directory).  "list" (the default)
+lists the cached builds, most recently used first; "clear" removes all of them (or just
+those of the given product and version); "prune" evicts the least recently used builds
+until the cache is no larger than its maximum size (or --max-size).
+"""
+
+    def addOptions(self):
+        self.clo.add_option("-c", "--cache-dir", dest="cacheDir", action="store", metavar="DIR",
+                            help="Use the build cache in DIR")
+        self.clo.add_option("-s", "--max-size", dest="maxSize", action="store", metavar="SIZE",
+                            help="The size to prune the cache to (e.g. 20G)")
+
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+    def execute(self):
+        from . import distrib
+        # get rid of sub-command arg
+        self.args.pop(0)
+
+        action = self.args.pop(0) if self.args else "list"
+        if action not in ("list", "clear", "prune"):
+            self.err("Unrecognized build cache action: %s" % action)
+            return 2
+        if self.args and action != "clear" or len(self.args) > 2:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 2
+
+        options = dict(buildCache=self.opts.cacheDir) if self.opts.cacheDir else None
+        cache = distrib.BuildCache.fromConfig(options, self.opts.verbose)
+        if cache is None:
+            self.err("No build cache is configured; please set hooks.config.distrib[\"eupspkg\"][\"buildCache\"] or use --cache-dir")
+            return 3
+
+        if action == "list":
+            for entry in cache.entries():
+                print("%-20s %-20s %-10s %8.1fM  %s" % (entry["product"], entry["version"], entry["flavor"],
+                                                        entry["size"]/1024.0**2,
+                                                        utils.ctimeTZ(time.localtime(entry["lastUsed"]))))
+        elif action == "clear":
+            n = cache.clear(*self.args)
+            if self.opts.verbose:
+                print("Removed %d build%s from %s" % (n, "" if n == 1 else "s", cache.cacheDir),
+                      file=utils.stdinfo)
+        else:
+            maxSize = self.opts.maxSize
+            if maxSize is None and cache.maxSize is None:
+                self.err("Please specify the size to prune the cache to")
+                return 2
+            n = cache.evict(maxSize)
+            if self.opts.verbose:
+                print("Evicted %d build%s from %s" % (n, "" if n == 1 else "s", cache.cacheDir),
+                      file=utils.stdinfo)
+
+        return 0
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 class DistribTagsCmd(EupsCmd):
 
@@ -2834,6 +3010,7 @@ The tagname may be a glob pattern.
                             help="equivalent to --server-dir (deprecated)")
 
     def execute(self):
+        from . import distrib
         myeups = eups.Eups(readCache=False)
 
         # get rid of sub-command arg
@@ -2912,6 +3089,12 @@ class TagsCmd(EupsCmd):
         self.clo.add_option("--delete", action="store", default=None,
                             help="Specify a tag to delete")
 
+    def __init__(self, **kwargs):
+        EupsCmd.__init__(self, **kwargs)
+
+        if self.lockType is not None and (self.opts.clone or self.opts.delete):
+            self.lockType = lock.LOCK_EX # we're changing tags, not just listing them
+
     def execute(self):
         myeups = self.createEups(self.opts)
 
@@ -3139,39 +3322,6 @@ def makeEupsCmd(cmdName, cmd):
 
 #=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-==-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
-class EupsOptionParser(optparse.OptionParser):
-    """
-    a specialization for parsing the eups command line.  In particular, the
-    options that appear in the help messages will depend on the command
-    being accessed.
-    """
-
-    def __init__(self, helpstrm=None, usage=None, description=None,
-                 formatdesc=True, prog=None):
-
-        optparse.OptionParser.__init__(self, usage=usage,
-                                       description=description,
-                                       prog=prog,
-                                       add_help_option=False,
-                                       conflict_handler="resolve")
-
-        self._preformattedDescr = not formatdesc
-        if not helpstrm:
-            helpstrm = _errstrm
-        self._helpstrm = helpstrm
-
-    def print_help(self):
-        optparse.OptionParser.print_help(self, self._helpstrm) # optparse.OptionParser is an old-style class, damn them
-
-    def format_description(self, formatter):
-        """
-        a specialization of the optparse.OptionParser method.
-        """
-        if self._preformattedDescr:
-            return self.description
-        else:
-            return optparse.OptionParser.format_description(self, formatter)
-
 #=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-==-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 #
 #  REGISTER
@@ -3186,8 +3336,8 @@ register("pkg-config",   PkgconfigCmd, lockType=lock.LOCK_SH)
 register("uses",         UsesCmd, lockType=lock.LOCK_SH)
 register("expandbuild",  ExpandbuildCmd, lockType=lock.LOCK_SH)
 register("expandtable",  ExpandtableCmd, lockType=lock.LOCK_SH)
-register("declare",      DeclareCmd)
-register("undeclare",    UndeclareCmd)
+register("declare",      DeclareCmd, lockType=lock.LOCK_PRODUCT)
+register("undeclare",    UndeclareCmd, lockType=lock.LOCK_PRODUCT)
 register("remove",       RemoveCmd)
 register("admin",                  AdminCmd, lockType=None) # must be None, as subcommands take locks
 register("admin buildCache",       AdminBuildCacheCmd)
@@ -3198,11 +3348,13 @@ register("admin listLocks",        AdminListLocksCmd, lockType=None)
 register("admin listCache",        AdminListCacheCmd, lockType=lock.LOCK_SH)
 register("admin info",             AdminInfoCmd, lockType=lock.LOCK_SH)
 register("admin show",             AdminShowCmd, lockType=None)
+register("admin verify",           AdminVerifyCmd, lockType=lock.LOCK_SH)
 register("distrib",         DistribCmd, lockType=None) # must be None, as subcommands take locks
+register("distrib cache",   DistribCacheCmd, lockType=None)
 register("distrib clean",   DistribCleanCmd)
 register("distrib create",  DistribCreateCmd)
 register("distrib declare", DistribDeclareCmd)
-register("distrib install", DistribInstallCmd)
+register("distrib install", DistribInstallCmd, lockType=lock.LOCK_PRODUCT)
 register("distrib list",    DistribListCmd, lockType=lock.LOCK_SH)
 register("distrib path",    DistribPathCmd)
 register("distrib tags",    DistribTagsCmd)
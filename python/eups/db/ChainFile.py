@@ -1,7 +1,7 @@
 import os
 import re
 import errno
-from eups.utils import ctimeTZ, stdwarn, getUserName
+from eups.utils import ctimeTZ, stdwarn, getUserName, AtomicFile
 
 who = getUserName(full=True)
 
@@ -144,8 +144,11 @@ class ChainFile:
             if os.path.exists(file):  os.remove(file)
             return
 
-        fd = open(file, "w")
+        with AtomicFile(file, "w") as fd:
+            self._write(fd)
 
+    def _write(self, fd):
+        """write the tag assignment data to the open file fd"""
         # Should really be "FILE = chain", but eups checks for version.  I've changed it to allow
         # chain, but let's not break backward compatibility with old eups versions
         print("""FILE = version
@@ -180,8 +183,6 @@ CHAIN = %s
 
             print("#End:", file=fd)
 
-        fd.close()
-
     REGEX_KEYVAL = re.compile(r"^(\w+)\s*=\s*(.*)", flags = re.IGNORECASE)
     REGEX_GROUPEND = re.compile(r"^(End|Group)\s*:")
 
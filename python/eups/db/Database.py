@@ -1,11 +1,15 @@
+import contextlib
+import fcntl
 import os
+import pickle
 import re
 from .VersionFile import VersionFile
 from .ChainFile import ChainFile
 import eups.tags
 from eups.Product import Product
 from eups.exceptions import UnderSpecifiedProduct, ProductNotFound, TableFileNotFound
-from eups.utils import xrange, cmp_or_key, is_string
+from eups.utils import xrange, cmp_or_key, is_string, AtomicFile, fsyncBatch, fsyncPending
+from eups import timing
 
 versionFileExt = "version"
 versionFileTmpl = "%s." + versionFileExt
@@ -13,12 +17,19 @@ versionFileRe = re.compile(r'^(\w.*)\.%s$' % versionFileExt)
 tagFileExt = "chain"
 tagFileTmpl = "%s." + tagFileExt
 tagFileRe = re.compile(r'^(\w.*)\.%s$' % tagFileExt)
+userTagIndexVersion = 1                 # the format of the files written by getUserTagAssignments
+generationFile = ".generation"          # where a database's generation is recorded
 
 try:
     _databases
 except NameError:
     _databases = {}                     # the actual Database objects, making Database(XXX) a singleton
 
+try:
+    _transactions
+except NameError:
+    _transactions = {}                  # the open transactions: dbpath -> [depth, changed]
+
 def Database(dbpath, userTagRoot=None, defStackRoot=None, owner=None):
     """Return the singleton _Database object identified by this function call's arguments
 
@@ -225,6 +236,80 @@ class _Database:
 
         return tags
 
+    def getGeneration(self):
+        """
+        return the database's generation, a number that's incremented by
+        publishGeneration() whenever a product is declared or undeclared or a
+        global tag is changed.  None is returned if it's never been published
+        """
+        try:
+            with open(os.path.join(self.dbpath, generationFile)) as fd:
+                return int(fd.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def publishGeneration(self):
+        """
+        record that the database has changed by incrementing its generation,
+        returning the new value (or None if it can't be written).  The file is
+        replaced atomically, so readers see either the old or the new generation
+        """
+        fsyncPending()                  # the changes must be on disk before we announce them
+
+        try:
+            dirfd = os.open(self.dbpath, os.O_RDONLY)
+        except OSError:
+            return None
+
+        try:
+            # processes changing different products (see lock.lockProduct) mustn't publish the same value
+            fcntl.flock(dirfd, fcntl.LOCK_EX)
+
+            generation = (self.getGeneration() or 0) + 1
+            with AtomicFile(os.path.join(self.dbpath, generationFile), "w") as fd:
+                print(generation, file=fd)
+        except (IOError, OSError):
+            return None
+        finally:
+            os.close(dirfd)             # releasing the lock
+
+        return generation
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        A context manager that batches changes to the database: the generation
+        isn't published until the outermost transaction on this database ends,
+        and then only once however many products were declared, undeclared or
+        tagged.  Changes made before an exception are kept (and published).
+        The directories written to are fsync()ed together (see utils.fsyncBatch)
+
+            with db.transaction():
+                for product in products:
+                    db.declare(product)
+        """
+        key = os.path.realpath(self.dbpath)
+        state = _transactions.setdefault(key, [0, False])
+        state[0] += 1
+        try:
+            with fsyncBatch():
+                yield self
+        finally:
+            state[0] -= 1
+            if state[0] == 0:
+                del _transactions[key]
+                if state[1]:
+                    self.publishGeneration()
+
+    def _changed(self):
+        """Publish a new generation, or note that one's needed if a transaction is open"""
+        state = _transactions.get(os.path.realpath(self.dbpath))
+        if state:
+            state[1] = True
+        else:
+            self.publishGeneration()
+
+    @timing.timed("Database.findProductNames")
     def findProductNames(self):
         """
         return a list of the names of all products declared in this database
@@ -240,6 +325,7 @@ class _Database:
         return out
 
 
+    @timing.timed("Database.findVersions")
     def findVersions(self, productName):
         """
         return a list of the versions currently declared for a given product
@@ -259,6 +345,26 @@ class _Database:
 
         return versions
 
+    @timing.timed("Database.findVersionFiles")
+    def findVersionFiles(self):
+        """
+        return a list of (productName, version, path) tuples, one for each
+        version file in this database.  This requires a single pass over the
+        database directory, and doesn't read the files.
+        """
+        out = []
+        for productName in os.listdir(self.dbpath):
+            pdir = self._productDir(productName)
+            if not os.path.isdir(pdir):
+                continue
+
+            for file in os.listdir(pdir):
+                mat = versionFileRe.match(file)
+                if mat:
+                    out.append((productName, mat.group(1), os.path.join(pdir, file)))
+
+        return out
+
     def findFlavors(self, productName, versions=None):
         """
         return a list of flavors supported for the given product.  An
@@ -287,6 +393,7 @@ class _Database:
         return out
 
 
+    @timing.timed("Database.findProducts")
     def findProducts(self, name, versions=None, flavors=None):
         """
         return a list of Products matching the given inputs
@@ -383,6 +490,90 @@ class _Database:
 
         return out
 
+    def getUserTagAssignments(self, indexFile=None):
+        """
+        return a list of tuples of the form (productName, tag, version, flavor)
+        listing all of the user tags assigned to products.  Products that aren't
+        declared in this database may be included.
+        @param indexFile   if not None, a file to save the assignments in.  As
+                             long as none of the user tag (chain) files has
+                             changed the assignments are read from this file
+                             rather than from the chain files
+        """
+        userTagDb = self._getUserTagDb()
+        if not userTagDb or not os.path.isdir(userTagDb):
+            return []
+
+        if indexFile:
+            assignments = self._readUserTagIndex(indexFile, userTagDb)
+            if assignments is not None:
+                timing.count("user tag index hits")
+                return assignments
+            timing.count("user tag index misses")
+
+        assignments = []
+        others = []                     # names in userTagDb that aren't product directories
+        mtimes = {}                     # modification times of the product directories and chain files
+        for productName in os.listdir(userTagDb):
+            pdir = os.path.join(userTagDb, productName)
+            if not os.path.isdir(pdir):
+                others.append(productName)
+                continue
+
+            mtimes[pdir] = os.stat(pdir).st_mtime
+            for file in os.listdir(pdir):
+                mat = tagFileRe.match(file)
+                if mat:
+                    file = os.path.join(pdir, file)
+                    mtimes[file] = os.stat(file).st_mtime
+
+                    tag = mat.group(1)
+                    chain = ChainFile(file, productName, tag)
+                    for flavor in chain.getFlavors():
+                        assignments.append((productName, "user:" + tag, chain.getVersion(flavor), flavor))
+
+        if indexFile:
+            if os.path.basename(indexFile) not in others:
+                others.append(os.path.basename(indexFile))
+            try:
+                with AtomicFile(indexFile, "wb") as fd:
+                    pickle.dump(dict(version=userTagIndexVersion, userTagDb=userTagDb, others=others,
+                                     mtimes=mtimes, assignments=assignments), fd, protocol=4)
+            except (IOError, OSError):
+                pass                    # it's only a cache
+
+        return assignments
+
+    def _readUserTagIndex(self, indexFile, userTagDb):
+        """
+        return the assignments saved in indexFile by getUserTagAssignments, or None
+        if it's missing or out of date
+        """
+        try:
+            with open(indexFile, "rb") as fd:
+                index = pickle.load(fd)
+
+            if index["version"] != userTagIndexVersion or index["userTagDb"] != userTagDb:
+                return None
+            #
+            # Any new entries in userTagDb may be new products' directories
+            #
+            known = set(index["others"])
+            known.update([os.path.basename(path) for path in index["mtimes"]
+                          if os.path.dirname(path) == userTagDb])
+            if not set(os.listdir(userTagDb)) <= known:
+                return None
+            #
+            # A new or deleted chain file changes its directory's modification time
+            #
+            for path, mtime in index["mtimes"].items():
+                if os.stat(path).st_mtime != mtime:
+                    return None
+        except Exception:               # missing, corrupt, or a product has been removed
+            return None
+
+        return index["assignments"]
+
     def isDeclared(self, productName, version=None, flavor=None):
         """
         return true if a product is declared.
@@ -465,11 +656,14 @@ class _Database:
             if trimDir and not os.path.exists(trimDir):
                 trimDir = None
 
-        versionFile.write(trimDir)
+        with self.transaction():
+            versionFile.write(trimDir)
+
+            # now assign any tags
+            for tag in prod.tags:
+                self.assignTag(tag, prod.name, prod.version, prod.flavor)
 
-        # now assign any tags
-        for tag in prod.tags:
-            self.assignTag(tag, prod.name, prod.version, prod.flavor)
+            self._changed()
 
     def undeclare(self, product):
         """
@@ -497,23 +691,27 @@ class _Database:
         if not os.path.exists(vfile):
             return False
 
-        versionFile = VersionFile(vfile)
-        if versionFile.hasFlavor(product.flavor):
-            # unassign tags associated with this product
-            tags = self.findTags(product.name, product.version, product.flavor)
-            for tag in tags:
-                self.unassignTag(tag, product.name, product.flavor)
+        with self.transaction():
+            versionFile = VersionFile(vfile)
+            if versionFile.hasFlavor(product.flavor):
+                # unassign tags associated with this product
+                tags = self.findTags(product.name, product.version, product.flavor)
+                for tag in tags:
+                    self.unassignTag(tag, product.name, product.flavor)
 
-        changed = versionFile.removeFlavor(product.flavor)
-        if changed:  versionFile.write()
+            changed = versionFile.removeFlavor(product.flavor)
+            if changed:  versionFile.write()
 
-        # do a little clean up: if we got rid of the version file, try
-        # deleting the directory
-        if not os.path.exists(vfile):
-            try:
-                os.rmdir(pdir)
-            except Exception:
-                pass
+            # do a little clean up: if we got rid of the version file, try
+            # deleting the directory
+            if not os.path.exists(vfile):
+                try:
+                    os.rmdir(pdir)
+                except Exception:
+                    pass
+
+            if changed:
+                self._changed()
 
         return changed
 
@@ -606,6 +804,20 @@ class _Database:
                                msg="Requested flavors not declared for %s %s"
                                    % (productName, version))
 
+        self.setTaggedVersion(tag, productName, version, flavors, writeableDB)
+
+    def setTaggedVersion(self, tag, productName, version, flavors, writeableDB=None):
+        """
+        assign a tag to the given flavors of a product, replacing any version it
+        was assigned to for those flavors.  Unlike assignTag(), the flavors are
+        assumed to have been declared.
+
+        @param tag :         the tag to assign, as a Tag
+        @param productName : the name of the product getting the tag
+        @param version :     the version to tag
+        @param flavors :     the flavors of the product to be tagged
+        @param writeableDB   database to write the tag too
+        """
         if not writeableDB and tag.isUser():
             if not self._getUserTagDb():
                 raise RuntimeError("Unable to assign user tags (user db not available)")
@@ -626,6 +838,9 @@ class _Database:
         tagFile.setVersion(version, flavors)
         tagFile.write()
 
+        if not writeableDB:
+            self._changed()
+
 
     def unassignTag(self, tag, productNames, flavors=None):
         """
@@ -678,6 +893,9 @@ class _Database:
                 tf.write()
                 unassigned = True
 
+        if unassigned and dbroot == self.dbpath:
+            self._changed()
+
         return unassigned
 
     def isNewerThan(self, timestamp, dbrootdir=None):
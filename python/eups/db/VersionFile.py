@@ -436,8 +436,11 @@ class VersionFile:
         if trimDir:
             trimDir = os.path.realpath(trimDir)
 
-        fd = open(file, "w")
+        with eups.utils.AtomicFile(file, "w") as fd:
+            self._write(fd, trimDir)
 
+    def _write(self, fd, trimDir):
+        """write the version data to the open file fd, stripping trimDir from paths"""
         print("""FILE = version
 PRODUCT = %s
 VERSION = %s
@@ -511,5 +514,3 @@ Group:
                     print("   %s = %s" % (field.upper(), value), file=fd)
 
         print("End:", file=fd)
-
-        fd.close()
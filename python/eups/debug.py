@@ -6,14 +6,15 @@ N.b. can't go in utils.py as utils is imported be eups, and we need to import eu
 import re
 import sys
 import eups.Eups
+import eups.timing
 
 def parseDebugOption(debugOpts):
     """Parse the options passed on the command line as --debug=..."""
-    allowedDebugOptions = ["", "debug", "none", "profile([filename])", "raise"]
+    allowedDebugOptions = ["", "debug", "none", "profile([filename])", "raise", "timing([filename])"]
 
     debugOptions = re.split("[:,]", debugOpts)
     for do in debugOptions:
-        if not do in allowedDebugOptions and not re.search(r"^profile($|\[)", do):
+        if not do in allowedDebugOptions and not re.search(r"^(profile|timing)($|\[)", do):
             print("Unknown debug option: %s; exiting (valid options are: %s)" % \
                 (do, ", ".join([x for x in allowedDebugOptions if x])), file=sys.stderr)
             sys.exit(1)
@@ -27,3 +28,8 @@ def parseDebugOption(debugOpts):
             eups.Eups.profile = mat.group(1)
             if not eups.Eups.profile:
                 eups.Eups.profile = "eups.prof"
+
+    for o in debugOptions:
+        mat = re.search(r"^timing(?:\[([^]]*)])?$", o)
+        if mat:
+            eups.timing.enable(mat.group(1))
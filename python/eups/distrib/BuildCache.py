@@ -0,0 +1,220 @@
+"""
+the BuildCache class -- a local cache of products built from source by
+"eups distrib install", allowing them to be restored rather than rebuilt.
+"""
+import sys
+import os
+import re
+import json
+import time
+import hashlib
+import tarfile
+
+import eups.hooks as hooks
+from eups.utils import AtomicFile
+
+class BuildCache:
+    """
+    A size-bounded cache of installed product trees, keyed by everything
+    that determines the result of a build: the product's name, version and
+    flavor, the directory that it's installed into, the contents of its
+    source package, and the versions of the products that were setup to
+    build it.
+
+    Each entry is stored as a gzipped tarball, <key>.tar.gz, with a
+    description of the product in <key>.json; the latter's modification time
+    records when the entry was last used, and the least recently used
+    entries are evicted when the cache grows beyond its maximum size.
+
+    The cache is enabled by setting hooks.config.distrib["eupspkg"]["buildCache"]
+    to a directory (or with the buildCache distrib option).
+    """
+
+    def __init__(self, cacheDir, maxSize=None, verbosity=0, log=sys.stderr):
+        """
+        @param cacheDir    the directory holding the cache
+        @param maxSize     the maximum size of the cache, in bytes; may be
+                             a string with a suffix k, M, G, or T.  If None,
+                             the cache is unbounded
+        """
+        self.cacheDir = cacheDir
+        self.maxSize = parseSize(maxSize)
+        self.verbose = verbosity
+        self.log = log
+
+    @staticmethod
+    def fromConfig(options=None, verbosity=0, log=sys.stderr):
+        """return the BuildCache configured by options (a dictionary of
+        distrib options) or hooks.config.distrib["eupspkg"], or None
+        if caching isn't enabled"""
+        config = dict(hooks.config.distrib.get("eupspkg", {}))
+        if options:
+            config.update([(k, v) for k, v in options.items() if k in ("buildCache", "buildCacheMaxSize")])
+
+        cacheDir = config.get("buildCache")
+        if not cacheDir:
+            return None
+
+        return BuildCache(os.path.expanduser(cacheDir), config.get("buildCacheMaxSize"), verbosity, log)
+
+    @staticmethod
+    def makeKey(product, version, flavor, installDir, source, setups):
+        """return the key identifying a build
+        @param product      the name of the product
+        @param version      the product's version
+        @param flavor       the flavor being built for
+        @param installDir   the directory that the product is installed into
+        @param source       the name of the file containing the product's
+                              source package
+        @param setups       the setup commands for the product's dependencies
+        """
+        key = hashlib.sha256()
+        for val in [product, version, flavor, installDir] + sorted(setups or []):
+            key.update(val.encode())
+            key.update(b"\0")
+
+        with open(source, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1024*1024), b""):
+                key.update(chunk)
+
+        return key.hexdigest()
+
+    def _archive(self, key):
+        return os.path.join(self.cacheDir, "%s.tar.gz" % key)
+
+    def _info(self, key):
+        return os.path.join(self.cacheDir, "%s.json" % key)
+
+    def restore(self, key, installDir):
+        """unpack the cached product with the given key into installDir,
+        returning True if it was available
+        """
+        archive = self._archive(key)
+        if not os.path.exists(archive) or not os.path.exists(self._info(key)):
+            return False
+
+        if self.verbose > 0:
+            print("Restoring %s from %s" % (installDir, archive), file=self.log)
+
+        parentDir = os.path.dirname(installDir)
+        if not os.path.isdir(parentDir):
+            os.makedirs(parentDir, exist_ok=True)
+
+        extractOptions = dict(filter="tar") if hasattr(tarfile, "tar_filter") else {}
+        try:
+            with tarfile.open(archive, "r:gz") as tf:
+                tf.extractall(parentDir, **extractOptions)
+        except (tarfile.TarError, OSError) as e:
+            print("Unable to restore %s from the build cache (%s); rebuilding" % (installDir, e),
+                  file=self.log)
+            self.remove(key)
+            return False
+
+        os.utime(self._info(key))       # mark as recently used
+        return True
+
+    def store(self, key, installDir, product, version, flavor):
+        """add the product installed in installDir to the cache"""
+        if not os.path.isdir(installDir):
+            return
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+        if self.verbose > 0:
+            print("Saving %s in the build cache" % installDir, file=self.log)
+
+        with AtomicFile(self._archive(key), "wb") as fd:
+            with tarfile.open(fileobj=fd, mode="w:gz") as tf:
+                tf.add(installDir, os.path.basename(installDir))
+
+        with AtomicFile(self._info(key), "w") as fd:
+            json.dump(dict(product=product, version=version, flavor=flavor, installDir=installDir,
+                           created=time.time()), fd)
+
+        self.evict()
+
+    def entries(self):
+        """return a list of the cache's entries as dictionaries with keys
+        key, product, version, flavor, installDir, size, and lastUsed;
+        the most recently used are first
+        """
+        out = []
+        if not os.path.isdir(self.cacheDir):
+            return out
+
+        for f in os.listdir(self.cacheDir):
+            mat = re.search(r"^([0-9a-f]+)\.json$", f)
+            if not mat:
+                continue
+            key = mat.group(1)
+            try:
+                with open(self._info(key)) as fd:
+                    entry = json.load(fd)
+                entry["key"] = key
+                entry["size"] = os.path.getsize(self._archive(key))
+                entry["lastUsed"] = os.path.getmtime(self._info(key))
+            except (OSError, ValueError):
+                continue
+            out.append(entry)
+
+        out.sort(key=lambda e: e["lastUsed"], reverse=True)
+        return out
+
+    def remove(self, key):
+        """remove an entry from the cache"""
+        for f in (self._info(key), self._archive(key)):
+            try:
+                os.unlink(f)
+            except OSError:
+                pass
+
+    def clear(self, product=None, version=None):
+        """remove all entries, or just those for the given product (and version),
+        from the cache, returning the number removed"""
+        n = 0
+        for entry in self.entries():
+            if product and entry["product"] != product:
+                continue
+            if version and entry["version"] != version:
+                continue
+            self.remove(entry["key"])
+            n += 1
+
+        return n
+
+    def evict(self, maxSize=None):
+        """remove the least recently used entries until the cache is no
+        larger than maxSize (default: the cache's maximum size) bytes,
+        returning the number removed"""
+        if maxSize is None:
+            maxSize = self.maxSize
+        else:
+            maxSize = parseSize(maxSize)
+        if maxSize is None:
+            return 0
+
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        n = 0
+        while entries and total > maxSize:
+            entry = entries.pop()
+            if self.verbose > 0:
+                print("Evicting %s %s (%s) from the build cache" % (entry["product"], entry["version"],
+                                                                     entry["flavor"]), file=self.log)
+            self.remove(entry["key"])
+            total -= entry["size"]
+            n += 1
+
+        return n
+
+def parseSize(size):
+    """return a size in bytes given an integer or a string such as "20G" """
+    if size is None or isinstance(size, int):
+        return size
+
+    mat = re.search(r"^\s*(\d+(?:\.\d*)?)\s*([kMGT]?)B?\s*$", str(size))
+    if not mat:
+        raise RuntimeError("Unable to interpret \"%s\" as a size" % size)
+
+    return int(float(mat.group(1))*1024**" kMGT".index(mat.group(2) or " "))
@@ -413,8 +413,7 @@ class Distrib:
             def getDependencies(productName, version):
                 try:
                     product = self.Eups.getProduct(productName, version)
-                    dependencies = self.Eups.getDependentProducts(product, productDictionary={},
-                                                                  topological=True)
+                    dependencies = self.Eups.getDependentProducts(product, topological=True)
                 except Exception:
                     return None
                 return dependencies
@@ -797,25 +796,27 @@ class DefaultDistrib(Distrib):
             return True
 
         #
-        # Go through that manifest copying table files into the distribution tree
+        # Go through that manifest copying table files into the distribution tree.  The tables
+        # share dependencies, so only resolve each once
         #
-        for dep in productDeps:
-            if not dep.tablefile:
-                dep.tablefile = "none"
-            if dep.tablefile == "none":
-                continue
-
-            fulltablename, tablefile_for_distrib = getTableFile(product, version)
-            if not copyTableFile(product, fulltablename, tablefile_for_distrib):
-                # Try the repository version
-                haveTable = False
-                repoVersion = hooks.config.Eups.repoVersioner(product, version)
-                if repoVersion != version:
-                    fulltablename, tablefile_for_distrib = getTableFile(product, repoVersion)
-                    if copyTableFile(product, fulltablename, tablefile_for_distrib):
-                        haveTable = True
-                if not haveTable:
-                    print("Tablefile %s doesn't exist; omitting" % (fulltablename), file=sys.stderr)
+        with self.Eups.batchedResolution():
+            for dep in productDeps:
+                if not dep.tablefile:
+                    dep.tablefile = "none"
+                if dep.tablefile == "none":
+                    continue
+
+                fulltablename, tablefile_for_distrib = getTableFile(product, version)
+                if not copyTableFile(product, fulltablename, tablefile_for_distrib):
+                    # Try the repository version
+                    haveTable = False
+                    repoVersion = hooks.config.Eups.repoVersioner(product, version)
+                    if repoVersion != version:
+                        fulltablename, tablefile_for_distrib = getTableFile(product, repoVersion)
+                        if copyTableFile(product, fulltablename, tablefile_for_distrib):
+                            haveTable = True
+                    if not haveTable:
+                        print("Tablefile %s doesn't exist; omitting" % (fulltablename), file=sys.stderr)
 
         #
         # Finally write the manifest file itself
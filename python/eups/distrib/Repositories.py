@@ -17,6 +17,8 @@ from .Distrib        import findInstallableRoot
 from .DistribFactory import DistribFactory
 from .server         import Manifest, ServerError, RemoteFileInvalid
 import eups.hooks as hooks
+from eups import lock
+from eups.db import Database
 
 class Repositories:
 
@@ -584,6 +586,17 @@ class Repositories:
     def _doInstall(self, pkgroot, prod, productRoot, instflavor, opts,
                    noclean, setups, tag):
 
+        # Other processes may be installing products into productRoot at the same time (see
+        # lock.lockProduct);  if one installed this product while we waited for its lock we're done
+        if lock.lockProduct(productRoot, prod.product) and \
+           Database(self.eups.getUpsDB(productRoot)).isDeclared(prod.product, prod.version,
+                                                               instflavor if instflavor else opts["flavor"]):
+            if self.verbose >= 0:
+                print("(installed by another process)", end=' ', file=self.log)
+            if self.eups.versions.isLoaded(productRoot):
+                self.eups.versions[productRoot].refreshFromDatabase()
+            return
+
         if prod.instDir:
             installdir = prod.instDir
             if not os.path.isabs(installdir):
@@ -3,6 +3,7 @@ the Repository class -- An interface into a distribution server for
 installing and deploying distribution packages.
 """
 import sys
+import concurrent.futures
 import eups
 from eups.tags      import Tag, TagNotRecognized
 from eups.utils     import Flavor, isDbWritable, cmp_or_key, is_string
@@ -433,6 +434,11 @@ class Repository:
                               products will not be deployed if they are
                               already deployed in any of the repositories
                               given.
+
+        If options["jobs"] is greater than one, the packages are created
+        in parallel by that many threads.  The dependencies are first found
+        as usual, and each product's manifest is written once its package
+        and those of its dependencies have been successfully created.
         """
         if not self.isWritable():
             raise RuntimeError("Unable to create packages for this repository (Choose a local repository)")
@@ -465,15 +471,38 @@ class Repository:
         man.remapEntries(mode="create", mapping=rebuildMapping)
         distrib.updateDependencies(man.getProducts(), flavor=self.flavor, mapping=rebuildInverse)
 
-        # we will always overwrite the top package
-        created = {}
-        id = distrib.createPackage(self.pkgroot, rebuildProduct, rebuildVersion, self.flavor, overwrite=True)
-        created["%s-%s" % (rebuildProduct, rebuildVersion)] = man.getDependency(rebuildProduct,
-                                                                                version=rebuildVersion,
-                                                                                flavor=self.flavor)
-
-        if not nodepend:
-            self._recursiveCreate(distrib, man, created, True, repositories, mapping=rebuildMapping)
+        jobs = int((opts or {}).get("jobs", 1))
+        executor = None
+        if jobs > 1:
+            self.eups.preload()         # the threads share self.eups
+            executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        pending = []                    # (dependency, Future for distId, manifest) awaiting completion
+        try:
+            # we will always overwrite the top package
+            created = {}
+            id = self._createPackage(distrib, executor, rebuildProduct, rebuildVersion, overwrite=True)
+            created["%s-%s" % (rebuildProduct, rebuildVersion)] = man.getDependency(rebuildProduct,
+                                                                                    version=rebuildVersion,
+                                                                                    flavor=self.flavor)
+
+            if not nodepend:
+                self._recursiveCreate(distrib, man, created, True, repositories, mapping=rebuildMapping,
+                                      executor=executor, pending=pending)
+
+            if executor is not None:
+                # pending is in dependency order, so a product's dependencies' distIds are set
+                # before we write its manifest
+                for dp, future, depman in pending:
+                    dp.distId = future.result()
+                    distrib.writeManifest(self.pkgroot, depman.getProducts(), dp.product, dp.version,
+                                          flavor=self.flavor, force=self.eups.force)
+                id = id.result()
+        finally:
+            if executor is not None:
+                # n.b. shutdown(cancel_futures=True) needs python 3.9
+                for dp, future, depman in pending:
+                    future.cancel()
+                executor.shutdown()
 
         # update the manifest record for the requested product
         dp = man.getDependency(rebuildProduct, rebuildVersion)
@@ -513,7 +542,23 @@ class Repository:
         distrib.writeManifest(self.pkgroot, man.getProducts(), packageName, packageVersion,
                               flavor=self.flavor, force=self.eups.force)
 
-    def _recursiveCreate(self, distrib, manifest, created=None, recurse=True, repos=None, mapping=Mapping()):
+    def _createPackage(self, distrib, executor, product, version, overwrite=False):
+        """create a package with distrib, returning its distID.  If executor
+        isn't None, the package is created asynchronously and a Future
+        for the distID is returned
+        """
+        if executor is None:
+            return distrib.createPackage(self.pkgroot, product, version, self.flavor, overwrite=overwrite)
+
+        return executor.submit(distrib.createPackage, self.pkgroot, product, version, self.flavor,
+                               overwrite=overwrite)
+
+    def _recursiveCreate(self, distrib, manifest, created=None, recurse=True, repos=None, mapping=Mapping(),
+                         executor=None, pending=None):
+        """create packages for the products in manifest that aren't already available.  If
+        executor is provided, the packages are created asynchronously, and rather than
+        writing the products' manifests we append (dependency, Future, manifest) to pending
+        """
         if created is None:
             created = {}
 
@@ -573,15 +618,20 @@ class Repository:
                 raise RuntimeError("Creating manifest for %s:%s, dependency of %s %s: %s" %
                                    (dp.product, dp.version, manifest.product, manifest.version, e))
 
-            id = distrib.createPackage(self.pkgroot, dp.product, dp.version, self.flavor)
+            id = self._createPackage(distrib, executor, dp.product, dp.version)
             created[pver] = dp
-            dp.distId = id
+            if executor is None:
+                dp.distId = id
 
             if recurse:
-                self._recursiveCreate(distrib, man, created, recurse, repos, mapping=mapping)
+                self._recursiveCreate(distrib, man, created, recurse, repos, mapping=mapping,
+                                      executor=executor, pending=pending)
 
-            distrib.writeManifest(self.pkgroot, man.getProducts(), dp.product, dp.version,
-                                  flavor=self.flavor, force=self.eups.force)
+            if executor is None:
+                distrib.writeManifest(self.pkgroot, man.getProducts(), dp.product, dp.version,
+                                      flavor=self.flavor, force=self.eups.force)
+            else:
+                pending.append((dp, id, man))
 
     def _availableAtLocation(self, dp):
         distrib = self.distFactory.createDistrib(dp.distId, dp.flavor, None,
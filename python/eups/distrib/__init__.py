@@ -31,3 +31,4 @@ from .Repositories import Repositories
 from .Repository import Repository
 from .Distrib import Distrib, DefaultDistrib, findInstallableRoot
 from .DistribFactory import DistribFactory
+from .BuildCache import BuildCache
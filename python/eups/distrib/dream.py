@@ -60,7 +60,7 @@ class DreamServer(DistribServer):
             raise RuntimeError("Unspecified version for %s" % product)
 
         tablefile = self.getTableFile(product, version, flavor)
-        table = Table(tablefile)
+        table = Table(tablefile, eupsenv=self.Eups)
         deps = table.dependencies(self.Eups, recursive=True)
         deps.reverse()
 
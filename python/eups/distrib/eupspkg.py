@@ -673,6 +673,8 @@ r"""
 import sys, os, shutil, tempfile, shlex, stat
 from . import Distrib as eupsDistrib
 from . import server as eupsServer
+from .BuildCache import BuildCache
+from eups import timing
 
 issued_sconsflags_warning = False
 
@@ -680,6 +682,10 @@ class Distrib(eupsDistrib.DefaultDistrib):
     """A class to implement product distribution based on packages
     ("EupsPkg packages") constructed by builder scripts implementing
     verbs not unlike RPM's %xxxx macros.
+
+    If a build cache is configured (see BuildCache), successfully installed
+    products are saved in it, and later installs of the same package built
+    against the same dependencies are restored from it rather than rebuilt.
     """
 
     NAME = "eupspkg"
@@ -701,7 +707,8 @@ class Distrib(eupsDistrib.DefaultDistrib):
 
         # Prepare the string with all unrecognized options, to be passed to eupspkg on the command line
         # FIXME: This is not the right way to do it. -S options should be preserved in a separate dict()
-        knownopts = set(['config', 'nobuild', 'noclean', 'noaction', 'exact', 'allowIncomplete', 'buildDir', 'noeups', 'installCurrent']);
+        knownopts = set(['config', 'nobuild', 'noclean', 'noaction', 'exact', 'allowIncomplete', 'buildDir', 'noeups', 'installCurrent',
+                         'buildCache', 'buildCacheMaxSize']);
         self.qopts = " ".join( "%s=%s" % (k.upper(), shlex.quote(str(v))) for k, v in self.options.items() if k not in knownopts )
 
     @staticmethod
@@ -928,6 +935,20 @@ TAGLIST_DIR = tags
             print("skipping [noaction]", file=self.log)
             return
 
+        # Have we already built this package, against the same dependencies?
+        prodDir = os.path.join(self.Eups.path[0], self.Eups.flavor, product, version) # where build.sh installs it
+        buildCache = None
+        if not self.nobuild:
+            buildCache = BuildCache.fromConfig(self.options, self.verbose, self.log)
+        if buildCache is not None:
+            cacheKey = buildCache.makeKey(product, version, self.Eups.flavor, prodDir, tfname, setups)
+            if buildCache.restore(cacheKey, prodDir):
+                timing.count("build cache hits")
+                if self.Eups.verbose >= 1:
+                    print("[cached]", end=' ', file=self.log); self.log.flush()
+                return
+            timing.count("build cache misses")
+
         # Make sure the buildDir is empty (to avoid interference from failed builds)
         shutil.rmtree(buildDir)
         os.mkdir(buildDir)
@@ -1046,7 +1067,7 @@ setup --type=build -k -r .
                 eupsServer.system(cmd, self.Eups.noaction)
 
                 # Copy the build log into the product install directory. It's useful to keep around.
-                installDirUps = os.path.join(self.Eups.path[0], self.Eups.flavor, product, version, 'ups')
+                installDirUps = os.path.join(prodDir, 'ups')
                 if os.path.isdir(installDirUps):
                     shutil.copy2(logfile, installDirUps)
                     if self.verbose > 0:
@@ -1063,6 +1084,12 @@ setup --type=build -k -r .
                         self.log.write("             %s" % line)
                     fp.close()
 
+                if buildCache is not None:
+                    try:
+                        buildCache.store(cacheKey, prodDir, product, version, self.Eups.flavor)
+                    except Exception as e:
+                        print("Unable to save %s in the build cache: %s" % (prodDir, e), file=self.log)
+
         except OSError as e:
             if self.verbose >= 0 and os.path.exists(logfile):
                 try:
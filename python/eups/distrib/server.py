@@ -14,13 +14,16 @@ import tempfile
 from pathlib import Path
 import posixpath
 import concurrent.futures
-from urllib.request import urlopen
+import hashlib
+from http.client import HTTPException
+from urllib.request import urlopen, Request
 from urllib.error import HTTPError, URLError
 import eups
 import eups.hooks as hooks
 import eups.utils as utils
+from eups import timing
 
-from eups.exceptions import EupsException
+from eups.exceptions import EupsException, CustomizationError
 
 serverConfigFilename = "config.txt"
 BASH = "/bin/bash"    # see end of this module where we look for bash
@@ -347,6 +350,34 @@ class DistribServer:
 #        if filename is None:  filename = self.makeTempFile(product + "_path_")
 #        return self.cacheFile(filename, src, noaction)
 
+    def openFileForProduct(self, path, product, version, flavor, ftype=None):
+        """return an open (binary) stream for a file with a given path on the
+        server associated with a given product, allowing it to be read
+        without first copying it to a local file.
+
+        This implementation simply looks for the path directly below the
+        base URL, ignoring the product name and version inputs.
+
+        @param path        the path on the remote server to the desired file
+        @param product     the desired product name
+        @param version     the desired version of the product
+        @param flavor      the flavor of the target platform
+        @param ftype       a type of file to assume; if not provided, the
+                              extension will be used to determine the type
+        @exception StreamNotSupported  if the file's transport mechanism
+                                         doesn't support streaming
+        """
+        return self.openFile("%s/%s" % (self.base, path))
+
+    def openFile(self, source):
+        """return an open (binary) stream for a remote file
+        @param source      the name of the remote file to read
+        """
+        if self._isCached(source):
+            return open(self._fileCache[source], "rb")
+
+        return makeTransporter(source, self.verbose-1, self.log).openStream()
+
     def listFiles(self, path, flavor=None, tag=None, noaction=False):
         """return a list of filenames under a server directory referred to
         by path.  The actual directory on the server may be different, depending
@@ -366,13 +397,17 @@ class DistribServer:
     def makeTempFile(self, prefix):
         return makeTempFile(prefix)
 
+    def _isCached(self, source):
+        # n.b. the copy may have been removed, e.g. when a build directory was cleaned
+        return not self.NOCACHE and source in self._fileCache and os.path.exists(self._fileCache[source])
+
     def cacheFile(self, filename, source, noaction=False):
         """cache a copy of a file to a file with the given name
         @param filename    the name of the file to write to
         @param source      the name of the remote file to obtain a copy of
         @param noaction    if True, simulate the retrieval
         """
-        if not self.NOCACHE and source in self._fileCache:
+        if self._isCached(source):
             if self.verbose > 1:
                 msg = "%s has already been retrieved" % source
                 if self.verbose > 2:
@@ -637,8 +672,48 @@ class ConfigurableDistribServer(DistribServer):
                                                flavor, None, filename,
                                                noaction)
 
+    def openFileForProduct(self, path, product, version, flavor, ftype=None):
+        """return an open (binary) stream for a file with a given path on the
+        server associated with a given product.  The URL is found in the same
+        way as getFileForProduct()
+
+        @param path        the path on the remote server to the desired file
+        @param product     the desired product name
+        @param version     the desired version of the product
+        @param flavor      the flavor of the target platform
+        @param ftype       a type of file to assume; if not provided, the
+                              extension will be used to determine the type
+        @exception StreamNotSupported  if the file's transport mechanism
+                                         doesn't support streaming
+        """
+        values = { "path": path,
+                   "product": product,
+                   "version": version,
+                   "flavor": flavor,
+                   "base": self.base }
+
+        oftype = ftype
+        if ftype is None:
+            ftype = os.path.splitext(path)[1]
+            if ftype.startswith("."):  ftype = ftype[1:]
+
+        stream = self._fileViaTmpl8s(ftype, values, None, retrieve=self.openFile)
+        if stream:
+            return stream
+
+        if not oftype and ftype != 'PRODUCT_FILE':
+            return self.openFileForProduct(path, product, version, flavor, 'PRODUCT_FILE')
+
+        return DistribServer.openFileForProduct(self, path, product, version, flavor)
+
     def _fileViaTmpl8s(self, ftype, data, filename, noaction=False,
-                       ignoreMissingData=True):
+                       ignoreMissingData=True, retrieve=None):
+        """retrieve a file using the URL templates configured for ftype,
+        returning the value of retrieve(url) (by default, a call to cacheFile()
+        which copies it to filename), or False if it can't be found"""
+        if retrieve is None:
+            retrieve = lambda src: self.cacheFile(filename, src, noaction)
+
         ftype = ftype.upper()
         if len(ftype) == 0 or not self.getConfigProperty("%s_URL" % ftype):
             return False
@@ -687,10 +762,12 @@ class ConfigurableDistribServer(DistribServer):
                 print("Looking on server for %s %s" % (ftype if ftype else "directory listing", src),
                       file=self.log)
             try:
-                return self.cacheFile(filename, src, noaction)
+                return retrieve(src)
             except RemoteFileNotFound as e:
                 if self.verbose > 1:
                     print("Not found; checking next alternative", file=self.log)
+            except StreamNotSupported:
+                raise
             except Exception as e:
                 if self.verbose >= 0:
                     print("Warning: trouble retrieving", \
@@ -702,7 +779,7 @@ class ConfigurableDistribServer(DistribServer):
             src = self.getConfigProperty("%s_URL" % ftype) % data
             if self.verbose > 1:
                 print("Failed to find %s in %s; looking on server" % (src, locations), file=self.log)
-            return self.cacheFile(filename, src, noaction)
+            return retrieve(src)
         except RemoteFileNotFound as e:
             if self.verbose > 1:
                 print("no appropriate template found for %s, checking path directly" % ftype, file=self.log)
@@ -936,6 +1013,15 @@ class RemoteFileInvalid(TransporterError):
         """
         TransporterError.__init__(self, message, exc)
 
+class StreamNotSupported(TransporterError):
+    """an error indicating that a transport mechanism cannot stream a file"""
+    def __init__(self, message, exc=None):
+        """create a server error exception
+        @param message    the reason for the error
+        @param exc        a caught exception representing underlying symptom
+        """
+        TransporterError.__init__(self, message, exc)
+
 class ServerNotResponding(TransporterError):
     """an error indicating a problem connecting to the server"""
     def __init__(self, message, exc=None):
@@ -984,6 +1070,13 @@ class Transporter:
         """
         self.unimplemented("listDir")
 
+    def openStream(self):
+        """return an open binary stream from which the source may be read.
+        This implementation raises StreamNotSupported, as not all transport
+        mechanisms support streaming.
+        """
+        raise StreamNotSupported("%s does not support streaming %s" % (type(self).__name__, self.loc))
+
     def unimplemented(self, name):
         raise Exception("%s: unimplemented (abstract) method" % name)
 
@@ -1000,8 +1093,31 @@ class WebTransporter(Transporter):
                bool(re.search(r'^https://', source)) or \
                bool(re.search(r'^ftp://', source))
 
+    # suffix added to the name of a file while it is being downloaded; the
+    # state needed to resume it is kept alongside in PARTIAL_SUFFIX + ".json"
+    PARTIAL_SUFFIX = ".partial"
+
     def cacheToFile(self, filename, noaction=False):
         """cache the source to a local file
+
+        The data are first written to filename + PARTIAL_SUFFIX, and only
+        renamed to filename once they are complete (and, if requested,
+        their checksum has been verified).  If the download is interrupted
+        the partial file is kept, and the next attempt (either a retry within
+        this call or a later call with the same filename) asks the server for
+        just the missing bytes using an HTTP Range request.
+
+        The behaviour is controlled by hooks.config.distrib["transport"]:
+           resume          if False, always restart downloads from scratch
+           retries         the number of times to resume an interrupted
+                             download before giving up
+           checksumSuffix  if set (e.g. ".sha256"), look for a file
+                             with the source's name plus this suffix on the
+                             server and verify the download against the
+                             checksum it contains.  The suffix names the
+                             hashlib algorithm to use;  a CustomizationError
+                             is raised before anything is fetched if it doesn't.
+
         @param filename      the name of the file to cache to
         @param noaction      if True, simulate the result (default: False)
         """
@@ -1012,21 +1128,147 @@ class WebTransporter(Transporter):
             if self.verbose > 0:
                 Path(filename).touch()
                 print("Simulated web retrieval from", self.loc, file=self.log)
-        else:
-            out = None
+            return
+
+        retries = getTransportOption("retries")
+        expected = self._getExpectedChecksum()
+        for i in range(retries + 1):
             try:
-                with urlopen(self.loc) as url, open(filename, 'wb') as out:
+                with timing.span("download", url=self.loc):
+                    self._download(filename, expected)
+                timing.count("files downloaded")
+                return
+            except ServerNotResponding as e:
+                if i == retries:
+                    raise
+                if self.verbose >= 0:
+                    print("Download of %s interrupted (%s); resuming" % (self.loc, e), file=self.log)
+            except KeyboardInterrupt:
+                raise EupsException("^C")
+
+    def _download(self, filename, expected=None):
+        """Download self.loc to filename, resuming a previous partial download
+        if one is available
+
+        @param filename      the name of the file to cache to
+        @param expected      (algorithm, hexdigest) to check the file against,
+                               or None
+        """
+        partialFile = filename + self.PARTIAL_SUFFIX
+        stateFile = partialFile + ".json"
+
+        resume = getTransportOption("resume") and re.search(r"^https?://", self.loc)
+        state = self._readPartialState(stateFile) if resume else None
+        if state and state.get("url") == self.loc and os.path.exists(partialFile):
+            offset = os.path.getsize(partialFile)
+        else:
+            offset = 0
+            state = None
+            for f in (partialFile, stateFile):
+                if os.path.exists(f):
+                    os.unlink(f)
+
+        headers = {}
+        if offset > 0:
+            headers["Range"] = "bytes=%d-" % offset
+            validator = state.get("etag") or state.get("lastModified")
+            if validator:
+                headers["If-Range"] = validator
+
+        checksum = hashlib.new(expected[0]) if expected else None
+        try:
+            with urlopen(Request(self.loc, headers=headers)) as url:
+                if offset > 0 and url.getcode() == 206:
+                    if self.verbose > 0:
+                        print("Resuming download of %s at byte %d" % (self.loc, offset), file=self.log)
+                    mode = "ab"
+                    if checksum is not None:
+                        with open(partialFile, "rb") as fd:
+                            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                                checksum.update(chunk)
+                else:                   # the server sent the whole file
+                    offset = 0
+                    mode = "wb"
+
+                size = url.headers.get("Content-Length")
+                size = offset + int(size) if size else None
+
+                if resume:
+                    with open(stateFile, "w") as fd:
+                        json.dump(dict(url=self.loc, size=size,
+                                       etag=url.headers.get("ETag"),
+                                       lastModified=url.headers.get("Last-Modified")), fd)
+
+                with open(partialFile, mode) as out:
                     while True:
                         chunk = url.read(1024 * 1024)   # read 1MB at a time for small-memory machines
                         if not chunk:
                             break
                         out.write(chunk)
-            except HTTPError as e:
-                raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, e.reason))
-            except URLError as e:
-                raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e.reason))
-            except KeyboardInterrupt:
-                raise EupsException("^C")
+                        if checksum is not None:
+                            checksum.update(chunk)
+        except HTTPError as e:
+            if e.code == 416 and offset > 0:  # our partial file is bad; start again
+                os.unlink(partialFile)
+                raise ServerNotResponding("Unable to resume download of %s" % self.loc, e)
+            raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, e.reason))
+        except URLError as e:
+            raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e.reason))
+        except (HTTPException, ConnectionError, TimeoutError) as e:
+            raise ServerNotResponding("Lost connection to URL %s" % self.loc, e)
+
+        received = os.path.getsize(partialFile)
+        if size is not None and received < size:
+            raise ServerNotResponding("Download of %s is incomplete (%d of %d bytes)" %
+                                      (self.loc, received, size))
+
+        if checksum is not None and checksum.hexdigest() != expected[1]:
+            for f in (partialFile, stateFile):
+                if os.path.exists(f):
+                    os.unlink(f)
+            raise RemoteFileInvalid("Checksum mismatch for %s: expected %s %s, saw %s" %
+                                    (self.loc, expected[0], expected[1], checksum.hexdigest()))
+
+        os.rename(partialFile, filename)
+        if os.path.exists(stateFile):
+            os.unlink(stateFile)
+
+    def openStream(self):
+        """return an open binary stream from which the source may be read"""
+        try:
+            return urlopen(self.loc)
+        except HTTPError as e:
+            raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, e.reason))
+        except URLError as e:
+            raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e.reason))
+
+    def _readPartialState(self, stateFile):
+        """Return the state saved for a partial download, or None"""
+        try:
+            with open(stateFile) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def _getExpectedChecksum(self):
+        """Return (algorithm, hexdigest) for self.loc as published by the server
+        next to the file, or None if we aren't checking (or none is available)"""
+        suffix = getTransportOption("checksumSuffix")
+        if not suffix:
+            return None
+
+        algorithm = suffix.lstrip(".")
+        try:
+            with urlopen(self.loc + suffix) as url:
+                digest = url.read().decode().split()
+        except (HTTPError, URLError):
+            if self.verbose > 1:
+                print("No %s checksum available for %s" % (algorithm, self.loc), file=self.log)
+            return None
+
+        if not digest:
+            return None
+        return (algorithm, digest[0].lower())
 
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
@@ -1271,6 +1513,13 @@ class LocalTransporter(Transporter):
                     print("%s does not exist" % self.loc, file=self.log)
                 return []
 
+    def openStream(self):
+        """return an open binary stream from which the source may be read"""
+        if not os.path.exists(self.loc):
+            raise RemoteFileNotFound("%s: file not found" % self.loc)
+
+        return open(self.loc, "rb")
+
 class DreamTransporter(Transporter):
     """This transporter serves to set up a DreamServer at the
     nominated path on the local system.
@@ -1336,6 +1585,19 @@ defaultTransporterFactory.register(SshTransporter)
 defaultTransporterFactory.register(WebTransporter)
 defaultTransporterFactory.register(DreamTransporter)
 
+def getTransportOption(name):
+    """Return the value of a transport option, set via hooks.config.distrib["transport"]"""
+    defaults = dict(resume=True, retries=3, checksumSuffix=None)
+
+    value = hooks.config.distrib.get("transport", {}).get(name, defaults[name])
+    if name == "checksumSuffix" and value:
+        algorithm = value.lstrip(".")
+        if algorithm not in hashlib.algorithms_available or hashlib.new(algorithm).digest_size == 0:
+            raise CustomizationError("hooks.config.distrib[\"transport\"][\"checksumSuffix\"] must name a "
+                                     "hashlib algorithm (e.g. \".sha256\"), not \"%s\"" % value)
+
+    return value
+
 def defaultMakeTransporter(source, verbosity, log):
     """create a Transporter instance for a given source.
     If the source is not recognized, an exception is raised.
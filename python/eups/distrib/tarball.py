@@ -5,6 +5,16 @@
 # product from a package: : a specialization for binary tar-balls
 #
 import sys, os, re
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import lzma
+import shutil
+import subprocess
+import tarfile
+import zlib
+from http.client import HTTPException
 from . import Distrib as eupsDistrib
 from . import server as eupsServer
 
@@ -25,6 +35,16 @@ class Distrib(eupsDistrib.DefaultDistrib):
        buildDir         a directory to use to build a package during install.
                           If this is a relative path, the full path will be
                           relative to the product root for the installation.
+       stream           if true, unpack tarballs as they are read from the
+                          server rather than first copying them into buildDir
+                          (if the server's transport mechanism supports it)
+       compression      how to compress tarballs written by createPackage;
+                          one of the keys of COMPRESSORS (default: gzip).
+                          "pgzip" writes gzip files, but compresses blocks
+                          of the tarball in parallel.
+       compressionLevel the compression level (or xz preset) to use
+       compressionJobs  the number of processes "pgzip" should use
+                          (default: the number of CPUs)
     """
 
     NAME = "tarball"
@@ -34,6 +54,19 @@ class Distrib(eupsDistrib.DefaultDistrib):
     TARBALL_URL =      r"%(base)s/%(path)s"
     DIST_URL =         r"%(base)s/%(path)s"
 
+    # The supported compression formats, giving the suffix of the tarballs
+    # that they generate and tar's flag to read them
+    COMPRESSORS = {
+        "gzip" : (".tar.gz", "z"),
+        "pgzip" : (".tar.gz", "z"),
+        "bzip2" : (".tar.bz2", "j"),
+        "xz" : (".tar.xz", "J"),
+    }
+    PGZIP_BLOCKSIZE = 8*1024*1024       # size of the blocks of the tarball compressed in parallel
+
+    # The exceptions raised by unpackStream when a stream is broken or truncated
+    STREAM_ERRORS = (tarfile.TarError, OSError, EOFError, zlib.error, lzma.LZMAError, HTTPException)
+
     def __init__(self, Eups, distServ, flavor, tag="current", options=None,
                  verbosity=0, log=sys.stderr):
         eupsDistrib.Distrib.__init__(self, Eups, distServ, flavor, tag, options,
@@ -46,13 +79,14 @@ class Distrib(eupsDistrib.DefaultDistrib):
         """Return a valid package location if and only if we recognize the
         given distribution identifier
 
-        This implementation return a location if it ends with ".tar.gz"
+        This implementation return a location if it ends with the suffix
+        of one of the supported compression formats (e.g. ".tar.gz")
         """
         if distID:
-            suffix = ".tar.gz"
             distID = distID.strip()
-            if distID.endswith(suffix):
-                return distID
+            for suffix, flag in Distrib.COMPRESSORS.values():
+                if distID.endswith(suffix):
+                    return distID
 
         return None
 
@@ -125,10 +159,14 @@ DIST_URL = %s
                 print("Unable to write %s; installation will be unable to check paths: %s" % (pwdFile, e), file=self.log)
 
         fullTarball = os.path.join(serverDir, tarball)
+        compression = self.getCompression()
         try:
-            eupsServer.system('(cd "%s" && tar -cf - "%s") | gzip > "%s"' %
-                              (baseDir, productDir, fullTarball),
-                              self.Eups.noaction, self.verbose-1, self.log)
+            if compression == "gzip":
+                eupsServer.system('(cd "%s" && tar -cf - "%s") | gzip > "%s"' %
+                                  (baseDir, productDir, fullTarball),
+                                  self.Eups.noaction, self.verbose-1, self.log)
+            else:
+                self.writeCompressedTarball(baseDir, productDir, fullTarball, compression)
         except Exception as e:
             try:
                 os.unlink(pwdFile)
@@ -151,6 +189,58 @@ DIST_URL = %s
 
         return tarball
 
+    def getCompression(self):
+        """Return the name of the compression format to use for new tarballs"""
+        compression = self.getOption("compression", "gzip")
+        if compression not in self.COMPRESSORS:
+            raise RuntimeError("Unknown tarball compression %s; please choose one of %s" %
+                               (compression, ", ".join(sorted(self.COMPRESSORS))))
+        return compression
+
+    def writeCompressedTarball(self, baseDir, productDir, fullTarball, compression):
+        """Write a tarball of baseDir/productDir, compressing it in this process
+        @param baseDir        the directory to run tar in
+        @param productDir     the directory (relative to baseDir) to archive
+        @param fullTarball    the name of the file to write
+        @param compression    the name of the compression format to use
+        """
+        if self.Eups.noaction or self.verbose > 1:
+            print('(cd "%s" && tar -cf - "%s") | %s > "%s"' %
+                  (baseDir, productDir, compression, fullTarball), file=self.log)
+        if self.Eups.noaction:
+            return
+
+        level = self.getOption("compressionLevel")
+        if level is not None:
+            level = int(level)
+
+        if compression == "pgzip":
+            compressor = None
+        elif compression == "bzip2":
+            compressor = bz2.BZ2Compressor(9 if level is None else level)
+        elif compression == "xz":
+            compressor = lzma.LZMACompressor(preset=level)
+        else:
+            raise RuntimeError("Unable to write a %s tarball in python" % compression)
+
+        tar = subprocess.Popen(["tar", "-cf", "-", productDir], cwd=baseDir, stdout=subprocess.PIPE)
+        try:
+            with open(fullTarball, "wb") as fd:
+                if compressor is None:
+                    jobs = int(self.getOption("compressionJobs", 0)) or None
+                    _parallelGzip(tar.stdout, fd, 6 if level is None else level, jobs,
+                                  self.PGZIP_BLOCKSIZE)
+                else:
+                    for chunk in iter(lambda: tar.stdout.read(1024*1024), b""):
+                        fd.write(compressor.compress(chunk))
+                    fd.write(compressor.flush())
+        finally:
+            tar.stdout.close()
+            status = tar.wait()
+
+        if status != 0:
+            raise OSError("tar -cf - %s exited with code %d" % (productDir, status))
+
     def packageCreated(self, serverDir, product, version, flavor=None):
         """return True if a distribution package for a given product has
         apparently been deployed into the given server directory.
@@ -195,17 +285,6 @@ DIST_URL = %s
         if self.verbose > 0:
             print("Building in", buildDir, file=self.log)
 
-        # we will download the tarball to the build directory
-        tfile = "%s/%s" % (buildDir, tarball)
-
-        if not self.Eups.noaction:
-            tfile = self.distServer.getFileForProduct(location, product,
-                                                      version, self.Eups.flavor,
-                                                      ftype="dist",
-                                                      filename=tfile)
-            if not os.access(tfile, os.R_OK):
-                raise RuntimeError("Unable to read %s" % (tfile))
-
         unpackDir = os.path.join(productRoot, self.Eups.flavor)
         if installDir and installDir != "none":
             try:
@@ -221,11 +300,44 @@ DIST_URL = %s
         if self.verbose > 0:
             print("installing %s into %s" % (tarball, unpackDir), file=self.log)
 
-        try:
-            eupsServer.system('cd "%s" && tar -zxmf "%s"' % (unpackDir, tfile),
-                              self.Eups.noaction, verbosity=self.verbose-1)
-        except Exception as e:
-            raise RuntimeError("Failed to read '%s': %s" % (tfile, e))
+        streamed = False
+        if self.getOption("stream", False) in (True, "True", "true") and not self.Eups.noaction:
+            try:
+                stream = self.distServer.openFileForProduct(location, product, version,
+                                                            self.Eups.flavor, ftype="dist")
+            except eupsServer.StreamNotSupported as e:
+                if self.verbose > 0:
+                    print("%s; copying it to %s" % (e, buildDir), file=self.log)
+            else:
+                try:
+                    self.unpackStream(stream, unpackDir, gzipped=tarball.endswith(".gz"))
+                    streamed = True
+                except self.STREAM_ERRORS as e:
+                    # unpackStream removed what it had unpacked, so we can try again from a copy
+                    if self.verbose >= 0:
+                        print("Failed to read '%s' as it was streamed (%s); copying it to %s" %
+                              (tarball, e, buildDir), file=self.log)
+                finally:
+                    stream.close()
+
+        if not streamed:
+            # we will download the tarball to the build directory
+            tfile = "%s/%s" % (buildDir, tarball)
+
+            if not self.Eups.noaction:
+                tfile = self.distServer.getFileForProduct(location, product,
+                                                          version, self.Eups.flavor,
+                                                          ftype="dist",
+                                                          filename=tfile)
+                if not os.access(tfile, os.R_OK):
+                    raise RuntimeError("Unable to read %s" % (tfile))
+
+            flag = [f for suffix, f in self.COMPRESSORS.values() if tarball.endswith(suffix)][0]
+            try:
+                eupsServer.system('cd "%s" && tar -%sxmf "%s"' % (unpackDir, flag, tfile),
+                                  self.Eups.noaction, verbosity=self.verbose-1)
+            except Exception as e:
+                raise RuntimeError("Failed to read '%s': %s" % (tfile, e))
 
         if installDir and installDir == "none":
             installDir = None
@@ -253,6 +365,49 @@ DIST_URL = %s
                     print("Installing binary product %s %s into %s (was built for %s)" % (
                         product, version, installDir, originalDir), file=self.log)
 
+    def unpackStream(self, stream, unpackDir, gzipped=True):
+        """Unpack a compressed tarball as it is read from a stream, without
+        needing to seek; equivalent to "tar -xmf".  If the stream is broken or
+        truncated one of STREAM_ERRORS is raised, and the files and directories
+        that we created are removed
+        @param stream      a binary file-like object to read the tarball from
+        @param unpackDir   the directory to unpack into
+        @param gzipped     the tarball is gzipped; otherwise the compression
+                             is detected automatically
+        """
+        if hasattr(tarfile, "tar_filter"):
+            extractOptions = dict(filter="tar")
+        else:
+            extractOptions = {}
+
+        if gzipped:                     # handle multi-member files such as those written by pgzip
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+
+        created = []                    # the outermost files and directories that we created
+        try:
+            with tarfile.open(fileobj=stream, mode="r|*") as tf:
+                for member in tf:
+                    path = unpackDir
+                    for name in member.name.split("/"):
+                        path = os.path.join(path, name)
+                        if not os.path.lexists(path):
+                            created.append(path)
+                            break
+
+                    tf.extract(member, unpackDir, **extractOptions)
+                    if not member.isdir():  # don't preserve modification times ("tar -m")
+                        try:
+                            os.utime(os.path.join(unpackDir, member.name), follow_symlinks=False)
+                        except (OSError, NotImplementedError):
+                            pass
+        except BaseException:
+            for path in reversed(created):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.lexists(path):
+                    os.remove(path)
+            raise
+
     def getDistIdForPackage(self, product, version, flavor=None):
         """return the distribution ID that for a package distribution created
         by this Distrib class (via createPackage())
@@ -265,7 +420,7 @@ DIST_URL = %s
                                 be ignored by the implentation
         """
         if not flavor:  flavor = self.flavor
-        return "%s-%s@%s.tar.gz" % (product, version, flavor)
+        return "%s-%s@%s%s" % (product, version, flavor, self.COMPRESSORS[self.getCompression()][0])
 
     def writeManifest(self, *args, **kwargs):
         """We want to write flavor-specific manifest files, but without a flavor subdirectory,
@@ -304,3 +459,33 @@ DIST_URL = %s
         config["MANIFEST_URL"] = Distrib.MANIFEST_URL
         config["TARBALL_URL"] = Distrib.TARBALL_URL
         config["DIST_URL"] = Distrib.DIST_URL
+
+
+def _gzipBlock(data, level):
+    """Return data compressed as a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _parallelGzip(instream, outstream, level=6, jobs=None, blocksize=Distrib.PGZIP_BLOCKSIZE):
+    """Compress instream to outstream as a sequence of gzip members, each
+    compressed in a separate process.  The output may be read by gunzip
+    or tar -z (which concatenate the members)
+    @param instream    a binary file-like object to read from
+    @param outstream   a binary file-like object to write to
+    @param level       the compression level
+    @param jobs        the number of processes to use (default: number of CPUs)
+    @param blocksize   the number of bytes to compress in each process
+    """
+    if not jobs:
+        jobs = os.cpu_count() or 1
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        pending = collections.deque()   # futures for compressed blocks, in order
+        maxPending = 2*jobs
+        for block in iter(lambda: instream.read(blocksize), b""):
+            pending.append(executor.submit(_gzipBlock, block, level))
+            if len(pending) >= maxPending:
+                outstream.write(pending.popleft().result())
+
+        while pending:
+            outstream.write(pending.popleft().result())
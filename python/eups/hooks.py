@@ -33,7 +33,7 @@ def defineProperties(names, parentName=None):
 
 # various configuration properties settable by the user
 config = defineProperties("Eups distrib site user")
-config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize", "Eups")
+config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize deferTableLookup writeBehindCache", "Eups")
 config.Eups.setType("verbose", int)
 
 config.Eups.userTags = []
@@ -70,18 +70,67 @@ config.Eups.defaultProduct = {"name" : "implicitProducts", "version" : None, "ta
 
 config.Eups.colorize = False
 #
+# Only check whether a product's default table file (ups/<product>.table) exists when its table is
+# needed, rather than whenever a description of the product is created.  This saves many filesystem
+# operations (especially on NFS) when, e.g., listing products
+#
+config.Eups.deferTableLookup = False
+#
+# Don't save the product stacks' caches after each change (declare, assign a tag, ...), but only when the
+# eups command exits or Eups.flushCaches() is called;  changes that other processes make to the caches
+# in the meantime are merged with ours.  This saves rewriting a large cache many times in a multi-step
+# command, but until then other processes have to detect that the cache is out of date from the database
+#
+config.Eups.writeBehindCache = False
+#
 # Configure things that apply to the entire site
 #
-config.site = defineProperties("lockDirectoryBase", "site")
+config.site = defineProperties("lockDirectoryBase lockBackend lockTimeout snapshotReads productLocks", "site")
 
 _defaultLockDirectoryBase = "__UPS_DB__";
 config.site.lockDirectoryBase = _defaultLockDirectoryBase
+#
+# How to lock the product stacks:
+#   "directory":  create a lock directory, polling (for up to ~10s) if it's already locked.  Locks
+#                 left behind by processes that were killed must be removed with "eups admin clearLocks"
+#   "fcntl":      use flock() on a lock file;  the kernel releases the locks if the process dies
+# lockTimeout is the number of seconds that the "fcntl" backend waits for a lock (None: wait forever)
+#
+config.site.lockBackend = "directory"
+config.site.lockTimeout = 60
+#
+# If snapshotReads is True, commands that only read the stacks (e.g. setup, list, uses) don't take
+# shared locks;  instead they check the generation that writers publish whenever they change a database,
+# and read it again if it changed while they were reading.  Only enable this if all the eups installations
+# that write to your stacks publish generations
+#
+config.site.snapshotReads = False
+#
+# If productLocks is True, commands that change only a few products (declare, undeclare, distrib install)
+# lock just those products rather than the entire stack, so e.g. installs of different products can
+# proceed at the same time.  Readers don't wait for these commands, so they behave as if snapshotReads
+# were set, and the same caveat applies
+#
+config.site.productLocks = False
 
 # it is expected that different Distrib classes will have different set-able
 # properties.  The key for looking up Distrib-specific data should be the Distrib
 # name.
 config.distrib = {}
 config.distrib["builder"] = dict(variables = {})
+#
+# How files are fetched from remote servers (see server.WebTransporter.cacheToFile); shared by all Distribs.
+#   resume:          resume interrupted downloads using HTTP Range requests
+#   retries:         how many times to resume a download before giving up
+#   checksumSuffix:  if set (e.g. ".sha256"), verify downloads against the checksum in <file><checksumSuffix>
+#
+config.distrib["transport"] = dict(resume=True, retries=3, checksumSuffix=None)
+#
+# A local cache of products built by eupspkg (see distrib.BuildCache):
+#   buildCache:         the directory to keep the cache in; None disables caching
+#   buildCacheMaxSize:  the maximum size of the cache (e.g. "50G"); None means unbounded
+#
+config.distrib["eupspkg"] = dict(buildCache=None, buildCacheMaxSize=None)
 
 config.Eups.startupFileName = "startup.py"
 
@@ -1,20 +1,40 @@
+import contextlib
 import errno
+import fcntl
 import glob
 import os
 import shutil
 import sys
 import time
 import re
+import signal
+import threading
 from . import hooks
 from . import utils
+from . import timing
 
 #
 # Types of locks
 #
 LOCK_SH = 1                             # acquire a shared lock
 LOCK_EX = 2                             # acquire an exclusive lock
+LOCK_PRODUCT = 3                        # acquire a shared lock, and exclusive locks on products (see lockProduct)
 
 _lockDir = ".lockDir"                   # name of lock directory
+_lockFile = ".lockFile"                 # name of lock file used by the "fcntl" backend
+_updateSuffix = ".update"               # suffix of the locks taken by updatingStack()
+
+_productLocking = None                  # state of the LOCK_PRODUCT locks that we hold (see takeLocks)
+_exclusiveLocks = []                    # (path, locks) for the LOCK_EX locks that we hold (see takeLocks)
+
+def _useFcntl():
+    """Return True iff we should use the "fcntl" lock backend"""
+    backend = hooks.config.site.lockBackend
+    if backend not in ("directory", "fcntl"):
+        raise RuntimeError("hooks.config.site.lockBackend must be \"directory\" or \"fcntl\", not \"%s\"" %
+                           backend)
+
+    return backend == "fcntl"
 
 def getLockPath(dirName, create=False):
     """Get the directory path that should prefix the """
@@ -42,133 +62,240 @@ def getLockPath(dirName, create=False):
 
         return dirName
 
+@timing.timed("lock.takeLocks")
 def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
-    locks = []
+    """
+    Take locks of type lockType on the product stacks in path, returning a list of
+    the locks to pass to giveLocks()
+
+    LOCK_PRODUCT is for commands that change only a few products' entries in the
+    databases:  we take shared locks on the stacks, and the command takes
+    exclusive locks on the products that it changes by calling lockProduct().
+    Unless hooks.config.site.productLocks is True it's the same as LOCK_EX
+    """
+    global _productLocking
 
     if hooks.config.site.lockDirectoryBase is None:
         if verbose > 2:
             print("Locking is disabled", file=utils.stdinfo)
         nolocks = True
 
-    if lockType is not None and not nolocks:
+    if lockType == LOCK_SH and hooks.config.site.snapshotReads:
+        if verbose > 2:
+            print("Not taking shared locks; reading snapshots", file=utils.stdinfo)
+        nolocks = True
+
+    if lockType is None or nolocks:
+        return []
+
+    if lockType == LOCK_PRODUCT and not hooks.config.site.productLocks:
+        lockType = LOCK_EX
+
+    if lockType == LOCK_PRODUCT:
+        locks = _takeLocks(cmdName, path, LOCK_SH, ntry, verbose)
+        _productLocking = dict(cmdName=cmdName, path=path, ntry=ntry, verbose=verbose,
+                               locks=locks, products=set(), updating=[])
+    else:
+        locks = _takeLocks(cmdName, path, lockType, ntry, verbose)
         if lockType == LOCK_EX:
-            lockTypeName = "exclusive"
-        else:
-            lockTypeName = "shared"
+            _exclusiveLocks.append((path, locks))
 
-        if verbose > 1:
-            print("Acquiring %s locks for command \"%s\"" % (lockTypeName, cmdName), file=utils.stdinfo)
+    if not _useFcntl():                 # the kernel releases fcntl locks for us
+        #
+        # Cleanup, even in the event of the user being rude enough to use kill
+        #
+        def cleanup(*args):
+            giveLocks(locks, verbose)
 
-        dt = 1.0                        # number of seconds to wait
-        for d in path:
-            makeLock = True             # we can make the lock
-            for i in range(1, ntry + 1):
-                try:
-                    lockDir = os.path.join(getLockPath(d), _lockDir)
-                    getLockPath(d, create=True)
+        import atexit
+        atexit.register(cleanup)            # regular exit
 
-                    os.mkdir(lockDir)
-                except OSError as e:
-                    if lockType == LOCK_EX:
-                        lockPids = listLockers(lockDir, getPids=True)
-                        if len(lockPids) == 1 and lockPids[0] == os.environ.get("EUPS_LOCK_PID", "-1"):
-                            pass        # OK, there's a lock but we know about it
-                            if verbose:
-                                print("Lock is held by a parent, PID %d" % lockPids[0], file=utils.stdinfo)
-                        else:
-                            if e.errno == errno.EEXIST:
-                                reason = "locks are held by %s" % " ".join(listLockers(lockDir))
-                            else:
-                                reason = str(e)
-
-                            msg = "Unable to take exclusive lock on %s" % (d)
-                            if e.errno == errno.EACCES:
-                                if verbose >= 0:
-                                    print("%s; your command may fail" % (msg), file=utils.stdinfo)
-                                    utils.stdinfo.flush()
-                                makeLock = False
-                                break
-
-                            msg += ": %s" % (reason)
-                            if i == ntry:
-                                raise RuntimeError(msg)
-                            else:
-                                print("%s; retrying" % msg, file=utils.stdinfo)
-                                utils.stdinfo.flush()
+        import signal
+        signal.signal(signal.SIGINT, cleanup) # user killed us
+        signal.signal(signal.SIGTERM, cleanup)
 
-                                time.sleep(dt)
-                                continue
-                    else:
-                        if not os.path.exists(lockDir):
-                            if verbose:
-                                print("Unable to lock %s; proceeding with trepidation" % d, file=utils.stdwarn)
-                            return locks
+    return locks
 
-                if not makeLock:
-                    continue
+def holdsExclusiveLock(stackDir):
+    """Return True iff we hold an exclusive lock (taken by takeLocks) on the product stack stackDir"""
+    return any(stackDir in path for path, locks in _exclusiveLocks)
+
+def lockProduct(stackDir, productName):
+    """
+    Take an exclusive lock on productName in the product stack stackDir if we hold LOCK_PRODUCT
+    locks there (otherwise we don't need to).  The lock is held until giveLocks() is called
+    on the locks returned by takeLocks(), and return True iff we took a new lock
+
+    We may not take a new lock within updatingStack(stackDir):  a process holding the product's
+    lock may be waiting for the stack's, so lock all the products first (see lockProducts)
+    """
+    if _productLocking is None or stackDir not in _productLocking["path"] or \
+       (stackDir, productName) in _productLocking["products"]:
+        return False
+
+    if stackDir in _productLocking["updating"]:
+        raise RuntimeError("Unable to lock %s in %s while updating the stack; it must be locked first" %
+                           (productName, stackDir))
+
+    _productLocking["locks"] += _takeLocks(_productLocking["cmdName"], [stackDir], LOCK_EX,
+                                           _productLocking["ntry"], _productLocking["verbose"],
+                                           "-%s" % productName, productName)
+    _productLocking["products"].add((stackDir, productName))
+
+    return True
+
+def lockProducts(stackDir, productNames):
+    """
+    Lock all of productNames in the product stack stackDir (see lockProduct).  They're locked in
+    sorted order, so processes locking overlapping sets of products don't deadlock;  return True
+    iff we took a new lock
+    """
+    tookLock = False
+    for productName in sorted(set(productNames)):
+        if lockProduct(stackDir, productName):
+            tookLock = True
+
+    return tookLock
+
+@contextlib.contextmanager
+def updatingStack(stackDir):
+    """
+    A context manager that prevents processes holding LOCK_PRODUCT locks on the product
+    stack stackDir from changing its database or caches at the same time as us (the
+    other locks exclude them already)
+    """
+    if _productLocking is None or stackDir not in _productLocking["path"]:
+        yield
+        return
+
+    locks = _takeLocks(_productLocking["cmdName"], [stackDir], LOCK_EX,
+                       _productLocking["ntry"], _productLocking["verbose"], _updateSuffix, "updates")
+    updating = _productLocking["updating"]
+    updating.append(stackDir)
+    try:
+        yield
+    finally:
+        updating.remove(stackDir)
+        giveLocks(locks, _productLocking["verbose"] if _productLocking else 0)
+
+def _takeLocks(cmdName, path, lockType, ntry=10, verbose=0, suffix="", what=None):
+    """
+    Take locks of type lockType (LOCK_SH or LOCK_EX) on the product stacks in path
+    @param suffix   appended to the name of the lock, to lock a part of the stacks
+    @param what     a description of that part, for messages
+    """
+    if _useFcntl():
+        return _takeFileLocks(cmdName, path, lockType, verbose, suffix, what)
+
+    locks = []
+    if lockType == LOCK_EX:
+        lockTypeName = "exclusive"
+    else:
+        lockTypeName = "shared"
+
+    if verbose > 1:
+        print("Acquiring %s locks%s for command \"%s\"" % (lockTypeName, " on %s" % what if what else "", cmdName),
+              file=utils.stdinfo)
+
+    dt = 1.0                        # number of seconds to wait
+    for d in path:
+        where = "%s in %s" % (what, d) if what else d
+        makeLock = True             # we can make the lock
+        for i in range(1, ntry + 1):
+            try:
+                lockDir = os.path.join(getLockPath(d), _lockDir + suffix)
+                getLockPath(d, create=True)
 
-                if verbose > 2:
-                    print("Creating lock directory %s" % (lockDir), file=utils.stdinfo)
-                #
-                # OK, the lock directory exists.
-                #
-                # If we're a shared lock, we need to check that no-one holds an exclusive lock (or, if someone
-                # does hold the lock, that we're the holder's child)
-                #
-                # N.b. the check isn't atomic, but that's conservative (we don't care if the exclusive lock's
-                # dropped while we're pondering its existence)
-                #
-                lockers = listLockers(lockDir, "exclusive*")
-                if len(lockers) > 0:
-                    if len(lockers) == 1 and \
-                       os.environ.get("EUPS_LOCK_PID", "-1") == \
-                       listLockers(lockDir, "exclusive*", getPids=True)[0]:
-                        pass
+                os.mkdir(lockDir)
+            except OSError as e:
+                if lockType == LOCK_EX:
+                    lockPids = listLockers(lockDir, getPids=True)
+                    if len(lockPids) == 1 and lockPids[0] == os.environ.get("EUPS_LOCK_PID", "-1"):
+                        pass        # OK, there's a lock but we know about it
+                        if verbose:
+                            print("Lock is held by a parent, PID %s" % lockPids[0], file=utils.stdinfo)
                     else:
-                        raise RuntimeError(("Unable to take shared lock on %s: " +
-                                            "an exclusive lock is held by %s") % (d, " ".join(lockers)))
+                        if e.errno == errno.EEXIST:
+                            reason = "locks are held by %s" % " ".join(listLockers(lockDir))
+                        else:
+                            reason = str(e)
 
-                break                   # got the lock
+                        msg = "Unable to take exclusive lock on %s" % (where)
+                        if e.errno == errno.EACCES:
+                            if verbose >= 0:
+                                print("%s; your command may fail" % (msg), file=utils.stdinfo)
+                                utils.stdinfo.flush()
+                            makeLock = False
+                            break
+
+                        msg += ": %s" % (reason)
+                        if i == ntry:
+                            raise RuntimeError(msg)
+                        else:
+                            print("%s; retrying" % msg, file=utils.stdinfo)
+                            utils.stdinfo.flush()
+
+                            time.sleep(dt)
+                            continue
+                else:
+                    if not os.path.exists(lockDir):
+                        if verbose:
+                            print("Unable to lock %s; proceeding with trepidation" % where, file=utils.stdwarn)
+                        return locks
 
             if not makeLock:
                 continue
 
-            if "EUPS_LOCK_PID" not in os.environ: # remember the PID of the process taking the lock
-                os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
-                os.putenv("EUPS_LOCK_PID", os.environ["EUPS_LOCK_PID"])
+            if verbose > 2:
+                print("Creating lock directory %s" % (lockDir), file=utils.stdinfo)
             #
+            # OK, the lock directory exists.
             #
-            # Create a file in it
+            # If we're a shared lock, we need to check that no-one holds an exclusive lock (or, if someone
+            # does hold the lock, that we're the holder's child)
             #
-            who = utils.getUserName()
-            pid = os.getpid()
-
-            lockFile = "%s-%s.%d" % (lockTypeName, who, pid)
+            # N.b. the check isn't atomic, but that's conservative (we don't care if the exclusive lock's
+            # dropped while we're pondering its existence)
+            #
+            lockers = listLockers(lockDir, "exclusive*")
+            if len(lockers) > 0:
+                if len(lockers) == 1 and \
+                   os.environ.get("EUPS_LOCK_PID", "-1") == \
+                   listLockers(lockDir, "exclusive*", getPids=True)[0]:
+                    pass
+                else:
+                    raise RuntimeError(("Unable to take shared lock on %s: " +
+                                        "an exclusive lock is held by %s") % (where, " ".join(lockers)))
+
+            break                   # got the lock
+
+        if not makeLock:
+            continue
 
-            try:
-                fd = os.open(os.path.join(lockDir, lockFile), os.O_EXCL | os.O_RDWR | os.O_CREAT)
-                os.close(fd)
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    # should not occur
-                    raise
+        if "EUPS_LOCK_PID" not in os.environ: # remember the PID of the process taking the lock
+            os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
+            os.putenv("EUPS_LOCK_PID", os.environ["EUPS_LOCK_PID"])
+        #
+        #
+        # Create a file in it
+        #
+        who = utils.getUserName()
+        pid = os.getpid()
 
-            locks.append((lockDir, lockFile))
+        lockFile = "%s-%s.%d" % (lockTypeName, who, pid)
 
-            if verbose > 3:
-                print("Creating lockfile %s" % (os.path.join(lockDir, lockFile)), file=utils.stdinfo)
-    #
-    # Cleanup, even in the event of the user being rude enough to use kill
-    #
-    def cleanup(*args):
-        giveLocks(locks, verbose)
+        try:
+            fd = os.open(os.path.join(lockDir, lockFile), os.O_EXCL | os.O_RDWR | os.O_CREAT)
+            os.close(fd)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                # should not occur
+                raise
 
-    import atexit
-    atexit.register(cleanup)            # regular exit
+        locks.append((lockDir, lockFile))
 
-    import signal
-    signal.signal(signal.SIGINT, cleanup) # user killed us
-    signal.signal(signal.SIGTERM, cleanup)
+        if verbose > 3:
+            print("Creating lockfile %s" % (os.path.join(lockDir, lockFile)), file=utils.stdinfo)
 
     return locks
 
@@ -177,7 +304,17 @@ def giveLocks(locks, verbose=0):
 
     If the directory ends up empty, it is removed
     """
-    for d, f in locks:
+    global _productLocking
+    if _productLocking is not None and locks is _productLocking["locks"]:
+        _productLocking = None
+    _exclusiveLocks[:] = [held for held in _exclusiveLocks if held[1] is not locks]
+
+    for lk in locks:
+        if isinstance(lk, _FileLock):
+            lk.release(verbose)
+            continue
+
+        d, f = lk
         if not os.path.isdir(d):
             continue
 
@@ -193,43 +330,340 @@ def giveLocks(locks, verbose=0):
         if nlockFiles == 0:
             os.rmdir(d)
 
+class _FileLock:
+    """
+    A lock on a product stack, taken with flock() on its lock file.  The kernel releases
+    the lock if we die.
+
+    A process holds one lock per lock file, shared by all the _FileLocks that it takes on
+    that file (flock() locks taken on different descriptors would conflict with each other).
+    The holder of an exclusive lock writes its PID to the file so that its children can
+    tell that it holds the lock (see EUPS_LOCK_PID)
+    """
+    _held = {}                          # filename: [fd, lockType, number of _FileLocks]
+
+    def __init__(self, filename, lockType):
+        self.filename = filename
+        self.lockType = lockType
+        self._released = False
+
+    def __repr__(self):
+        return "_FileLock(%s, %s)" % (self.filename, "exclusive" if self.lockType == LOCK_EX else "shared")
+
+    def release(self, verbose=0):
+        if self._released:
+            return
+        self._released = True
+
+        held = self._held.get(self.filename)
+        if held is None:                # we lost it (see _upgradeFileLock)
+            return
+
+        held[2] -= 1
+        if held[2] > 0:
+            return
+
+        if verbose > 2:
+            print("Releasing lock on %s" % (self.filename), file=utils.stdinfo)
+
+        fd, lockType = held[0], held[1]
+        if lockType == LOCK_EX:
+            try:
+                os.ftruncate(fd, 0)
+            except OSError:
+                pass
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        del self._held[self.filename]
+
+def _exclusiveHolder(fd):
+    """Return the PID written to a lock file by the holder of an exclusive lock (or None)"""
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        return int(os.read(fd, 32).decode())
+    except (OSError, ValueError):
+        return None
+
+def _isAlive(pid):
+    """Return True iff process pid exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM   # it exists, but isn't ours
+
+    return True
+
+class _LockTimeout(Exception):
+    """Raised by the SIGALRM handler used by _flock"""
+    pass
+
+def _flock(fd, op, timeout, verbose=0, msg=None):
+    """
+    Apply flock operation op to fd, waiting up to timeout seconds (forever if None);
+    return True iff we got the lock.
+
+    We wait in flock() itself, so that we're queued along with the other processes waiting for the
+    lock, and interrupt it with SIGALRM when our time's up.  Only the main thread can handle signals,
+    so other threads poll
+    """
+    try:
+        fcntl.flock(fd, op | fcntl.LOCK_NB)
+        return True
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+
+    if timeout is not None and timeout <= 0:
+        return False
+
+    if msg and verbose > 0:
+        print(msg, file=utils.stdinfo)
+        utils.stdinfo.flush()
+
+    if timeout is None:
+        fcntl.flock(fd, op)
+        return True
+
+    if threading.current_thread() is not threading.main_thread():
+        return _pollFlock(fd, op, timeout)
+
+    waiting = [True]
+    def alarm(signum, frame):
+        if waiting[0]:
+            raise _LockTimeout()
+
+    start = time.time()
+    oldHandler = signal.signal(signal.SIGALRM, alarm)
+    oldTimer = signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        fcntl.flock(fd, op)
+        return True
+    except _LockTimeout:
+        return False
+    finally:
+        waiting[0] = False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, oldHandler)
+        if oldTimer[0] > 0:             # restart the timer that we replaced
+            signal.setitimer(signal.ITIMER_REAL, max(oldTimer[0] - (time.time() - start), 1e-6), oldTimer[1])
+
+def _pollFlock(fd, op, timeout):
+    """Apply flock operation op to fd, retrying for up to timeout seconds;  return True iff we got the lock"""
+    start = time.time()
+    dt = 0.001                          # initial time to wait before retrying (seconds)
+    while True:
+        try:
+            fcntl.flock(fd, op | fcntl.LOCK_NB)
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return False
+
+        time.sleep(min(dt, remaining))
+        dt = min(2*dt, 0.1)
+
+def _takeFileLocks(cmdName, path, lockType, verbose=0, suffix="", what=None):
+    """
+    Take locks on the product stacks in path using flock(); see takeLocks.  We wait
+    for up to hooks.config.site.lockTimeout seconds for each lock
+    """
+    if lockType == LOCK_EX:
+        lockTypeName, op = "exclusive", fcntl.LOCK_EX
+    else:
+        lockTypeName, op = "shared", fcntl.LOCK_SH
+
+    if verbose > 1:
+        print("Acquiring %s locks%s for command \"%s\"" % (lockTypeName, " on %s" % what if what else "", cmdName),
+              file=utils.stdinfo)
+
+    timeout = hooks.config.site.lockTimeout
+    parentPid = os.environ.get("EUPS_LOCK_PID")
+
+    locks = []
+    try:
+        for d in path:
+            where = "%s in %s" % (what, d) if what else d
+            filename = os.path.join(getLockPath(d, create=True), _lockFile + suffix)
+
+            held = _FileLock._held.get(filename)
+            if held:                    # we already have a lock on this stack
+                if held[1] == LOCK_SH and lockType == LOCK_EX:
+                    _upgradeFileLock(filename, timeout, verbose, where)
+
+                held[2] += 1
+                locks.append(_FileLock(filename, lockType))
+                continue
+
+            try:
+                fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError:
+                try:
+                    fd = os.open(filename, os.O_RDONLY) # we can still lock it
+                except OSError as e:
+                    if verbose >= 0:
+                        print("Unable to take %s lock on %s: %s; your command may fail" %
+                              (lockTypeName, where, e), file=utils.stdinfo)
+                        utils.stdinfo.flush()
+                    continue
+
+            holder = _exclusiveHolder(fd)
+            if holder is not None and parentPid == str(holder) and holder != os.getpid() and \
+                    _isAlive(holder):
+                if verbose > 0:
+                    print("Lock is held by a parent, PID %d" % holder, file=utils.stdinfo)
+                os.close(fd)
+                continue
+
+            if not _flock(fd, op, timeout, verbose, "Waiting for %s lock on %s" % (lockTypeName, where)):
+                holder = _exclusiveHolder(fd)
+                os.close(fd)
+                msg = "Unable to take %s lock on %s after %gs" % (lockTypeName, where, timeout)
+                if holder is not None and _isAlive(holder):
+                    msg += ": an exclusive lock is held by [pid=%d]" % holder
+                raise RuntimeError(msg)
+
+            if lockType == LOCK_EX:
+                _writePid(fd)
+
+            _FileLock._held[filename] = [fd, lockType, 1]
+            locks.append(_FileLock(filename, lockType))
+
+            if verbose > 3:
+                print("Took %s lock on %s" % (lockTypeName, filename), file=utils.stdinfo)
+    except Exception:
+        giveLocks(locks, verbose)
+        raise
+
+    if "EUPS_LOCK_PID" not in os.environ: # remember the PID of the process taking the lock
+        os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
+        os.putenv("EUPS_LOCK_PID", os.environ["EUPS_LOCK_PID"])
+
+    return locks
+
+def _upgradeFileLock(filename, timeout, verbose, where):
+    """
+    Upgrade our shared lock on filename to an exclusive lock, raising RuntimeError if we can't.
+
+    flock() gives up the shared lock before waiting for the exclusive one, so we say so explicitly,
+    and if we don't get the exclusive lock we take the shared one back.  If we can't do that either
+    we no longer hold a lock on filename
+    """
+    held = _FileLock._held[filename]
+    fd = held[0]
+
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    if _flock(fd, fcntl.LOCK_EX, timeout, verbose, "Waiting for exclusive lock on %s" % where):
+        held[1] = LOCK_EX
+        _writePid(fd)
+        return
+
+    msg = "Unable to take exclusive lock on %s after %gs" % (where, timeout)
+    if not _flock(fd, fcntl.LOCK_SH, timeout):
+        os.close(fd)
+        del _FileLock._held[filename]
+        msg += "; the shared lock that we held has been lost"
+
+    raise RuntimeError(msg)
+
+def _writePid(fd):
+    """Record that we hold the exclusive lock on the lock file fd"""
+    try:
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, ("%d\n" % os.getpid()).encode())
+    except OSError:
+        pass                            # we opened it read-only
+
 def clearLocks(path, verbose=0, noaction=False):
     """Remove all locks found in the directories listed in path"""
 
+    if _useFcntl():
+        if verbose:
+            print("Locks are released automatically when the processes holding them exit", file=utils.stdinfo)
+        return
+
     for d in path:
-        lockDir = getLockPath(d)
-        if not lockDir:
+        lockPath = getLockPath(d)
+        if not lockPath:
             continue
 
-        lockDir = os.path.join(lockDir, _lockDir)
-        if not os.path.isdir(lockDir):
-            continue
+        for lockDir in _findLocks(lockPath, _lockDir):
+            if not os.path.isdir(lockDir):
+                continue
 
-        if noaction:
-            print("rm -rf %s" % lockDir, file=sys.stderr)
-        else:
-            if verbose:
-                print("Removing %s" % lockDir, file=utils.stdinfo)
+            if noaction:
+                print("rm -rf %s" % lockDir, file=sys.stderr)
+            else:
+                if verbose:
+                    print("Removing %s" % lockDir, file=utils.stdinfo)
 
-            try:
-                shutil.rmtree(lockDir)
-            except OSError as e:
-                print("Unable to remove %s: %s" % (lockDir, e), file=utils.stderr)
+                try:
+                    shutil.rmtree(lockDir)
+                except OSError as e:
+                    print("Unable to remove %s: %s" % (lockDir, e), file=utils.stderr)
+
+def _findLocks(lockPath, lockName):
+    """
+    Return the locks named lockName in lockPath, followed by those on parts of the
+    stack (e.g. the products locked by lockProduct())
+    """
+    lockName = os.path.join(lockPath, lockName)
+    return [lockName] + sorted(glob.glob(lockName + "-*") + glob.glob(lockName + _updateSuffix))
+
+def _lockLabel(stackDir, lockName, lock):
+    """Return a label for the lock on part of stackDir in file lock"""
+    suffix = os.path.basename(lock)[len(lockName):]
+    if suffix:                          # "-product" or _updateSuffix
+        return "%s [%s]:" % (stackDir, suffix[1:])
+    else:
+        return stackDir + ":"
 
 def listLocks(path, verbose=0, noaction=False):
     """List all locks found in the directories listed in path"""
 
+    if _useFcntl():
+        for d in path:
+            lockPath = getLockPath(d)
+            if not lockPath:
+                continue
+
+            for lockFile in _findLocks(lockPath, _lockFile):
+                try:
+                    fd = os.open(lockFile, os.O_RDONLY)
+                except OSError:
+                    continue
+
+                try:
+                    held = None
+                    if not _flock(fd, fcntl.LOCK_SH, 0):
+                        held = "exclusive [pid=%s]" % _exclusiveHolder(fd)
+                    else:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                        if not _flock(fd, fcntl.LOCK_EX, 0):
+                            held = "shared"
+                        else:
+                            fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+
+                if held:
+                    print("%-30s %s" % (_lockLabel(d, _lockFile, lockFile), held))
+        return
+
     for d in path:
         lockPath = getLockPath(d)
         if not lockPath:                # no locking
             continue
 
-        lockDir = os.path.join(lockPath, _lockDir)
-
-        if not os.path.isdir(lockDir):
-            continue
+        for lockDir in _findLocks(lockPath, _lockDir):
+            if not os.path.isdir(lockDir):
+                continue
 
-        print("%-30s %s" % (d + ":", " ".join(listLockers(lockDir))))
+            print("%-30s %s" % (_lockLabel(d, _lockDir, lockDir), " ".join(listLockers(lockDir))))
 
 def listLockers(lockDir, globPattern="*", getPids=False):
     """List all the owners of locks in a lockDir"""
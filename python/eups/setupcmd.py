@@ -15,7 +15,7 @@ The output of run() is a status code appropriate for passing to sys.exit().
 """
 import os
 import sys
-from .cmd import EupsOptionParser
+from .cmdline import EupsOptionParser, commandCallbacks
 from .exceptions import EupsException
 import eups
 from . import lock
@@ -35,7 +35,7 @@ class EupsSetup:
 
     """
 
-    usage = "%prog [-h|--help|-V|--version] [options] [product [version]]"
+    usage = "%prog [-h|--help|-V|--version] [options] [product [version]] [+ product [version] ...]"
 
     # set this to True if the description is preformatted.  If false, it
     # will be automatically reformatted to fit the screen
@@ -44,6 +44,9 @@ class EupsSetup:
     description = \
 """(Un)Setup an EUPS-managed product.  This will "load" (or "unload") the
 product and all its dependencies into the environment so that it can be used.
+Several products may be (un)setup at once by separating them with "+" (e.g.
+"setup afw + pex_logging 1.2"); this is equivalent to setting them up in turn,
+but faster as they share the work of reading the product stacks and tables.
 """
 
     def __init__(self, args=None, toolname=None):
@@ -95,7 +98,7 @@ product and all its dependencies into the environment so that it can be used.
                             help="The colon-separated list of product stacks (databases) to use. " +
                             "Default: $EUPS_PATH")
         self.clo.add_option("--debug", dest="debug", action="store", default="",
-                            help="turn on specified debugging behaviors (allowed: debug, profile, raise)")
+                            help="turn on specified debugging behaviors (allowed: debug, profile, raise, timing)")
         self.clo.add_option("-e", "--exact", dest="exact_version", action="store_true", default=False,
                             help="Don't use exact matching even though an explicit version is specified")
         self.clo.add_option("-f", "--flavor", dest="flavor", action="store",
@@ -116,6 +119,11 @@ product and all its dependencies into the environment so that it can be used.
                             help="deprecated (use 'eups list')")
         self.clo.add_option("-m", "--table", dest="tablefile", action="store", default=None,
                             help="Use this table file")
+        self.clo.add_option("--lockfile", dest="lockfile", action="store", metavar="FILE",
+                            help="Recreate the setup saved by --write-lockfile, without reading the " +
+                            "product stacks or table files")
+        self.clo.add_option("--write-lockfile", dest="writeLockfile", action="store", metavar="FILE",
+                            help="Save the result of this setup to FILE, for use with --lockfile")
         self.clo.add_option("-S", "--max-depth", dest="max_depth", action="store", type="int", default=-1,
                             help="Only show this many levels of dependencies (use with -v)")
         self.clo.add_option("-n", "--noaction", dest="noaction", action="store_true", default=False,
@@ -146,11 +154,11 @@ product and all its dependencies into the environment so that it can be used.
 
 
     def execute(self):
+        products = self.splitProducts(self.args)
+
         productName = versionName = None
-        if len(self.args) > 0:
-            productName = self.args[0]
-        if len(self.args) > 1:
-            versionName = self.args[1]
+        if products:
+            productName, versionName = products[0]
 
         if self.opts.unsetup:
             cmdName = "unsetup"
@@ -159,7 +167,7 @@ product and all its dependencies into the environment so that it can be used.
 
         if not self.opts.noCallbacks:
             try:
-                eups.commandCallbacks.apply(None, cmdName, self.opts, self.args)
+                commandCallbacks.apply(None, cmdName, self.opts, self.args)
             except eups.OperationForbidden as e:
                 e.status = 255
                 raise
@@ -167,11 +175,36 @@ product and all its dependencies into the environment so that it can be used.
                 e.status = 9
                 raise
 
+        if self.opts.lockfile:
+            if products or self.opts.unsetup or self.opts.productDir or self.opts.tablefile:
+                self.err("You may not specify products, --unsetup, -r or -m with --lockfile")
+                print(self.clo.get_usage(), file=utils.stderr)
+                return 3
+
+            try:
+                cmds = eups.setupFromLockfile(self.opts.lockfile, flavor=self.opts.flavor,
+                                              noaction=self.opts.noaction,
+                                              verbose=self.opts.verbose - self.opts.quiet,
+                                              force=self.opts.force)
+            except EupsException as e:
+                e.status = 1
+                raise
+
+            print(";\n".join(cmds))
+            return 0
+
         if self.opts.exact_version and self.opts.inexact_version:
             self.err("Specifying --exact --inexact confuses me, so I'll ignore both")
             self.opts.exact_version = False
             self.opts.inexact_version = False
 
+        if len(products) > 1:
+            for opt, name in [("productDir", "-r"), ("tablefile", "-m")]:
+                if getattr(self.opts, opt):
+                    self.err("You may not specify %s with more than one product" % name)
+                    print(self.clo.get_usage(), file=utils.stderr)
+                    return 3
+
         if self.opts.tablefile:         # we're setting up a product based only on a tablefile
             if self.opts.unsetup:
                 self.err("Ignoring --table as I'm unsetting up a product")
@@ -241,7 +274,7 @@ product and all its dependencies into the environment so that it can be used.
 
                 if not self.opts.noCallbacks:
                     try:
-                        eups.commandCallbacks.apply(Eups, cmdName, self.opts, self.args)
+                        commandCallbacks.apply(Eups, cmdName, self.opts, self.args)
                     except eups.OperationForbidden as e:
                         e.status = 255
                         raise
@@ -249,8 +282,9 @@ product and all its dependencies into the environment so that it can be used.
                         e.status = 9
                         raise
 
-                Eups.selectVRO(self.opts.tag, self.opts.productDir, versionName, self.opts.dbz,
-                               inexact_version=self.opts.inexact_version, postTag=self.opts.postTag)
+                if len(products) <= 1:
+                    Eups.selectVRO(self.opts.tag, self.opts.productDir, versionName, self.opts.dbz,
+                                   inexact_version=self.opts.inexact_version, postTag=self.opts.postTag)
 
                 if self.opts.tag:
                     for t in self.opts.tag:
@@ -260,23 +294,35 @@ product and all its dependencies into the environment so that it can be used.
                 Eups.includeUserDataDirInPath()
                 for user in Eups.tags.owners.values():
                     Eups.includeUserDataDirInPath(eups.utils.defaultUserDataDir(user))
-                #
-                # If they specify a productDir in addition to a complete product + version specification
-                # Use that product + version's expanded table file, but this directory
-                #
-                if self.opts.productDir and not self.opts.tablefile and productName and versionName:
-                    prod = Eups.findProduct(productName, versionName)
-                    if not prod:
-                        self.err("Unable to find %s %s" % (productName, versionName))
-                        return 3
-
-                    tablefile = prod.tablefile
-                else:
-                    tablefile=self.opts.tablefile
 
-                cmds = eups.setup(productName, versionName, self.opts.tag, self.opts.productDir,
-                                  Eups, fwd=not self.opts.unsetup, tablefile=tablefile,
-                                  postTags=self.opts.postTag)
+                if len(products) > 1:   # setupProducts selects the VRO for each product
+                    cmds = eups.setupProducts(products, self.opts.tag, Eups, fwd=not self.opts.unsetup,
+                                              postTags=self.opts.postTag,
+                                              vroOptions=dict(tag=self.opts.tag, dbz=self.opts.dbz,
+                                                              inexact_version=self.opts.inexact_version,
+                                                              postTag=self.opts.postTag))
+                else:
+                    #
+                    # If they specify a productDir in addition to a complete product + version
+                    # specification use that product + version's expanded table file, but this directory
+                    #
+                    if self.opts.productDir and not self.opts.tablefile and productName and versionName:
+                        prod = Eups.findProduct(productName, versionName)
+                        if not prod:
+                            self.err("Unable to find %s %s" % (productName, versionName))
+                            return 3
+
+                        tablefile = prod.tablefile
+                    else:
+                        tablefile=self.opts.tablefile
+
+                    cmds = eups.setup(productName, versionName, self.opts.tag, self.opts.productDir,
+                                      Eups, fwd=not self.opts.unsetup, tablefile=tablefile,
+                                      postTags=self.opts.postTag)
+
+                if self.opts.writeLockfile and not self.opts.noaction and "false" not in cmds:
+                    eups.writeLockfile(self.opts.writeLockfile, Eups,
+                                       [p[0] for p in products] if len(products) > 1 else [productName])
 
             except EupsException as e:
                 e.status = 1
@@ -294,6 +340,23 @@ product and all its dependencies into the environment so that it can be used.
 
         return status
 
+    def splitProducts(self, args):
+        """
+        Return the products (and versions) given on the command line as a list of
+        (productName, versionName) pairs, where versionName may be None.  Products
+        are separated by "+", e.g. "afw + pex_logging 1.2"
+        """
+        products = []
+        words = []
+        for a in args + ["+"]:
+            if a != "+":
+                words.append(a)
+            elif words:
+                products.append((words[0], words[1] if len(words) > 1 else None))
+                words = []
+
+        return products
+
     def err(self, msg, volume=0):
         """
         print an error message to standard error.  The message will only
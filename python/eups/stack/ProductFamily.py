@@ -1,34 +1,114 @@
 import os
+import sys
 from eups import utils
+import eups.hooks as hooks
 from eups.Product import Product
 import eups.tags
 from eups.exceptions import ProductNotFound, TableFileNotFound
 from eups.table import Table
 
+# The cached information about a version of a product is kept in a tuple,
+# which is both compact and quickly unpickled:
+#   (name, version, dir, tablefile, table, flags)
+# These are the product name, version, installation directory, path to the
+# table file, the corresponding Table instance (or None if not yet loaded),
+# and flags.  Products are nearly always installed in <parent>/<version>,
+# with the same parent for all versions, and have the default table file,
+# <dir>/ups/<name>.table; as indicated by the flags, such paths are not
+# stored, but are regenerated from the (interned) parent directory, version,
+# and product name when requested.
+_IN_PARENT = 0x1                        # the dir field holds the parent directory
+_DEFAULT_TABLE = 0x2                    # the table file is the default
+
+def _makeRecord(name, version, dir, tablefile, table=None):
+    flags = 0
+    if isinstance(dir, str):
+        if tablefile and tablefile == os.path.join(dir, "ups", name + ".table"):
+            flags |= _DEFAULT_TABLE
+            tablefile = None
+        if os.path.basename(dir) == version and os.path.dirname(dir):
+            flags |= _IN_PARENT
+            dir = _intern(os.path.dirname(dir))
+
+    return (name, version, dir, tablefile, table, flags)
+
+def _recordDir(rec):
+    if rec[5] & _IN_PARENT:
+        return os.path.join(rec[2], rec[1])
+    return rec[2]
+
+def _recordTablefile(rec):
+    if rec[5] & _DEFAULT_TABLE:
+        return os.path.join(_recordDir(rec), "ups", rec[0] + ".table")
+    return rec[3]
+
+def _intern(value):
+    # Intern a string so that the many copies of the same name, version or
+    # directory share a single object (which pickling preserves)
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
 class ProductFamily:
     """
     a set of different versions of a named product.  When this refers to
     installed products, it is assumed that all versions are of the same flavor.
     """
 
+    # A stack holds a great many of these, so keep them compact
+    __slots__ = ("name", "versions", "tags", "_tagsByVersion", "_sortedVersions", "_sortedBy")
+
     def __init__(self, name):
         """
         create a product family with a given product name
         """
 
         # the product name
-        self.name = name
+        self.name = _intern(name)
 
         # a lookup for version-specific information where the keys are the
-        # version names and the values are tuples containing the installation
-        # directory, the dependencies table, and a corresponding instance of
-        # Table (which may be None).
+        # version names and the values are tuples (see _makeRecord) giving
+        # the installation directory, the dependencies table, and a
+        # corresponding instance of Table (which may be None).
         self.versions = {}
 
         # a lookup of tag assignments where each key is a tag name and its
         # value is the version name assigned to the tag.
         self.tags = {}
 
+        self._initIndexes()
+
+    def _initIndexes(self):
+        # the reverse of self.tags: each key is a version name and its value
+        # is the list of tags assigned to it.
+        self._tagsByVersion = {}
+        for tag, version in self.tags.items():
+            self._tagsByVersion.setdefault(version, []).append(tag)
+
+        # the version names sorted by hooks.version_cmp (the latest last),
+        # and the comparison function used to sort them; built on demand.
+        self._sortedVersions = None
+        self._sortedBy = None
+
+    def __getstate__(self):
+        # leave out the indexes, which are rebuilt when first needed; without
+        # a __setstate__, unpickling a family involves no python code
+        return (None, dict(name=self.name, versions=self.versions, tags=self.tags))
+
+    def _checkIndexes(self):
+        # build the indexes if this family was just unpickled
+        if not hasattr(self, "_tagsByVersion"):
+            self._initIndexes()
+
+    def _getSortedVersions(self):
+        # return the (internal) sorted list of version names, (re)sorting if
+        # needed; hooks.version_cmp may be replaced by a startup file.
+        self._checkIndexes()
+        if self._sortedVersions is None or self._sortedBy is not hooks.version_cmp:
+            self._sortedVersions = sorted(self.versions.keys(), **utils.cmp_or_key(hooks.version_cmp))
+            self._sortedBy = hooks.version_cmp
+        return self._sortedVersions
+
     def __repr__(self):
         nVersion = len(self.versions)
         return "ProductFamily: %s (%d version%s)" % (self.name, nVersion, ('' if nVersion == 1 else 's'))
@@ -39,6 +119,23 @@ class ProductFamily:
         """
         return list(self.versions.keys())
 
+    def getSortedVersions(self):
+        """
+        return a list containing the version names in this product family,
+        sorted with hooks.version_cmp so that the latest version is last
+        """
+        return list(self._getSortedVersions())
+
+    def getLatest(self):
+        """
+        return the name of the latest version in this product family (as
+        defined by hooks.version_cmp), or None if it has no versions
+        """
+        vers = self._getSortedVersions()
+        if not vers:
+            return None
+        return vers[-1]
+
     def getProduct(self, version, dbpath=None, flavor=None):
         """
         return the Product of the requested version or None if not found.
@@ -51,13 +148,12 @@ class ProductFamily:
         """
         try:
             versdata = self.versions[version]
-            tags = [item[0] for item in [x for x in self.tags.items() if x[1] == version]]
+            self._checkIndexes()
             out = Product(self.name, version, flavor,
-                          versdata[0],    # the install directory
-                          versdata[1],    # the table file
-                          tags, dbpath)
-            if versdata[2]:
-                out._table = versdata[2]
+                          _recordDir(versdata), _recordTablefile(versdata),
+                          self._tagsByVersion.get(version), dbpath)   # Product copies the tags
+            if versdata[4]:
+                out._table = versdata[4]
             return out
 
         except KeyError:
@@ -141,7 +237,23 @@ class ProductFamily:
             msg = "Missing version name while registering new version " + \
                 "for product %s: %s"
             raise RuntimeError(msg % (self.name, version))
-        self.versions[version] = (installdir, tablefile, table)
+        self._checkIndexes()
+        if version not in self.versions and self._sortedVersions is not None:
+            if self._sortedBy is hooks.version_cmp:
+                # insert in order (bisect.insort only takes a key from python 3.10)
+                vers = self._sortedVersions
+                lo, hi = 0, len(vers)
+                while lo < hi:
+                    mid = (lo + hi)//2
+                    if hooks.version_cmp(version, vers[mid]) < 0:
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                vers.insert(lo, version)
+            else:
+                self._sortedVersions = None
+        version = _intern(version)
+        self.versions[version] = _makeRecord(self.name, version, installdir, tablefile, table)
 
     def hasVersion(self, version):
         """
@@ -160,10 +272,12 @@ class ProductFamily:
         @return bool :
         """
         if self.hasVersion(version):
-            itsTags = [y[0] for y in [x for x in self.versions.items() if x[1] == version]]
-            for tag in itsTags:
+            self._checkIndexes()
+            for tag in list(self._tagsByVersion.get(version, [])):
                 self.unassignTag(tag)
             del self.versions[version]
+            if self._sortedVersions is not None:
+                self._sortedVersions.remove(version)
             return True
         else:
             return False
@@ -180,8 +294,12 @@ class ProductFamily:
         if not self.hasVersion(version):
             raise ProductNotFound(self.name, version)
 
-        tag = str(tag)
+        tag = _intern(str(tag))
+        version = _intern(version)
+        self._checkIndexes()
+        self.unassignTag(tag)
         self.tags[tag] = version
+        self._tagsByVersion.setdefault(version, []).append(tag)
 
     def unassignTag(self, tag, file=None):
         """
@@ -193,7 +311,13 @@ class ProductFamily:
         @return bool :  false if the tag was not previously assigned
         """
         if tag in self.tags:
-            del self.tags[tag]
+            self._checkIndexes()
+            version = self.tags.pop(tag)
+            itsTags = self._tagsByVersion.get(version, [])
+            if tag in itsTags:
+                itsTags.remove(tag)
+                if not itsTags:
+                    del self._tagsByVersion[version]
             return True
         else:
             return False
@@ -212,13 +336,14 @@ class ProductFamily:
         try:
             verdata = self.versions[version]
             if not table:
-                if not utils.isRealFilename(verdata[1]):
+                tablefile = _recordTablefile(verdata)
+                if not utils.isRealFilename(tablefile):
                     return
-                if not os.path.exists(verdata[1]):
-                    raise TableFileNotFound(verdata[1], self.name, version)
+                if not os.path.exists(tablefile):
+                    raise TableFileNotFound(tablefile, self.name, version)
                 prod = self.getProduct(version)
-                table = Table(verdata[1]).expandEupsVariables(prod)
-            self.versions[version] = (verdata[0], verdata[1], table)
+                table = Table(tablefile).expandEupsVariables(prod)
+            self.versions[version] = verdata[:4] + (table,) + verdata[5:]
         except KeyError:
             raise ProductNotFound(self.name, version)
 
@@ -2,6 +2,8 @@ import re, os, sys
 import contextlib
 import pickle
 from eups import utils
+from eups import timing
+import eups.hooks as hooks
 from eups import Product
 from .ProductFamily import ProductFamily
 from eups.exceptions import EupsException,ProductNotFound, UnderSpecifiedProduct
@@ -13,7 +15,7 @@ from ..utils import xrange
 
 # the version name for the persistence format used by this implementation.
 # It is intended to match the version of EUPS when this format was introduced
-persistVersionName = "1.3.0"
+persistVersionName = "2.2.16"
 
 # the prefix to a tag name that labels it as a user tag.  Anything left over is
 # considered a global tag.
@@ -90,6 +92,15 @@ class ProductStack:
         # pending
         self.updated = []
 
+        # the changes made to each flavor since it was last saved, loaded or
+        # refreshed, to be replayed on top of a cache that someone else has
+        # rewritten in the meantime (see reload(merge=True)).  Each value is
+        # a list of (productName, methodName, args), and a dictionary giving
+        # the state of each of those products before we changed it (see
+        # _familyState()).  None means that the flavor's data was read
+        # directly from the database, so there's nothing to merge
+        self.journal = {}
+
         # a lookup of modification times for the underlying cachefiles
         # by cachefile name when data was loaded in from this cache.
         # If a target cache file has been updated since then, we should
@@ -116,6 +127,12 @@ class ProductStack:
         # True if python is new enough to pickle the cache data
         self.canCache = utils.canPickle()
 
+        # the generation of the database (see Database.getGeneration()) that
+        # the product data was read from, if known.  It's recorded alongside
+        # the caches we write, so that readers can trust them without checking
+        # the database
+        self.generation = None
+
     def __repr__(self):
         return "ProductStack: %s (%d products)" % (self.dbpath, len(self.getProductNames()))
 
@@ -158,21 +175,40 @@ class ProductStack:
         else:
             return list(self.lookup[flavor].keys())
 
-    def getVersions(self, productName, flavor=None):
+    def getVersions(self, productName, flavor=None, sort=False):
         """
         return the versions declared for all declared products
         @param productName   the name of the product of interest
         @param flavor        the flavor to search; if None, return for all
                                 flavors
+        @param sort          if True, sort the versions with
+                                hooks.version_cmp, latest last
         """
         try:
           if flavor is None:
-            return _uniquify(_lol2l(z[productName].getVersions() for z in self.lookup.values()))
+            vers = _uniquify(_lol2l(z[productName].getVersions() for z in self.lookup.values()))
+            if sort:
+                vers.sort(**utils.cmp_or_key(hooks.version_cmp))
+            return vers
+          elif sort:
+            return self.lookup[flavor][productName].getSortedVersions()
           else:
             return self.lookup[flavor][productName].getVersions()
         except KeyError:
           return []
 
+    def getLatestVersion(self, productName, flavor):
+        """
+        return the name of the latest version (as defined by
+        hooks.version_cmp) of a product, or None if none are declared
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search
+        """
+        try:
+            return self.lookup[flavor][productName].getLatest()
+        except KeyError:
+            return None
+
     def hasProduct(self, name, flavor=None, version=None):
         """
         return true if a desired product is registered.
@@ -220,20 +256,24 @@ class ProductStack:
     def persistFilename(flavor):
         return "%s.%s" % (flavor, ProductStack.persistFileExt)
 
-    def save(self, flavors=None, dir=None):
+    def save(self, flavors=None, dir=None, merge=False):
         """
         persist the product information to disk.  If a cache file for a
         flavor is newer than when we loaded from it last, that flavor
-        will not be saved, and a RuntimeError will be raised.  Other flavors,
+        will not be saved, and a CacheOutOfSync will be raised.  Other flavors,
         will be saved, though.
         @param flavors  the flavors to persist.  This can be a single string
                            (for a single flavor) or a list of flavors.  If
                            None, save all flavors that appear to need updating
         @param file     the file to save it to.
+        @param merge    if True, a flavor whose cache file is newer is reloaded
+                           from it and our unsaved changes replayed on top (see
+                           reload()) before it's saved.  CacheOutOfSync is
+                           only raised if the changes can't be replayed
         """
         if flavors is None:
             if not self.updated: return
-            return self.save(self.updated)
+            return self.save(self.updated, dir, merge)
         if not isinstance(flavors, list):
             flavors = [flavors]
 
@@ -241,13 +281,22 @@ class ProductStack:
         for flavor in flavors:
             file = self._persistPath(flavor, dir)
             if not self._cacheFileIsInSync(file):
-                # file was updated since we loaded from it last!
-                outofsync.append(file)
-                continue
+                # file was updated since we loaded from it last!  If our data
+                # was read from the database we've no record of our changes, so
+                # we can't merge them into it
+                if not merge or self.journal.get(flavor, ([], {})) is None:
+                    outofsync.append(file)
+                    continue
+                try:
+                    self.reload(flavor, dir, merge=True)
+                except CacheOutOfSync:
+                    outofsync.append(file)
+                    continue
 
             self.persist(flavor, file)
             if dir is None:
                 self.updated = [x for x in self.updated if x != flavor]
+                self.journal.pop(flavor, None)
 
         if len(outofsync) > 0:
             raise CacheOutOfSync(outofsync)
@@ -305,12 +354,67 @@ class ProductStack:
             self.lookup[flavor] = {}
         flavorData = self.lookup[flavor]
 
+        timing.count("stack cache saves")
         with utils.AtomicFile(file, "wb") as fd:
             pickle.dump(flavorData, fd, protocol=4)
         # This could fail if another process deleted the file immediately.
         with contextlib.suppress(FileNotFoundError):
             self.modtimes[file] = os.stat(file).st_mtime
 
+        if self.generation is not None:
+            self._recordGeneration(file, self.generation)
+
+    def recordGeneration(self):
+        """
+        record that the cache files that we read or wrote hold the product data
+        of generation self.generation of the database (e.g. after updating the
+        database and saving the flavors that changed).  Files that someone else
+        has rewritten since are skipped
+        """
+        if self.generation is None:
+            return
+
+        for cache, mtime in list(self.modtimes.items()):
+            self._recordGeneration(cache, self.generation, mtime)
+
+    @staticmethod
+    def _generationFile(cache):
+        return cache + ".generation"
+
+    def _recordGeneration(self, cache, generation, mtime=None):
+        """
+        record that a cache file holds the product data of a given generation of
+        the database.  The cache file's inode and modification time are saved too,
+        so that the record is ignored if the cache is rewritten by someone else
+        @param mtime   if not None, only record the generation if the cache's
+                         modification time is still this
+        """
+        try:
+            st = os.stat(cache)
+            if mtime is not None and st.st_mtime != mtime:
+                return
+            with utils.AtomicFile(self._generationFile(cache), "w") as fd:
+                print(generation, st.st_ino, st.st_mtime_ns, file=fd)
+        except (IOError, OSError):
+            pass
+
+    def _cacheGeneration(self, cache):
+        """
+        return the generation of the database that a cache file was written
+        from, or None if it isn't known
+        """
+        try:
+            with open(self._generationFile(cache)) as fd:
+                generation, ino, mtime = [int(v) for v in fd.read().split()]
+            st = os.stat(cache)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if (st.st_ino, st.st_mtime_ns) != (ino, mtime):
+            return None
+
+        return generation
+
     def export(self):
         """
         return a hierarchical dictionary of all the Products in the stack,
@@ -345,7 +449,12 @@ class ProductStack:
         if not self.cacheIsInSync(flavors):
             if verbose > 0:
                 print("Note: cache appears out-of-sync; updating...", file=sys.stderr)
-            self.reload(flavors, persistDir)
+            try:
+                self.reload(flavors, persistDir, merge=True)
+            except CacheOutOfSync:
+                # our unsaved changes don't fit the newer cache, but they've
+                # been written to the database
+                self.refreshFromDatabase()
 
     def addFlavor(self, flavor):
         """
@@ -383,6 +492,7 @@ class ProductStack:
         prod = product.clone().resolvePaths()
 
         flavor = prod.flavor
+        self._journalBase(flavor, prod.name)
         if flavor not in self.lookup:
             self.lookup[flavor] = {}
         if prod.name not in self.lookup[flavor]:
@@ -394,6 +504,7 @@ class ProductStack:
         for tag in prod.tags:
             self.lookup[flavor][prod.name].assignTag(tag, prod.version)
 
+        self._journal(flavor, prod.name, "addProduct", prod)
         self._flavorsUpdated(flavor)
         if self.autosave: self.save(flavor)
 
@@ -408,6 +519,20 @@ class ProductStack:
         elif flavors not in self.updated:
             self.updated.append(flavors)
 
+    def _journalBase(self, flavor, name):
+        # remember the state of a product before we first change it, so that
+        # reload() can tell whether someone else has changed it too
+        journal = self.journal.setdefault(flavor, ([], {}))
+        if journal is not None and name not in journal[1]:
+            journal[1][name] = _familyState(self.lookup.get(flavor, {}).get(name))
+
+    def _journal(self, flavor, name, method, *args):
+        # remember a change to a product, so that it can be replayed if we
+        # need to merge it with a newer cache (see reload())
+        journal = self.journal.setdefault(flavor, ([], {}))
+        if journal is not None:
+            journal[0].append((name, method, args))
+
     def saveNeeded(self, flavors=None):
         """
         return true if there are unsaved updates to this product stack.
@@ -447,10 +572,12 @@ class ProductStack:
             if flavor not in self.lookup:
                 self.lookup[flavor] = {}
             for product in products[flavor].keys():
+                self._journalBase(flavor, product)
                 if product not in self.lookup[flavor]:
                     self.lookup[flavor][product] = ProductFamily(product)
                 self.lookup[flavor][product].import_(products[flavor][product])
                 updated = True
+                self._journal(flavor, product, "import_", {flavor : {product : products[flavor][product]}})
                 self._flavorsUpdated(flavor)
 
         if self.autosave and updated: self.save()
@@ -465,10 +592,12 @@ class ProductStack:
         @return bool :
         """
         try:
+            self._journalBase(flavor, name)
             updated = self.lookup[flavor][name].removeVersion(version)
             if updated:
                 if len(self.lookup[flavor][name].getVersions()) == 0:
                     del self.lookup[flavor][name]
+                self._journal(flavor, name, "removeProduct", name, flavor, version)
                 self._flavorsUpdated(flavor)
                 if self.autosave: self.save(flavor)
         except KeyError:
@@ -519,9 +648,11 @@ class ProductStack:
             flavors = [flavors]
         for flavor in flavors:
             try:
+                self._journalBase(flavor, product)
                 self.lookup[flavor][product].assignTag(tag, version)
 #                if tag.startswith(userPrefix):
 #                    self._setUserTag(flavor, tag, product, version)
+                self._journal(flavor, product, "assignTag", tag, product, version, flavor)
                 notfound = False
             except KeyError:
                 pass
@@ -552,8 +683,10 @@ class ProductStack:
         updated = False
         for flavor in flavors:
             try:
+                self._journalBase(flavor, product)
                 if (self.lookup[flavor][product].unassignTag(tag)):
                     updated = True
+                    self._journal(flavor, product, "unassignTag", tag, product, flavor)
                     self._flavorsUpdated(flavor)
             except KeyError:
                 pass
@@ -617,7 +750,7 @@ class ProductStack:
                 except KeyError:
                     pass
 
-    def cacheIsUpToDate(self, flavor, cacheDir=None):
+    def cacheIsUpToDate(self, flavor, cacheDir=None, generation=None):
         """
         return True if there is a cache file on disk with product information
         for a given flavor which is newer than the information in the
@@ -625,6 +758,9 @@ class ProductStack:
         or otherwise appears out-of-date.
 
         Note that this is different from cacheIsInSync()
+        @param generation   the database's current generation, if known.  A cache
+                              recorded as being written from this generation is
+                              up-to-date without checking the database's files
         """
         if not cacheDir:
             cacheDir = self.dbpath
@@ -643,6 +779,10 @@ class ProductStack:
            Database(cacheDir).isNewerThan(cache_mtime):
             return False
 
+        if generation is not None and self._cacheGeneration(cache) == generation:
+            timing.count("stack cache generation matches")
+            return True
+
         # this is slightly inaccurate: if data for any flavor in the database
         # is newer than this time, this isNewerThan() returns True
         return not Database(self.dbpath).isNewerThan(cache_mtime)
@@ -674,8 +814,10 @@ class ProductStack:
                 except FileNotFoundError:
                     # Some other process deleted the file.
                     pass
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._generationFile(fileName))
 
-    def reload(self, flavors=None, persistDir=None, verbose=0):
+    def reload(self, flavors=None, persistDir=None, verbose=0, merge=False):
         """
         throw away all information on products and replace it with the data
         saved in the cache files.
@@ -686,6 +828,14 @@ class ProductStack:
         @param persistDir         the directory to find cached product data.
                                     If None, the directory set at construction
                                     time will be used.
+        @param merge              if True, the changes made to a flavor since
+                                    it was last saved are replayed on top of
+                                    the reloaded data, rather than being lost;
+                                    a flavor that was read from the database
+                                    isn't reloaded.  CacheOutOfSync is raised if
+                                    a change can't be replayed, or if a product
+                                    that was changed in both places doesn't
+                                    then agree with the database
         """
         if persistDir is None:
             persistDir = self._persistDir()
@@ -700,7 +850,12 @@ class ProductStack:
         if not isinstance(flavors, list):
             flavors = [flavors]
 
+        merged = []
         for flavor in flavors:
+            journal = self.journal.get(flavor, ([], {}))
+            if merge and journal is None:
+                continue
+
             fileName = self._persistPath(flavor,persistDir)
             try:
                 self.modtimes[fileName] = os.stat(fileName).st_mtime
@@ -713,6 +868,63 @@ class ProductStack:
                 self.modtimes.pop(fileName, None)
             else:
                 self.lookup[flavor] = lookup
+                self.journal.pop(flavor, None)
+                if merge and journal and journal[0]:
+                    merged.append((flavor, fileName, journal))
+
+        for flavor, fileName, journal in merged:
+            self._replay(flavor, fileName, *journal)
+
+    def _replay(self, flavor, fileName, ops, bases):
+        # reapply changes (see _journal()) to a flavor reloaded from fileName
+        timing.count("stack cache merges")
+
+        # the merged data isn't known to match any generation of the database
+        self.generation = None
+
+        # the products that someone else changed too
+        lookup = self.lookup.get(flavor, {})
+        names = set(name for name, method, args in ops)
+        conflicts = [n for n in names if _familyState(lookup.get(n)) != bases.get(n)]
+
+        autosave, self.autosave = self.autosave, False
+        try:
+            for name, method, args in ops:
+                getattr(self, method)(*args)
+        except ProductNotFound:
+            # e.g. a tag was assigned to a product that someone else removed
+            raise CacheOutOfSync([fileName], [flavor],
+                                 msg="Unable to merge changes into %s" % fileName)
+        finally:
+            self.autosave = autosave
+
+        if conflicts and not self._agreesWithDatabase(flavor, conflicts):
+            raise CacheOutOfSync([fileName], [flavor],
+                                 msg="Changes to %s in %s conflict with the database" %
+                                 (", ".join(sorted(conflicts)), fileName))
+
+    def _agreesWithDatabase(self, flavor, names):
+        # return True if our versions of the named products, and the global
+        # tags assigned to them, are those declared in the database
+        db = Database(self.dbpath)
+        for name in names:
+            ours = {}
+            family = self.lookup.get(flavor, {}).get(name)
+            if family:
+                for version in family.getVersions():
+                    ours[version] = set()
+                for tag, version in family.tags.items():
+                    if not tag.startswith(userPrefix):
+                        ours[version].add(tag)
+
+            theirs = {}
+            for product in db.findProducts(name, flavors=flavor):
+                theirs[product.version] = set(t for t in product.tags if not t.startswith(userPrefix))
+
+            if ours != theirs:
+                return False
+
+        return True
 
     @staticmethod
     def findCachedFlavors(dir):
@@ -736,6 +948,14 @@ class ProductStack:
         """
         db = Database(self.dbpath, userTagDir)
 
+        # caches written after this point may hold changes that we won't read
+        persistDir = self._persistDir()
+        if os.path.isdir(persistDir):
+            for flavor in self.findCachedFlavors(persistDir):
+                fileName = self._persistPath(flavor, persistDir)
+                with contextlib.suppress(FileNotFoundError):
+                    self.modtimes[fileName] = os.stat(fileName).st_mtime
+
         # forget!
         self.lookup = {}
 
@@ -743,6 +963,10 @@ class ProductStack:
             for product in db.findProducts(prodname):
                 self.addProduct(product)
 
+        # what we've read is the truth; nothing needs merging into a newer cache,
+        # but our changes can't be merged into one either (see save())
+        self.journal = dict.fromkeys(self.lookup)
+
     def _loadUserTags(self, userTagDir=None):
         if not userTagDir:
             userTagDir = self.persistDir
@@ -774,8 +998,9 @@ class ProductStack:
         return out
 
     @staticmethod
+    @timing.timed("ProductStack.fromCache")
     def fromCache(dbpath, flavors, persistDir=None, userTagDir=None,
-                  updateCache=True, autosave=True, verbose=0):
+                  updateCache=True, autosave=True, verbose=0, generation=None):
         """
         return a ProductStack that has all products loaded in from the
         available caches.  If they are out of date (or non-existent), this
@@ -799,9 +1024,15 @@ class ProductStack:
                                directory.
         @param userTagDir   the directory where user tag data is persisted
         @param updateCache  if true (default), update the caches if any
-                               appear out of date
+                               appear out of date, and record the generation
+                               of those found to be up to date
         @param autosave     if true (default), all updates will be
                                saved to disk.
+        @param generation   the database's generation (read before calling
+                               fromCache), if known.  Caches recorded as
+                               being of this generation are trusted without
+                               checking the database's files, and caches that
+                               we write are recorded as being of it
         """
         if not flavors:
             raise RuntimeError("ProductStack.fromCache(): at least one flavor needed as input" +
@@ -810,28 +1041,34 @@ class ProductStack:
             flavors = [flavors]
 
         out = ProductStack(dbpath, persistDir, False)
+        out.generation = generation
 
-        cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose)
+        cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose, updateCache=updateCache)
         if not cacheOkay:
-            cacheOkay = out._tryCache(dbpath, dbpath, flavors)
+            cacheOkay = out._tryCache(dbpath, dbpath, flavors, updateCache=updateCache)
             if cacheOkay:
                 out._loadUserTags(userTagDir)
 
         if not cacheOkay:
-            out.refreshFromDatabase(userTagDir)
+            timing.count("stack cache misses")
+            with timing.span("ProductStack.refreshFromDatabase"):
+                out.refreshFromDatabase(userTagDir)
             out._flavorsUpdated(flavors)
+            out.journal.update(dict.fromkeys(flavors))
             if updateCache:  out.save()
+        else:
+            timing.count("stack cache hits")
 
         out.autosave = autosave
         return out
 
-    def _tryCache(self, dbpath, cacheDir, flavors, verbose=0):
+    def _tryCache(self, dbpath, cacheDir, flavors, verbose=0, updateCache=True):
         if not cacheDir or not os.path.exists(cacheDir):
             return False
 
         cacheOkay = True
         for flav in flavors:
-            if not self.cacheIsUpToDate(flav, cacheDir):
+            if not self.cacheIsUpToDate(flav, cacheDir, self.generation):
                 cacheOkay = False
                 if verbose > 1:
                     print("Regenerating missing or out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
@@ -840,6 +1077,13 @@ class ProductStack:
         if cacheOkay:
             self.reload(flavors, cacheDir, verbose=verbose)
 
+            # if the caches we read were written from the database as it now
+            # is, there's no need to check that they're consistent with it
+            if self.generation is not None and \
+               all(self._cacheGeneration(self._persistPath(flav, cacheDir)) == self.generation
+                   for flav in flavors):
+                return True
+
             # do a final consistency check; do we have the same products
             dbnames = Database(dbpath).findProductNames()
             dbnames.sort()
@@ -854,9 +1098,24 @@ class ProductStack:
                 self.lookup = {}   # forget loaded data
                 if verbose:
                   print("Regenerating out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+            elif self.generation is not None and updateCache:
+                # the caches are as new as the database was when we read its
+                # generation, so save the next reader the trouble of checking
+                for flav in flavors:
+                    cache = self._persistPath(flav, cacheDir)
+                    if cache in self.modtimes:
+                        self._recordGeneration(cache, self.generation, self.modtimes[cache])
 
         return cacheOkay
 
+def _familyState(family):
+    # return a summary of a ProductFamily's versions (leaving out their tables)
+    # and tags, to tell whether it's been changed
+    if family is None:
+        return None
+    return (dict((v, rec[:4] + rec[5:]) for v, rec in family.versions.items()),
+            dict(family.tags))
+
 def _uniquify(lis):
     for i in xrange(len(lis)):
         item = lis.pop(0)
@@ -13,11 +13,12 @@ from .tags       import TagNotRecognized
 from .VersionParser import VersionParser
 from . import utils
 from . import hooks
+from . import timing
 
 class Table:
     """A class that represents a eups table file"""
 
-    def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0):
+    def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0, eupsenv=None):
         """
         Parse a tablefile
         @param  tableFile          the tablefile we're reading
@@ -25,6 +26,8 @@ class Table:
         @param  addDefaultProduct  if True or None, automatically add a
                                      "setupOptional" action for the product
                                      specified in hooks.config.Eups.defaultProduct
+        @param  eupsenv            the Eups instance we're reading it for; its
+                                     defaultProduct is checked first
         @throws TableError       if an IOError occurs while reading the table file
         @throws BadTableContent  if the table file parser encounters unparseable
                                    content.  Note that BadTableContent is a subclass
@@ -37,7 +40,11 @@ class Table:
         self._actions = []
 
         if utils.isRealFilename(tableFile):
-            self._read(tableFile, addDefaultProduct, verbose, topProduct)
+            if addDefaultProduct is not False and eupsenv is not None:
+                eupsenv.checkDefaultProduct()
+            with timing.span("Table.parse", file=tableFile):
+                self._read(tableFile, addDefaultProduct, verbose, topProduct)
+            timing.count("tables parsed")
 
     def _rewrite(self, contents):
         """Rewrite the contents of a tablefile to the canonical form; each
@@ -545,6 +552,7 @@ but no other interpretation is applied
 
         if Eups is None:
             Eups = eups.Eups()
+        Eups.checkDefaultProduct()
 
         if followExact is None:
             followExact = Eups.exact_version
@@ -589,7 +597,7 @@ but no other interpretation is applied
                         thisProduct = [val for val in deps if val[0].name == productName][0][0]
                     except IndexError:
                         continue
-                    table = thisProduct.getTable()
+                    table = thisProduct.getTable(eupsenv=Eups)
 
                     unsetupProducts = [thisProduct.name]
                     if table and not extraArgs["noRecursion"]:
@@ -634,7 +642,7 @@ but no other interpretation is applied
 
                     if recursive and not extraArgs["noRecursion"] and prodkey(product) not in recursiveDict:
                         recursiveDict[prodkey(product)] = 1
-                        deptable = product.getTable(addDefaultProduct=addDefaultProduct)
+                        deptable = product.getTable(addDefaultProduct=addDefaultProduct, eupsenv=Eups)
                         if deptable:
                             deps += deptable.dependencies(Eups, eupsPathDirs, recursiveDict,
                                                           recursionDepth + 1, followExact, productDictionary,
@@ -245,14 +245,8 @@ class Tags:
 
         if not file:
             file = self._persistPath(group)
-        try:
-            fd = open(file, "w")
+        with utils.AtomicFile(file, "w") as fd:
             print(" ".join(self.bygrp[group]), file=fd)
-        finally:
-            try:
-                fd.close()
-            except Exception:
-                pass
 
     def loadFromEupsPath(self, eupsPath, verbosity=0):
         """
@@ -572,7 +566,7 @@ def getUserDefinedTags(user):
 
     myGlobals["hooks"] = Foo()
     myGlobals["hooks"].config = Foo()
-    myGlobals["hooks"].config.distrib = dict(builder = dict(variables = {}))
+    myGlobals["hooks"].config.distrib = dict(builder = dict(variables = {}), transport = {}, eupspkg = {})
     myEups = Foo()
     myGlobals["hooks"].config.Eups = myEups
     myGlobals["eups"] = Foo()
@@ -602,28 +596,58 @@ def getUserDefinedTags(user):
     return theirTags
 
 def cloneTag(eupsenv, newTag, oldTag, productList=[]):
+    """
+    Assign newTag to all the products tagged oldTag (or just those in productList, if it isn't
+    empty), removing it from any other versions of those products;  return a list of the products
+    that couldn't be tagged.  Each chain file is written once, replacing the version that newTag
+    was assigned to, and the product caches are updated once
+    """
     checkTagsList(eupsenv, [newTag, oldTag])
 
-    productsToTag = productList          # may be []
-    failedToTag = []                      # products we failed to tag
+    # where newTag's currently assigned
+    tagged = {}
+    for p in eupsenv.findProducts(tags=[newTag]):
+        tagged.setdefault(p.name, []).append(p)
+
+    # the flavors of each (product, version, stack) that's tagged oldTag
+    toTag = {}
     for p in eupsenv.findProducts(tags=[oldTag]):
-        if productList and p.name not in productList:
-            continue
+        if not productList or p.name in productList:
+            toTag.setdefault((p.name, p.version, p.stackRoot()), []).append(p)
 
-        try:
-            eupsenv.declare(p.name, p.version, tag=newTag)
-        except EupsException as e:
-            print(e, file=utils.stderr)
-            failedToTag.append(p.name)
+    failedToTag = []                      # products we failed to tag
+    with eupsenv.transaction(sorted(set(name for name, version, root in toTag))):
+        for (name, version, root), products in toTag.items():
+            flavors = [p.flavor for p in products]
+            try:
+                for q in tagged.get(name, []):
+                    if q.stackRoot() != root or q.flavor not in flavors:
+                        eupsenv.unassignTag(newTag, q.name, q.version, q.stackRoot())
+                    elif q.version == version:
+                        flavors.remove(q.flavor)        # already tagged
+
+                if flavors:
+                    if eupsenv.verbose:
+                        print("Tagging %-40s %s" % (name, version), file=utils.stdinfo)
+                    eupsenv.setTaggedVersion(newTag, products[0], flavors)
+            except EupsException as e:
+                print(e, file=utils.stderr)
+                failedToTag.append(name)
 
     return failedToTag
 
 def deleteTag(eupsenv, tag):
+    """
+    Unassign tag from all the products that have it.  The chain files are written in one pass, and
+    the product caches updated once
+    """
     checkTagsList(eupsenv, [tag])
 
-    for p in eupsenv.findProducts(tags=[tag]):
-        if eupsenv.verbose:
-            print("Untagging %-40s %s" % (p.name, p.version), file=utils.stdinfo)
-        eupsenv.undeclare(p.name, p.version, tag=tag)
+    products = eupsenv.findProducts(tags=[tag])
+    with eupsenv.transaction([p.name for p in products]):
+        for p in products:
+            if eupsenv.verbose:
+                print("Untagging %-40s %s" % (p.name, p.version), file=utils.stdinfo)
+            eupsenv.unassignTag(tag, p.name, p.version, p.stackRoot())
 
 __all__ = "Tags Tag TagNotRecognized TagNameConflict cloneTag deleteTag".split()
@@ -0,0 +1,221 @@
+"""
+Lightweight instrumentation of where eups spends its time.
+
+Code marks the phases of its work as (nested) spans, and counts events of
+interest:
+
+    with timing.span("ProductStack.fromCache", dbpath=dbpath):
+        ...
+    timing.count("tables parsed")
+
+or decorates a function with @timing.timed("name").  Both do (almost)
+nothing unless timing has been enabled with --debug=timing, in which case a
+tree of the time spent in each phase, and the counters, are written to
+stderr when the process exits; with --debug=timing[file.json] the spans are
+written to file.json in Chrome's trace event format (for chrome://tracing or
+https://ui.perfetto.dev) instead.
+
+N.b. this module mustn't import the rest of eups, as it's used everywhere.
+"""
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+
+_enabled = False
+_traceFile = None                       # write a Chrome trace here rather than a tree to stderr
+_root = None                            # the root of the tree of spans
+_start = None                           # when timing was enabled
+_counters = {}
+_events = []                            # the spans, for the Chrome trace
+_lock = threading.Lock()
+_local = threading.local()              # the current span in each thread
+_atexitRegistered = False
+
+class _Node:
+    """The time spent in all calls of a span with a given parent"""
+    __slots__ = ("name", "total", "calls", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.total = 0.0
+        self.calls = 0
+        self.children = {}
+
+    def child(self, name):
+        with _lock:
+            try:
+                return self.children[name]
+            except KeyError:
+                node = self.children[name] = _Node(name)
+                return node
+
+class _Span:
+    """A context manager that times a phase and adds it to the tree"""
+    __slots__ = ("name", "args", "node", "parent", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.parent = getattr(_local, "node", _root)
+        self.node = self.parent.child(self.name)
+        _local.node = self.node
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _local.node = self.parent
+        with _lock:
+            self.node.total += end - self.start
+            self.node.calls += 1
+            if _traceFile:
+                event = dict(name=self.name, ph="X", pid=os.getpid(), tid=threading.get_ident(),
+                             ts=int(1e6*self.start), dur=int(1e6*(end - self.start)))
+                if self.args:
+                    event["args"] = dict((k, str(v)) for k, v in self.args.items())
+                _events.append(event)
+        return False
+
+class _NullSpan:
+    """What span() returns when timing isn't enabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_nullSpan = _NullSpan()
+
+def isEnabled():
+    """Return True iff timing is enabled"""
+    return _enabled
+
+def enable(traceFile=None, name=None):
+    """
+    Start timing, reporting the results when the process exits
+    @param traceFile   if not None, write the spans to this file in Chrome's
+                         trace event format rather than writing a tree to stderr
+    @param name        the name of the root of the tree (default: the command line)
+    """
+    global _enabled, _traceFile, _root, _start, _atexitRegistered
+    if _enabled:
+        return
+
+    _enabled = True
+    _traceFile = traceFile
+    _root = _Node(name if name else " ".join([os.path.basename(sys.argv[0])] + sys.argv[1:]))
+    _root.calls = 1
+    _start = time.perf_counter()
+
+    if not _atexitRegistered:
+        atexit.register(report)
+        _atexitRegistered = True
+
+def disable():
+    """Stop timing, discarding the results"""
+    global _enabled, _traceFile, _root
+    _enabled = False
+    _traceFile = None
+    _root = None
+    _local.__dict__.clear()
+    with _lock:
+        _counters.clear()
+        del _events[:]
+
+def span(name, **args):
+    """
+    Return a context manager that times the enclosed code as a span with the
+    given name; any keyword arguments are recorded in the Chrome trace
+    """
+    if not _enabled:
+        return _nullSpan
+    return _Span(name, args)
+
+def timed(name=None, argName=None):
+    """
+    A decorator that times each call of a function as a span (default name:
+    the function's qualified name)
+    @param argName   if not None, the name of one of the function's arguments;
+                       its value is appended to the span's name (e.g.
+                       timed("setup", "productName") gives "setup afw")
+    """
+    def decorate(func):
+        spanName = name if name else func.__qualname__
+        argIndex = None
+        if argName:
+            argIndex = func.__code__.co_varnames[:func.__code__.co_argcount].index(argName)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            fullName = spanName
+            if argName:
+                val = kwargs[argName] if argName in kwargs else \
+                      args[argIndex] if argIndex < len(args) else None
+                fullName = "%s %s" % (spanName, val)
+            with _Span(fullName, None):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+def count(name, n=1):
+    """Add n to the counter with the given name"""
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def getCounters():
+    """Return a copy of the counters"""
+    with _lock:
+        return dict(_counters)
+
+def report(strm=None):
+    """
+    Write the timing tree and counters to strm (default: stderr), or the
+    Chrome trace to the file given to enable()
+    """
+    if not _enabled:
+        return
+    elapsed = time.perf_counter() - _start
+
+    if _traceFile:
+        with _lock:
+            events = list(_events)
+            events.append(dict(name=_root.name, ph="X", pid=os.getpid(), tid=threading.get_ident(),
+                               ts=int(1e6*_start), dur=int(1e6*elapsed)))
+            for name, value in sorted(_counters.items()):
+                events.append(dict(name=name, ph="C", pid=os.getpid(), ts=int(1e6*(_start + elapsed)),
+                                   args={"value" : value}))
+        import json
+        with open(_traceFile, "w") as fd:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), fd)
+        return
+
+    if strm is None:
+        strm = sys.stderr
+
+    print("Timing (seconds):", file=strm)
+    print("%10s %8s  %s" % ("total", "calls", "span"), file=strm)
+
+    def printNode(node, total, depth):
+        print("%10.4f %8d  %s%s" % (total, node.calls, "  "*depth, node.name), file=strm)
+        children = sorted(node.children.values(), key=lambda n: n.total, reverse=True)
+        for child in children:
+            printNode(child, child.total, depth + 1)
+
+    printNode(_root, elapsed, 0)
+
+    if _counters:
+        print("Counters:", file=strm)
+        width = max(len(k) for k in _counters)
+        for name, value in sorted(_counters.items()):
+            print("  %-*s %10d" % (width, name, value), file=strm)
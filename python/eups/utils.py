@@ -11,6 +11,8 @@ import shutil
 import tempfile
 import pwd
 
+from . import timing
+
 
 # Python 3.x versions
 import io as StringIO
@@ -266,6 +268,31 @@ def ctimeTZ(t=None):
 
     return time.strftime("%Y/%m/%d %H:%M:%S %Z", t)
 
+_existingPaths = set()
+
+def pathExists(path):
+    """
+    Return True iff path exists, remembering paths that do so that they
+    needn't be checked again (such checks are slow on network filesystems).
+    Paths that don't exist aren't remembered, as they may be created (e.g.
+    by installing a product) later in the process.
+    """
+    if path in _existingPaths:
+        timing.count("stat cache hits")
+        return True
+    timing.count("files stat'ed")
+    if os.path.exists(path):
+        _existingPaths.add(path)
+        return True
+    return False
+
+def clearStatCache():
+    """
+    Forget the paths that pathExists() has seen, e.g. because files may have
+    been removed
+    """
+    _existingPaths.clear()
+
 def isRealFilename(filename):
     """
     Return True iff "filename" is a real filename, not a placeholder.
@@ -354,6 +381,28 @@ def determineFlavor():
 
     return flav
 
+def determineShell(shell=None):
+    """
+    Return the type of shell we're running ("sh", "csh" or "zsh")
+    @param shell   the shell's name (default: $EUPS_SHELL)
+    """
+    from .exceptions import EupsException
+
+    if not shell:
+        try:
+            shell = os.environ["EUPS_SHELL"]
+        except KeyError:
+            raise EupsException("I cannot guess what shell you're running as $EUPS_SHELL isn't set")
+
+    if re.search(r"(^|/)(bash|ksh|sh)$", shell):
+        return "sh"
+    elif re.search(r"(^|/)(csh|tcsh)$", shell):
+        return "csh"
+    elif re.search(r"(^|/)(zsh)$", shell):
+        return "zsh"
+    else:
+        raise EupsException("Unknown shell type %s" % shell)
+
 def guessProduct(dir, productName=None):
     """Guess a product name given a directory containing table files.  If you provide productName,
     it'll be chosen if present; otherwise if dir doesn't contain exactly one product we'll raise RuntimeError"""
@@ -585,13 +634,18 @@ def copyfile(file1, file2):
 
     if issamefile(file1, file2):
         return
-
+    #
+    # Copy to a temporary file and rename it, so anyone reading file2 sees either the old or new contents
+    #
+    dir, base = os.path.split(file2)
+    fd, tmpFile = tempfile.mkstemp(dir=dir if dir else ".", prefix=".%s." % base, suffix=".tmp")
+    os.close(fd)
     try:
-        os.unlink(file2)
-    except OSError:
-        pass
-
-    shutil.copy2(file1, file2)
+        shutil.copy2(file1, tmpFile)
+        os.rename(tmpFile, file2)
+    except BaseException:
+        os.unlink(tmpFile)
+        raise
 
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -907,10 +961,16 @@ def AtomicFile(fn: str, mode: str):
     or not at all.  Useful for avoiding race conditions where a reader
     may be trying to read from a file that's still being written to.
 
-    This is accomplished by creating a temporary file into which all the
-    writes are directed, and then renaming it to the destination
-    filename on close().  On POSIX-compliant filesystems, the rename is
-    guaranteed to be atomic.
+    This is accomplished by creating a temporary file (in the same
+    directory) into which all the writes are directed, and then renaming it
+    to the destination filename on close().  On POSIX-compliant filesystems,
+    the rename is guaranteed to be atomic.  The file gets the permissions of
+    the file it replaces (or those allowed by the umask), and nothing is
+    changed if the block raises.
+
+    The file is fsync()ed before it's renamed, so a crash can't leave it
+    empty.  In an fsyncBatch() the directories written to are fsync()ed too,
+    once each when the batch ends, making the renames durable.
 
     Should be used as a context manager.
 
@@ -919,20 +979,87 @@ def AtomicFile(fn: str, mode: str):
         with AtomicFile("myfile.txt", "w") as fd:
             print("Some text", file=fd)
     """
-    dir = os.path.dirname(fn)
+    dir, base = os.path.split(fn)
+
+    try:
+        perms = os.stat(fn).st_mode & 0o7777
+    except OSError:
+        perms = 0o666 & ~_umask
 
     with tempfile.NamedTemporaryFile(
-        prefix=dir, suffix=".tmp", delete=False, mode=mode,
+        dir=dir if dir else ".", prefix=".%s." % base, suffix=".tmp", delete=False, mode=mode,
     ) as fh:
-        yield fh
-
-        # Needed because fclose() doesn't guarantee fsync()
-        # in POSIX, which may lead to interesting issues (e.g., see
-        # http://thunk.org/tytso/blog/2009/03/12/delayed-allocation-and-the-zero-length-file-problem/ )
-        os.fsync(fh)
+        try:
+            yield fh
+
+            fh.flush()
+            # Needed because fclose() doesn't guarantee fsync()
+            # in POSIX, which may lead to interesting issues (e.g., see
+            # http://thunk.org/tytso/blog/2009/03/12/delayed-allocation-and-the-zero-length-file-problem/ )
+            os.fsync(fh)
+            os.fchmod(fh.fileno(), perms)
+        except BaseException:
+            fh.close()
+            os.unlink(fh.name)
+            raise
 
     os.rename(fh.name, fn)
 
+    if _fsyncBatch is not None:
+        _fsyncBatch.append(dir if dir else ".")
+
+try:
+    _fsyncBatch
+except NameError:
+    _fsyncBatch = None                  # directories written by AtomicFile in an fsyncBatch(), still to be fsync()ed
+
+try:
+    _umask
+except NameError:
+    _umask = os.umask(0o022)            # os.umask() is the only way to read the umask, and it isn't thread-safe
+    os.umask(_umask)
+
+@contextlib.contextmanager
+def fsyncBatch():
+    """
+    A context manager within which AtomicFile doesn't fsync() the directory of each file it writes;
+    they are synced once each when the outermost batch ends, or fsyncPending() is called.
+
+    The files themselves are synced before they're renamed into place, so after a crash each holds
+    either its old or its new contents, but the renames made in the batch aren't durable until it ends
+    """
+    global _fsyncBatch
+    if _fsyncBatch is not None:
+        yield
+        return
+
+    _fsyncBatch = []
+    try:
+        yield
+    finally:
+        fsyncPending()
+        _fsyncBatch = None
+
+def fsyncPending():
+    """fsync() the directories written so far in an fsyncBatch() (a no-op if there isn't one)"""
+    if not _fsyncBatch:
+        return
+
+    dirs = list(dict.fromkeys(_fsyncBatch)) # unique, preserving order
+    del _fsyncBatch[:]
+
+    for dirName in dirs:
+        try:
+            fd = os.open(dirName, os.O_RDONLY)
+        except OSError:                 # it's been removed since, which is fine
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
 
 def isSubpath(path, root):
     """!Return True if path is root or in root
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""
+Time common eups operations against a synthetic product stack.
+
+A stack is generated on local disk with a configurable number of products,
+versions, tags and flavors.  Each flavor's products form a dependency DAG
+arranged in layers: every product depends on a few products in the next
+layer, so the first product ("the deep product") requires all the rest
+directly or indirectly.
+
+The operations are run in-process (as the eups and setup commands would
+run them), except that the time taken to import the modules needed by the
+setup and eups commands is measured in a new process with python -X
+importtime.  Each is run several times; the fastest time for each is reported and,
+with --output, written to a JSON file.  Given the results of an earlier run
+with --baseline, the script exits with status 1 if any operation has become
+more than --threshold times slower.  For example
+
+    python tests/benchEups.py -o baseline.json
+    ...
+    python tests/benchEups.py -b baseline.json -t 1.2
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+import platform
+import subprocess
+from optparse import OptionParser
+import testCommon
+
+import eups
+import eups.cmd
+import eups.setupcmd
+import eups.hooks as hooks
+from eups.db import VersionFile, ChainFile
+
+def productName(i):
+    return "prod%04d" % i
+
+def versionName(j):
+    return "%d.%d" % (1 + j//10, j % 10)
+
+def makeStack(root, nproduct=100, nversion=3, ntag=2, depth=5, fanout=3, flavors=["Linux64"]):
+    """
+    Create a synthetic stack in root, returning the names of its products
+    @param nproduct   the number of products
+    @param nversion   the number of versions of each product
+    @param ntag       the number of global tags (tag0, tag1, ...), each
+                        applied to one version of every product; the
+                        newest version is also tagged "current"
+    @param depth      the number of layers in the dependency DAG
+    @param fanout     the number of products in the next layer that each
+                        product depends on
+    @param flavors    the flavors to declare the products for
+    """
+    dbpath = os.path.join(root, "ups_db")
+    os.makedirs(os.path.join(root, "site"))
+    with open(os.path.join(root, "site", "startup.py"), "w") as fd:
+        print("hooks.config.Eups.globalTags += %s" % (["tag%d" % t for t in range(ntag)],), file=fd)
+
+    width = max(1, -(-nproduct//depth))
+    names = [productName(i) for i in range(nproduct)]
+    for i, name in enumerate(names):
+        layer = i//width
+        first = (layer + 1)*width
+        deps = names[first:first + width][i % width:][:fanout] if first < nproduct else []
+
+        os.makedirs(os.path.join(dbpath, name))
+        for j in range(nversion):
+            version = versionName(j)
+            vfile = VersionFile(os.path.join(dbpath, name, "%s.version" % version), name, version,
+                                readFile=False)
+            for flavor in flavors:
+                pdir = os.path.join(root, flavor, name, version)
+                os.makedirs(os.path.join(pdir, "ups"))
+                with open(os.path.join(pdir, "ups", "%s.table" % name), "w") as fd:
+                    for dep in deps:
+                        print("setupRequired(%s)" % dep, file=fd)
+                    print("envPrepend(PATH, ${PRODUCT_DIR}/bin)", file=fd)
+                vfile.addFlavor(flavor, pdir, "%s.table" % name, "ups")
+            vfile.write(trimDir=root)
+
+        tags = [("tag%d" % t, versionName(t % nversion)) for t in range(ntag)]
+        tags.append(("current", versionName(nversion - 1)))
+        for tag, version in tags:
+            cfile = ChainFile(os.path.join(dbpath, name, "%s.chain" % tag), name, tag, readFile=False)
+            cfile.setVersion(version, flavors)
+            cfile.write()
+
+    return names
+
+def clearCache(root, userDataDir):
+    """remove the caches of root's stack"""
+    for d in (os.path.join(root, "ups_db"), userDataDir):
+        for dirpath, dirnames, filenames in os.walk(d):
+            for f in filenames:
+                if f.endswith(".pickleDB") or ".pickleDB" in f:
+                    os.unlink(os.path.join(dirpath, f))
+
+def eupsCmd(args):
+    """run an eups command, discarding its output"""
+    out = io.StringIO()
+    argv = sys.argv
+    sys.argv = ["eups"] + args.split()  # the subcommands parse sys.argv
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            eups.cmd._errstrm = out
+            status = eups.cmd.EupsCmd(args=sys.argv[1:], toolname="eups").run()
+    finally:
+        eups.cmd._errstrm = sys.stderr
+        sys.argv = argv
+    if status:
+        raise RuntimeError("eups %s failed: %s" % (args, out.getvalue()))
+
+def setupCmd(args):
+    """run a setup command, restoring the environment afterwards"""
+    environ = os.environ.copy()
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            status = eups.setupcmd.EupsSetup(args=args.split(), toolname="setup").run()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+    if status:
+        raise RuntimeError("setup %s failed: %s" % (args, out.getvalue()))
+
+def importTime(module):
+    """return the time taken to import module in a new python process,
+    as reported by python -X importtime"""
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(testCommon.EUPS_DIR, "python")] +
+                                        [p for p in [env.get("PYTHONPATH")] if p])
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                          env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in proc.stderr.splitlines():
+        fields = [f.strip() for f in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return 1e-6*int(fields[1])
+
+    raise RuntimeError("Unable to find the time taken to import %s" % module)
+
+def loadStacks():
+    """construct an Eups and read its product stacks (which it does lazily)"""
+    myeups = eups.Eups()
+    for p in myeups.path:
+        if p in myeups.versions:
+            myeups.versions[p]
+
+def bestOf(func, nrepeat, prepare=None):
+    """return the shortest of nrepeat times taken by func(), calling
+    prepare() (untimed) before each.  If func returns a number, it's
+    taken to be the time to use"""
+    best = None
+    for i in range(nrepeat):
+        if prepare:
+            prepare()
+        t0 = time.perf_counter()
+        dt = func()
+        if not isinstance(dt, float):
+            dt = time.perf_counter() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+def run(opts, out=sys.stdout):
+    """run the benchmarks, returning a dictionary of their times"""
+    tmpdir = tempfile.mkdtemp(prefix="benchEups")
+    environ = os.environ.copy()
+    try:
+        root = os.path.join(tmpdir, "stack")
+        installRoot = os.path.join(tmpdir, "install")
+        pkgroot = os.path.join(tmpdir, "pkgroot")
+        userDataDir = os.path.join(tmpdir, "userdata")
+        for d in (installRoot, userDataDir):
+            os.makedirs(os.path.join(d, "ups_db") if d == installRoot else d)
+
+        flavors = opts.flavors.split(",")
+        flavor = flavors[0]
+        t0 = time.perf_counter()
+        names = makeStack(root, opts.nproduct, opts.nversion, opts.ntag, opts.depth, opts.fanout, flavors)
+        if out:
+            print("Created %d products x %d versions x %d flavors in %.1fs" %
+                  (len(names), opts.nversion, len(flavors), time.perf_counter() - t0), file=out)
+
+        os.environ["EUPS_PATH"] = root
+        os.environ["EUPS_FLAVOR"] = flavor
+        os.environ["EUPS_USERDATA"] = userDataDir
+        os.environ["EUPS_SHELL"] = "sh"
+        os.environ["EUPS_DIR"] = testCommon.EUPS_DIR
+        hooks.loadCustomization(path=[root], reset=True)
+        eups.Eups.setEupsPath(root)
+
+        deep = names[0]
+        leaf = names[-1]
+        # a product a layer above the bottom of the DAG, to install with its dependencies
+        width = max(1, -(-opts.nproduct//opts.depth))
+        distribProduct = names[max(0, len(names) - 1 - width)]
+        version = versionName(opts.nversion - 1)
+
+        def declare():
+            pdir = os.path.join(root, flavor, leaf, version)
+            eupsCmd("declare -r %s -m %s newprod 1.0" % (pdir, os.path.join(pdir, "ups", "%s.table" % leaf)))
+            eupsCmd("undeclare newprod 1.0")
+
+        def distribInstall():
+            eupsCmd("distrib install -r %s -Z %s --nolocks %s %s" % (pkgroot, installRoot,
+                                                                     distribProduct, version))
+
+        createRoot = os.path.join(tmpdir, "created")
+
+        def distribCreate():
+            eupsCmd("distrib create -d tarball -s %s --nolocks -f %s %s %s" % (createRoot, flavor, deep, version))
+
+        def cleanCreate():
+            if os.path.exists(createRoot):
+                shutil.rmtree(createRoot)
+
+        def cleanInstall():
+            """remove the installed products, but not the cached server configuration"""
+            for d in os.listdir(installRoot):
+                if d != "ups_db":
+                    shutil.rmtree(os.path.join(installRoot, d))
+            dbpath = os.path.join(installRoot, "ups_db")
+            for d in os.listdir(dbpath):
+                if not d.startswith("_"):
+                    shutil.rmtree(os.path.join(dbpath, d))
+
+        benchmarks = [
+            ("import (setup)", lambda: importTime("eups.setupcmd"), None),
+            ("import (eups)", lambda: importTime("eups.cmd"), None),
+            ("Eups()", lambda: eups.Eups(), None),
+            ("cache build (cold)", loadStacks, lambda: clearCache(root, userDataDir)),
+            ("cache load (warm)", loadStacks, None),
+            ("setup deep product", lambda: setupCmd(deep), None),
+            ("setup 5 products", lambda: setupCmd(" + ".join(names[::max(1, len(names)//5)][:5])), None),
+            ("eups list", lambda: eupsCmd("list"), None),
+            ("eups list -D --topological", lambda: eupsCmd("list -D --topological %s %s" % (deep, version)), None),
+            ("eups uses", lambda: eupsCmd("uses %s" % leaf), None),
+            ("declare/undeclare", declare, None),
+            ("distrib create", distribCreate, cleanCreate),
+            ("distrib install", distribInstall, cleanInstall),
+        ]
+        if opts.only:
+            benchmarks = [b for b in benchmarks if opts.only in b[0]]
+
+        if [b for b in benchmarks if b[0] == "distrib install"]:
+            eupsCmd("distrib create -d tarball -s %s --nolocks -f %s %s %s" %
+                    (pkgroot, flavor, distribProduct, version))
+
+        results = {}
+        for name, func, prepare in benchmarks:
+            results[name] = bestOf(func, opts.nrepeat, prepare)
+            if out:
+                print("%-30s %8.3fs" % (name, results[name]), file=out)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(tmpdir)
+
+    return results
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    """return the names of the operations in results that are more than
+    threshold times slower than in baseline"""
+    regressions = []
+    if out:
+        print("%-30s %9s %9s %6s" % ("", "baseline", "current", "ratio"), file=out)
+    for name, dt in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = dt/baseline[name] if baseline[name] > 0 else 1
+        if ratio > threshold:
+            regressions.append(name)
+        if out:
+            print("%-30s %8.3fs %8.3fs %6.2f%s" % (name, baseline[name], dt, ratio,
+                                                  " REGRESSION" if ratio > threshold else ""), file=out)
+    return regressions
+
+if __name__ == "__main__":
+    cli = OptionParser(usage="%prog [options]")
+    cli.add_option("-p", "--products", type="int", dest="nproduct", default=200,
+                   help="the number of products in the stack")
+    cli.add_option("-v", "--versions", type="int", dest="nversion", default=5,
+                   help="the number of versions of each product")
+    cli.add_option("-T", "--tags", type="int", dest="ntag", default=2,
+                   help="the number of global tags")
+    cli.add_option("-d", "--depth", type="int", dest="depth", default=6,
+                   help="the number of layers in the dependency DAG")
+    cli.add_option("-w", "--fanout", type="int", dest="fanout", default=3,
+                   help="the number of dependencies of each product")
+    cli.add_option("-f", "--flavors", dest="flavors", default="Linux64",
+                   help="comma-separated list of flavors to declare products for")
+    cli.add_option("-n", "--repeat", type="int", dest="nrepeat", default=3,
+                   help="the number of times to run each operation")
+    cli.add_option("--only", dest="only", default=None,
+                   help="only run operations whose names contain this string")
+    cli.add_option("-o", "--output", dest="output", default=None,
+                   help="write the results to this JSON file")
+    cli.add_option("-b", "--baseline", dest="baseline", default=None,
+                   help="compare the results with this JSON file written by an earlier run")
+    cli.add_option("-t", "--threshold", type="float", dest="threshold", default=1.25,
+                   help="fail if an operation is more than this many times slower than the baseline")
+    (cli.opts, cli.args) = cli.parse_args()
+
+    results = run(cli.opts)
+    parameters = dict((k, getattr(cli.opts, k)) for k in
+                      ("nproduct", "nversion", "ntag", "depth", "fanout", "flavors"))
+
+    if cli.opts.output:
+        with open(cli.opts.output, "w") as fd:
+            json.dump(dict(results=results, parameters=parameters, python=platform.python_version()),
+                      fd, indent=2, sort_keys=True)
+
+    if cli.opts.baseline:
+        with open(cli.opts.baseline) as fd:
+            baseline = json.load(fd)
+        if baseline.get("parameters") != parameters:
+            print("Warning: the baseline was measured with different parameters: %s" %
+                  baseline.get("parameters"), file=sys.stderr)
+        regressions = compare(results, baseline["results"], cli.opts.threshold)
+        if regressions:
+            print("Regressions (more than %gx slower): %s" % (cli.opts.threshold, ", ".join(regressions)),
+                  file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Measure the memory used by a synthetic product stack's cached data, and by
+the Products handed out from it.
+
+The stack's families are pickled (as a ProductStack's cache is) and loaded
+several times, as happens when a process reads the caches of several stacks
+or users; the result is compared with holding the same data as the plain
+dictionaries and tuples used by earlier versions.  The Products are compared
+with plain objects that, as before, share their paths with the cache; now
+that the cache doesn't store the paths, Products have their own copies.
+"""
+
+import sys
+import os
+import pickle
+import tracemalloc
+import types
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+from eups.stack import ProductFamily
+
+def makeFamilies(nproduct, nversion, root="/software/stack/Linux64"):
+    """return a dictionary of ProductFamilys describing a synthetic stack"""
+    families = {}
+    for i in range(nproduct):
+        name = "product%04d" % i
+        fam = ProductFamily(name)
+        for j in range(nversion):
+            version = "w.2024.%02d+%d" % (j, i % 7)
+            dir = "%s/%s/%s" % (root, name, version)
+            fam.addVersion(version, dir, "%s/ups/%s.table" % (dir, name))
+        fam.assignTag("current", version)
+        fam.assignTag("user:latest", version)
+        families[name] = fam
+
+    return families
+
+def measure(func):
+    """return func()'s result and the memory (in bytes) it retains"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return result, after - before
+
+def legacyState(family):
+    """return the data that earlier versions cached for a ProductFamily"""
+    versions = {}
+    for v in family.getVersions():
+        prod = family.getProduct(v)
+        versions[v] = (prod.dir, prod.tablefile, prod._table)
+
+    return dict(name=family.name, versions=versions, tags=family.tags)
+
+def legacyProducts(families, dbpath, flavor):
+    """return plain objects carrying the same attributes as the Products
+    that earlier versions made from cached families' data"""
+    out = []
+    for name, state in families.items():
+        for version, (dir, tablefile, table) in state["versions"].items():
+            tags = [t for t, v in state["tags"].items() if v == version]
+            out.append(types.SimpleNamespace(name=name, version=version, flavor=flavor, dir=dir,
+                                             ups_dir=None, tablefile=tablefile, db=dbpath,
+                                             _table=table, _tags=tags, _prodStack=None))
+    return out
+
+def run(nproduct, nversion, ncache, out=sys.stdout):
+    families = makeFamilies(nproduct, nversion)
+    cache = pickle.dumps(families, protocol=4)
+    legacyCache = pickle.dumps(dict((n, legacyState(f)) for n, f in families.items()), protocol=4)
+    del families
+
+    def load():
+        fams = pickle.loads(cache)
+        for fam in fams.values():       # build the indexes that aren't persisted
+            fam.getProduct(fam.getVersions()[0])
+        return fams
+
+    loaded, size = measure(lambda: [load() for i in range(ncache)])
+    legacy, legacySize = measure(lambda: [pickle.loads(legacyCache) for i in range(ncache)])
+
+    dbpath, flavor = "/software/stack/ups_db", "Linux64"
+    fams = loaded[0]
+    products, productSize = measure(lambda: [fams[n].getProduct(v, dbpath, flavor)
+                                             for n in fams for v in fams[n].getVersions()])
+    plain, plainSize = measure(lambda: legacyProducts(legacy[0], dbpath, flavor))
+
+    print("%d products x %d versions, %d caches loaded" % (nproduct, nversion, ncache), file=out)
+    print("%-20s %12s %12s %8s" % ("", "legacy", "current", "saving"), file=out)
+    for what, old, new in [("cached stack", legacySize, size),
+                           ("Products", plainSize, productSize)]:
+        print("%-20s %10.1fMB %10.1fMB %7.0f%%" % (what, old/2**20, new/2**20, 100*(1 - new/old)),
+              file=out)
+
+    return legacySize, size, plainSize, productSize
+
+if __name__ == "__main__":
+    cli = OptionParser(usage="%prog [-p NPRODUCT] [-v NVERSION] [-c NCACHE]")
+    cli.add_option("-p", "--products", type="int", dest="nproduct", default=4000,
+                   help="the number of products in the stack")
+    cli.add_option("-v", "--versions", type="int", dest="nversion", default=10,
+                   help="the number of versions of each product")
+    cli.add_option("-c", "--caches", type="int", dest="ncache", default=3,
+                   help="the number of times to load the stack's cache")
+    (cli.opts, cli.args) = cli.parse_args()
+
+    run(cli.opts.nproduct, cli.opts.nversion, cli.opts.ncache)
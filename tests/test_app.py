@@ -5,8 +5,10 @@ module are imported into the eups module.  Note also the most of these
 functions are tested via testCmd.py
 """
 
+import json
 import os
 import shutil
+import tempfile
 import unittest
 import testCommon
 from testCommon import testEupsStack
@@ -343,12 +345,191 @@ setupRequired(python 2.5.2 [>= 2.5])
         self.assertIn("PYTHON_DIR", os.environ, "PYTHON_DIR not set")
         self.assertEqual(os.environ["PYTHON_DIR"], prod.dir)
 
+class SetupProductsTestCase(unittest.TestCase):
+    """
+    Tests setting up several products at once via app.setupProducts()
+    """
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        for p in ("python", "tcltk", "doxygen"):
+            if eups.Eups().isSetup(p):
+                eups.unsetup(p)
+
+    def tearDown(self):
+        os.environ = self.environ0
+
+    def setupEnviron(self, setup):
+        """Return the environment after calling setup(), restoring the original"""
+        environ = os.environ.copy()
+        try:
+            cmds = setup()
+            return os.environ.copy(), cmds
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def testSequential(self):
+        """The environment is the same as from setting up the products in turn"""
+        products = [("python", None), ("doxygen", None), ("python", "2.6")]
+
+        def sequential():
+            for productName, version in products:
+                eups.setup(productName, version)
+
+        expected = self.setupEnviron(sequential)[0]
+        environ, cmds = self.setupEnviron(lambda: eups.setupProducts(products))
+
+        self.assertEqual(environ, expected)
+        self.assertEqual(environ["SETUP_PYTHON"].split()[1], "2.6")
+        self.assertIn("SETUP_DOXYGEN", environ)
+        self.assertNotIn("false", cmds)
+        self.assertIn("export PYTHON_DIR=%s" % environ["PYTHON_DIR"], cmds)
+
+    def testUnsetup(self):
+        products = [("python", None), ("doxygen", None)]
+        eups.setupProducts(products)
+        self.assertIn("SETUP_TCLTK", os.environ)
+
+        cmds = eups.setupProducts(products, fwd=False)
+        for k in ("SETUP_PYTHON", "SETUP_TCLTK", "SETUP_DOXYGEN"):
+            self.assertNotIn(k, os.environ)
+            self.assertIn("unset %s" % k, cmds)
+
+    def testFailure(self):
+        """A product that can't be setup doesn't stop the others"""
+        eupsenv = eups.Eups(quiet=1)
+        environ, cmds = self.setupEnviron(lambda: eups.setupProducts([("python", "2.5.2"),
+                                                                      ("goober", None),
+                                                                      ("doxygen", None)],
+                                                                     eupsenv=eupsenv, vroOptions={}))
+        self.assertIn("SETUP_PYTHON", environ)
+        self.assertIn("SETUP_DOXYGEN", environ)
+        self.assertEqual(cmds[-1], "false")
+
+    def testFailedDependencies(self):
+        """The products setup for a product that failed are forgotten, along with its changes"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            productDir = os.path.join(tmpdir, "broken")
+            os.makedirs(os.path.join(tmpdir, "ups_db"))
+            os.makedirs(os.path.join(productDir, "ups"))
+            with open(os.path.join(productDir, "ups", "broken.table"), "w") as fd:
+                print("setupRequired(tcltk)\nsetupRequired(goober)", file=fd)
+            os.environ["EUPS_PATH"] = "%s:%s" % (tmpdir, testEupsStack)
+            eups.Eups().declare("broken", "1.0", productDir, tmpdir)
+
+            eupsenv = eups.Eups(quiet=1)
+            environ, cmds = self.setupEnviron(lambda: eups.setupProducts([("broken", "1.0"), ("python", "2.5.2")],
+                                                                         eupsenv=eupsenv, vroOptions={}))
+            self.assertEqual(cmds[-1], "false")
+            self.assertNotIn("SETUP_BROKEN", environ)
+            self.assertIn("SETUP_TCLTK", environ) # python needs it too
+            self.assertEqual(sorted(eupsenv.alreadySetupProducts), ["python", "tcltk"])
+
+            eupsenv = eups.Eups(quiet=1)
+            environ, cmds = self.setupEnviron(lambda: eups.setupProducts([("python", "2.5.2"), ("broken", "1.0")],
+                                                                         eupsenv=eupsenv, vroOptions={}))
+            self.assertEqual(cmds[-1], "false")
+            self.assertIn("SETUP_TCLTK", environ)
+            self.assertEqual(sorted(eupsenv.alreadySetupProducts), ["python", "tcltk"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testSplitProducts(self):
+        import eups.setupcmd
+        cmd = eups.setupcmd.EupsSetup(["python", "+", "doxygen", "1.5.9", "+", "+"])
+        self.assertEqual(cmd.splitProducts(cmd.args), [("python", None), ("doxygen", "1.5.9")])
+        self.assertEqual(cmd.splitProducts(["python", "2.5.2"]), [("python", "2.5.2")])
+        self.assertEqual(cmd.splitProducts([]), [])
+
+class LockfileTestCase(unittest.TestCase):
+    """
+    Tests saving a setup to a lockfile, and recreating it
+    """
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_SHELL"] = "sh"
+        for p in ("python", "tcltk"):
+            if eups.Eups().isSetup(p):
+                eups.unsetup(p)
+        self.lockfile = os.path.join(testEupsStack, "test.lock")
+
+    def tearDown(self):
+        os.environ = self.environ0
+        if os.path.exists(self.lockfile):
+            os.remove(self.lockfile)
+
+    def writeLockfile(self):
+        """Setup python, saving it to a lockfile; return the resulting environment"""
+        environ = os.environ.copy()
+        eupsenv = eups.Eups()
+        eups.setup("python", "2.5.2", eupsenv=eupsenv)
+        eups.writeLockfile(self.lockfile, eupsenv, ["python"])
+
+        setupEnviron = os.environ.copy()
+        os.environ.clear()
+        os.environ.update(environ)
+
+        return setupEnviron
+
+    def testRoundTrip(self):
+        expected = self.writeLockfile()
+        self.assertNotIn("SETUP_PYTHON", os.environ)
+
+        contents = eups.app.readLockfile(self.lockfile)
+        self.assertEqual(sorted(p["name"] for p in contents["products"]), ["python", "tcltk"])
+
+        cmds = eups.setupFromLockfile(self.lockfile)
+        self.assertEqual(os.environ, expected)
+        self.assertIn("export PYTHON_DIR=%s" % expected["PYTHON_DIR"], cmds)
+
+    def testRebase(self):
+        """Additions to e.g. PATH are made to its current value"""
+        os.environ["PATH"] = "/old/bin"
+        expected = self.writeLockfile()
+        self.assertTrue(expected["PATH"].endswith(":/old/bin"))
+
+        os.environ["PATH"] = "/new/bin"
+        eups.setupFromLockfile(self.lockfile)
+        self.assertEqual(os.environ["PATH"], expected["PATH"].replace("/old/bin", "/new/bin"))
+
+    def testRebaseUnset(self):
+        """Additions to a variable that was unset are made to its current value"""
+        os.environ.pop("LD_LIBRARY_PATH", None)
+        expected = self.writeLockfile()
+
+        os.environ["LD_LIBRARY_PATH"] = "/new/lib"
+        os.environ["PYTHON_DIR"] = "/new/python"
+        eups.setupFromLockfile(self.lockfile)
+        self.assertEqual(os.environ["LD_LIBRARY_PATH"], expected["LD_LIBRARY_PATH"] + ":/new/lib")
+        self.assertEqual(os.environ["PYTHON_DIR"], expected["PYTHON_DIR"])
+
+    def testValidation(self):
+        self.writeLockfile()
+
+        with open(self.lockfile) as fd:
+            contents = json.load(fd)
+        contents["products"][0]["dir"] = os.path.join(testEupsStack, "goober")
+        with open(self.lockfile, "w") as fd:
+            json.dump(contents, fd)
+
+        self.assertRaises(eups.EupsException, eups.setupFromLockfile, self.lockfile)
+        self.assertNotIn("SETUP_PYTHON", os.environ)
+        self.assertRaises(eups.EupsException, eups.setupFromLockfile, self.lockfile, flavor="Darwin")
+
+        eups.setupFromLockfile(self.lockfile, force=True, verbose=-1)
+        self.assertIn("SETUP_PYTHON", os.environ)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
     """Return a test suite"""
 
-    return testCommon.makeSuite([AppTestCase], makeSuite)
+    return testCommon.makeSuite([AppTestCase, SetupProductsTestCase, LockfileTestCase], makeSuite)
 
 def run(shouldExit=False):
     """Run the tests"""
@@ -9,14 +9,17 @@ import testCommon
 import os
 import sys
 import unittest
-import re, shutil
+import glob, re, shutil, tempfile
 from eups.utils import StringIO, encodePath
 from testCommon import testEupsStack
 
 import eups.cmd
+import eups.db
 import eups.hooks as hooks
+from eups import lock, timing
 from eups import Tag, TagNotRecognized
 from eups.exceptions import ProductNotFound
+from eups.db.ChainFile import ChainFile
 
 prog = "eups"
 
@@ -63,6 +66,10 @@ class CmdTestCase(unittest.TestCase):
         if os.path.exists(pdir20):
             shutil.rmtree(pdir20)
 
+        genfile = os.path.join(self.dbpath, ".generation")
+        if os.path.exists(genfile):
+            os.remove(genfile)
+
     def testInit(self):
         eups.cmd.EupsCmd(args="-q".split(), toolname=prog)
 
@@ -317,6 +324,199 @@ tcltk                 8.5a4      \tcurrent
         prod = myeups.findProduct("newprod", Tag("current"))
         self.assertIsNone(prod, msg="Failed to undeclare product")
 
+    def testDeclareFromFile(self):
+        pdir = os.path.join(testEupsStack, "Linux", "newprod")
+        pdir10 = os.path.join(pdir, "1.0")
+        pdir20 = os.path.join(pdir, "2.0")
+        shutil.copytree(pdir10, pdir20)
+        db = eups.db.Database(self.dbpath)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            declarations = os.path.join(tmpdir, "declarations")
+            with open(declarations, "w") as fd:
+                print("# products to declare", file=fd)
+                print("newprod 1.0 -r %s" % pdir10, file=fd)
+                print("", file=fd)
+                print("newprod 2.0 -r %s -t current" % pdir20, file=fd)
+                print("newprod 3.0 -r %s" % os.path.join(pdir, "3.0"), file=fd)
+
+            # the last line is bad, so nothing's declared
+            generation = db.getGeneration()
+            cmd = eups.cmd.EupsCmd(args=["declare", "--from-file", declarations], toolname=prog)
+            self.assertNotEqual(cmd.run(), 0)
+            self.assertIn("%s:5" % declarations, self.err.getvalue())
+            self.assertIsNone(eups.Eups().findProduct("newprod"))
+            self.assertEqual(db.getGeneration(), generation)
+
+            with open(declarations) as fd:
+                lines = fd.readlines()[:-1]
+            with open(declarations, "w") as fd:
+                fd.writelines(lines)
+
+            self._resetOut()
+            cmd = eups.cmd.EupsCmd(args=["declare", "--from-file", declarations], toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assertEqual(self.err.getvalue(), "")
+            self.assertEqual((db.getGeneration() or 0), (generation or 0) + 1) # published once
+
+            myeups = eups.Eups()
+            self.assertEqual(sorted(p.version for p in myeups.findProducts("newprod")), ["1.0", "2.0"])
+            self.assertEqual(myeups.findProduct("newprod", Tag("current")).version, "2.0")
+        finally:
+            shutil.rmtree(tmpdir)
+            for version in ["1.0", "2.0"]:
+                if eups.Eups().findProduct("newprod", version):
+                    eups.Eups().undeclare("newprod", version)
+
+    def testTagsCloneDelete(self):
+        cmd = eups.cmd.TagsCmd(args=["tags", "--delete", "beta"], toolname=prog, cmd="tags",
+                               lockType=lock.LOCK_SH)
+        self.assertEqual(cmd.lockType, lock.LOCK_EX)
+
+        current = dict((p.name, p.version) for p in eups.Eups().findProducts(tags=["current"]))
+        try:
+            eups.Eups().assignTag("beta", "python", "2.6")
+
+            # the cache's only saved once
+            myeups = eups.Eups()
+            myeups.findProducts()
+            timing.enable(name="test")
+            try:
+                self.assertEqual(eups.tags.cloneTag(myeups, "stable", "current"), [])
+                self.assertEqual(timing.getCounters().get("stack cache saves", 0), 1)
+            finally:
+                timing.disable()
+            self.assertEqual(len(myeups.findProducts(tags=["stable"])), len(current))
+
+            # each chain file's written once, replacing python 2.6's beta tag
+            written = []
+            write = ChainFile.write
+            ChainFile.write = lambda self, file=None: written.append(self.file) or write(self, file)
+            try:
+                cmd = eups.cmd.EupsCmd(args="tags --clone current beta".split(), toolname=prog)
+                self.assertEqual(cmd.run(), 0)
+            finally:
+                ChainFile.write = write
+            self.assertEqual(self.err.getvalue(), "")
+            self.assertEqual(len(written), len(current))
+            self.assertEqual(len(set(written)), len(current))
+
+            myeups = eups.Eups()
+            self.assertEqual(dict((p.name, p.version) for p in myeups.findProducts(tags=["beta"])), current)
+            self.assertNotIn("beta", myeups.findProduct("python", "2.6").tags)
+
+            self._resetOut()
+            cmd = eups.cmd.EupsCmd(args="tags --delete beta".split(), toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assertEqual(self.err.getvalue(), "")
+            self.assertEqual(eups.Eups().findProducts(tags=["beta"]), [])
+        finally:
+            for chainFile in glob.glob(os.path.join(self.dbpath, "*", "beta.chain")) + \
+                    glob.glob(os.path.join(self.dbpath, "*", "stable.chain")):
+                os.remove(chainFile)
+
+    def testWriteBehindCache(self):
+        eupsModule = sys.modules["eups.Eups"]
+        hooks.config.Eups.writeBehindCache = True
+        try:
+            myeups = eups.Eups()
+            myeups.findProducts()
+            timing.enable(name="test")
+            try:
+                myeups.assignTag("beta", "python", "2.6")
+                myeups.assignTag("beta", "tcltk", "8.5a4")
+                self.assertEqual(timing.getCounters().get("stack cache saves", 0), 0)
+
+                # someone else saves the cache in the meantime
+                hooks.config.Eups.writeBehindCache = False
+                eups.Eups().assignTag("stable", "python", "2.5.2")
+                hooks.config.Eups.writeBehindCache = True
+
+                saves = timing.getCounters()["stack cache saves"]
+                myeups.flushCaches()
+                self.assertEqual(timing.getCounters()["stack cache saves"], saves + 1)
+                self.assertEqual(timing.getCounters()["stack cache merges"], 1)
+            finally:
+                timing.disable()
+            self.assertEqual(eupsModule._writeBehind, [])
+
+            stack = eups.stack.ProductStack(self.dbpath, myeups.versions[testEupsStack].persistDir,
+                                            autosave=False)
+            stack.reload("Linux")
+            self.assertIn("stable", stack.getProduct("python", "2.5.2", "Linux").tags)
+            self.assertIn("beta", stack.getProduct("python", "2.6", "Linux").tags)
+            self.assertIn("beta", stack.getProduct("tcltk", "8.5a4", "Linux").tags)
+
+            # the eups command saves the caches as it exits
+            cmd = eups.cmd.EupsCmd(args="tags --delete beta".split(), toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assertEqual(self.err.getvalue(), "")
+            self.assertEqual(eupsModule._writeBehind, [])
+            stack.reload("Linux")
+            self.assertEqual(stack.getTaggedProduct("python", "Linux", "beta"), None)
+            self.assertTrue(stack.cacheIsUpToDate("Linux", stack.persistDir))
+        finally:
+            hooks.config.Eups.writeBehindCache = False
+            for chainFile in glob.glob(os.path.join(self.dbpath, "*", "beta.chain")) + \
+                    glob.glob(os.path.join(self.dbpath, "*", "stable.chain")):
+                os.remove(chainFile)
+
+    def testDistribCreateParallel(self):
+        os.environ["EUPS_DIR"] = testCommon.EUPS_DIR
+        tmpdir = tempfile.mkdtemp()
+        try:
+            contents = {}
+            for jobs in (1, 3):
+                serverDir = os.path.join(tmpdir, "jobs%d" % jobs)
+                cmd = eups.cmd.EupsCmd(args=("distrib create -d tarball -S compression=xz -f Linux -s %s -J %d "
+                                             "python 2.5.2" % (serverDir, jobs)).split(), toolname=prog)
+                self.assertEqual(cmd.run(), 0)
+
+                contents[jobs] = {}
+                for dir in ("manifests", "tables"):
+                    for file in os.listdir(os.path.join(serverDir, dir)):
+                        with open(os.path.join(serverDir, dir, file)) as fd: # n.b. manifests are timestamped
+                            contents[jobs][file] = [l for l in fd if not l.startswith("# Time:")]
+                self.assertTrue(os.path.exists(os.path.join(serverDir, "tcltk-8.5a4@Linux.tar.xz")))
+
+            self.assertEqual(sorted(contents[3]), ["python-2.5.2.table", "python-2.5.2@Linux.manifest",
+                                                   "tcltk-8.5a4.table", "tcltk-8.5a4@Linux.manifest"])
+            self.assertEqual(contents[3], contents[1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testAdminVerify(self):
+        def verify(args=""):
+            self._resetOut()
+            timing.enable(name="test")
+            try:
+                cmd = eups.cmd.EupsCmd(args=("admin verify " + args).split(), toolname=prog)
+                self.assertEqual(cmd.run(), 1)
+                return timing.getCounters().get("version files verified", 0)
+            finally:
+                timing.disable()
+
+        self.assertEqual(verify("--full"), 8)
+        self.assertEqual(self.err.getvalue(), "")
+        out = self.out.getvalue()
+        self.assertIn("cfitsio 3006.2 (Linux) in %s: product directory %s does not exist" %
+                      (testEupsStack, os.path.join(testEupsStack, "Linux", "cfitsio", "3006.2")), out)
+        self.assertNotIn("tcltk", out)
+
+        # a rerun only rereads the version files that have changed
+        self.assertEqual(verify(), 0)
+        self.assertEqual(self.out.getvalue(), out)
+
+        vfile = os.path.join(self.dbpath, "tcltk", "8.5a4.version")
+        st = os.stat(vfile)
+        os.utime(vfile, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        try:
+            self.assertEqual(verify("--trust"), 1)
+            self.assertEqual(self.out.getvalue(), out)
+        finally:
+            os.utime(vfile, ns=(st.st_atime_ns, st.st_mtime_ns))
+
     def testRemove(self):
         pdir = os.path.join(testEupsStack, "Linux", "newprod")
         pdir10 = os.path.join(pdir, "1.0")
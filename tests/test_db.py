@@ -469,6 +469,7 @@ class ChainFileTestCase(unittest.TestCase):
 
 
 from eups.db import Database
+from eups import timing
 
 class DatabaseTestCase(unittest.TestCase):
 
@@ -508,6 +509,13 @@ class DatabaseTestCase(unittest.TestCase):
         for v in expected:
             self.assertIn(v, vers)
 
+    def testFindVersionFiles(self):
+        vfiles = self.db.findVersionFiles()
+        self.assertEqual(len(vfiles), 8)
+        self.assertIn(("doxygen", "1.5.9", os.path.join(self.dbpath, "doxygen", "1.5.9.version")), vfiles)
+        for prod, vers, file in vfiles:
+            self.assertIn(vers, self.db.findVersions(prod))
+
     def testFindFlavors(self):
         flavs = self.db.findFlavors("doxygen")
         self.assertEqual(len(flavs), 2)
@@ -651,6 +659,39 @@ class DatabaseTestCase(unittest.TestCase):
         self.assertFalse(os.path.exists(os.path.join(self.userdb,
                                                      "python","my.chain")))
 
+    def testUserTagIndex(self):
+        indexFile = os.path.join(self.userdb, "rhl.userTagIndex")
+
+        def assignments():
+            timing.enable()
+            try:
+                assignments = self.db.getUserTagAssignments(indexFile)
+                return sorted(assignments), timing.getCounters()
+            finally:
+                timing.disable()
+
+        self.assertEqual(assignments(), ([], {"user tag index misses" : 1}))
+
+        self.db.assignTag("user:my", "python", "2.5.2")
+        self.assertEqual(assignments(), ([("python", "user:my", "2.5.2", "Linux")],
+                                         {"user tag index misses" : 1}))
+        self.assertEqual(assignments(), ([("python", "user:my", "2.5.2", "Linux")],
+                                         {"user tag index hits" : 1}))
+        #
+        # Changing a chain file invalidates the index
+        #
+        self.db.assignTag("user:my", "python", "2.6")
+        chainFile = os.path.join(self.userdb, "python", "my.chain")
+        mtime = os.stat(chainFile).st_mtime + 10
+        os.utime(chainFile, (mtime, mtime))
+
+        self.assertEqual(assignments(), ([("python", "user:my", "2.6", "Linux")],
+                                         {"user tag index misses" : 1}))
+        self.assertEqual(self.db.getUserTagAssignments(), [("python", "user:my", "2.6", "Linux")])
+
+        self.db.unassignTag("user:my", "python")
+        self.assertEqual(assignments()[0], [])
+
     def testAssignTag(self):
         if not os.path.exists(self.pycur+".bak"):
             shutil.copyfile(self.pycur, self.pycur+".bak")
@@ -787,6 +828,75 @@ class DatabaseTestCase(unittest.TestCase):
                   os.removedirs(pdir)
             raise
 
+    def testGeneration(self):
+        genfile = os.path.join(self.dbpath, ".generation")
+        if os.path.exists(genfile):
+            os.remove(genfile)
+        pdir = self.db._productDir("base")
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"))
+        try:
+            self.assertIsNone(self.db.getGeneration())
+
+            self.db.declare(base)
+            self.assertEqual(self.db.getGeneration(), 1)
+
+            self.db.assignTag("beta", "base", "1.0")
+            self.assertEqual(self.db.getGeneration(), 2)
+
+            # user tags don't change the database
+            self.db.assignTag("user:rlp", "base", "1.0")
+            self.db.unassignTag("user:rlp", "base")
+            self.assertEqual(self.db.getGeneration(), 2)
+
+            self.assertTrue(self.db.unassignTag("beta", "base"))
+            self.assertEqual(self.db.getGeneration(), 3)
+
+            self.assertFalse(self.db.undeclare(Product("base", "9.9", "Linux")))
+            self.assertEqual(self.db.getGeneration(), 3)
+
+            self.assertTrue(self.db.undeclare(base))
+            self.assertEqual(self.db.getGeneration(), 4)
+            self.assertFalse(os.path.exists(pdir))
+        finally:
+            if os.path.exists(genfile):
+                os.remove(genfile)
+            if os.path.isdir(pdir):
+                shutil.rmtree(pdir)
+
+    def testTransaction(self):
+        genfile = os.path.join(self.dbpath, ".generation")
+        if os.path.exists(genfile):
+            os.remove(genfile)
+        pdir = self.db._productDir("base")
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"), tags=["beta"])
+        try:
+            with self.db.transaction():
+                self.db.declare(base)
+                self.db.assignTag("stable", "base", "1.0")
+                with self.db.transaction():
+                    self.assertTrue(self.db.unassignTag("stable", "base"))
+                self.assertIsNone(self.db.getGeneration())
+            self.assertEqual(self.db.getGeneration(), 1)
+            self.assertEqual(self.db.findTags("base", "1.0", "Linux"), ["beta"])
+
+            # the tags are unassigned in the same transaction
+            self.assertTrue(self.db.undeclare(base))
+            self.assertEqual(self.db.getGeneration(), 2)
+
+            # nothing changed
+            with self.db.transaction():
+                self.assertFalse(self.db.undeclare(base))
+            self.assertEqual(self.db.getGeneration(), 2)
+        finally:
+            if os.path.exists(genfile):
+                os.remove(genfile)
+            if os.path.isdir(pdir):
+                shutil.rmtree(pdir)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -19,6 +19,7 @@ from eups import TagNotRecognized, ProductNotFound, EupsException
 from eups.Eups import Eups
 from eups.stack import ProductStack
 from eups.utils import Quiet
+from eups import timing
 import eups.hooks
 
 class EupsTestCase(unittest.TestCase):
@@ -97,6 +98,43 @@ class EupsTestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(cache),
                          "Cache file for %s not written" % flav)
 
+    def testLazyInit(self):
+        myeups = Eups()
+        self.assertFalse(myeups.versions.isLoaded(testEupsStack))
+        self.assertFalse(myeups._tagsLoaded)
+        self.assertIn(testEupsStack, myeups.versions)
+        self.assertEqual(sorted(myeups.versions.keys()), sorted(myeups.path))
+        self.assertFalse(myeups.versions.isLoaded(testEupsStack))
+
+        self.assertIsNotNone(myeups.versions[testEupsStack])
+        self.assertTrue(myeups.versions.isLoaded(testEupsStack))
+
+        self.assertIn("stable", myeups.preferredTags)
+        self.assertTrue(myeups._tagsLoaded)
+
+        self.assertEqual(myeups.localVersions, {})
+        self.assertTrue(myeups.findProduct("python", "2.5.2"))
+
+    def testDefaultProductInTables(self):
+        from eups.table import Table
+        defaultProduct = eups.hooks.config.Eups.defaultProduct.copy()
+        eups.hooks.config.Eups.defaultProduct["name"] = "implicitProducts"
+        try:
+            self.eups.declare("toolchain", "1.0", productDir="none", tablefile="none")
+            myeups, other = Eups(), Eups()
+            self.assertFalse(myeups._defaultProductChecked)
+
+            # tables read before setup() still use "toolchain" if implicitProducts isn't declared
+            table = Table(os.path.join(testEupsStack, "empty.table"), eupsenv=myeups)
+            self.assertTrue(myeups._defaultProductChecked)
+            self.assertFalse(other._defaultProductChecked)
+            self.assertEqual([a.args[0] for a in table.actions("Linux") if a.cmd == "setupRequired"],
+                             ["toolchain"])
+        finally:
+            eups.hooks.config.Eups.defaultProduct.clear()
+            eups.hooks.config.Eups.defaultProduct.update(defaultProduct)
+            shutil.rmtree(os.path.join(self.dbpath, "toolchain"), ignore_errors=True)
+
     def testPrefTags(self):
         self.assertRaises(TagNotRecognized,
                           self.eups.setPreferredTags, "goober gurn")
@@ -512,6 +550,36 @@ class EupsTestCase(unittest.TestCase):
         self.assertNotIn("TCLTK_DIR", os.environ)
         self.assertNotIn("SETUP_TCLTK", os.environ)
 
+    def testBatchedResolution(self):
+        python = self.eups.findProduct("python", "2.5.2")
+        deps = [(p.name, p.version) for p, opt, depth in self.eups.getDependentProducts(python)]
+        self.assertEqual(deps[0], ("tcltk", "8.5a4"))
+
+        timing.enable(name="test")
+        try:
+            with self.eups.batchedResolution():
+                with self.eups.batchedResolution():       # nested batches share their results
+                    dependentProducts = self.eups.getDependentProducts(python)
+                    self.assertEqual([(p.name, p.version) for p, opt, depth in dependentProducts], deps)
+                    dependentProducts[0][2] = 100     # callers get their own copies
+                resolutions = timing.getCounters()["resolutions"]
+
+                dependentProducts = self.eups.getDependentProducts(python)
+                self.assertEqual([(p.name, p.version) for p, opt, depth in dependentProducts], deps)
+                self.assertNotEqual(dependentProducts[0][2], 100)
+                self.assertIs(self.eups.findProductFromVRO("tcltk", "8.5a4")[0], dependentProducts[0][0])
+                self.assertEqual(timing.getCounters()["resolutions"], resolutions)
+
+                # changing the environment forgets what we found
+                self.assertIsNone(self.eups.findSetupProduct("tcltk"))
+                self.eups.setup("tcltk")
+                self.assertEqual(self.eups.findSetupProduct("tcltk").version, "8.5a4")
+                self.eups.unsetup("tcltk")
+                self.assertIsNone(self.eups.findSetupProduct("tcltk"))
+            self.assertIsNone(self.eups._resolutions)
+        finally:
+            timing.disable()
+
     def testRemove(self):
         os.environ = self.environ0
 
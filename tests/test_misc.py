@@ -9,10 +9,27 @@ import shutil
 import re
 import unittest
 import time
+import hashlib
+import tempfile
+import threading
+import http.server
+import tarfile
+import json
+import io
+import signal
+import subprocess
 import testCommon
 from testCommon import testEupsStack
 
 import eups
+import eups.hooks
+from eups.distrib.server import WebTransporter, RemoteFileInvalid, DistribServer
+import eups.distrib.tarball
+from eups.distrib.BuildCache import BuildCache
+import eups.debug
+from eups import timing
+from eups import lock
+from eups.db import Database
 
 class MiscTestCase(unittest.TestCase):
 
@@ -25,6 +42,857 @@ class MiscTestCase(unittest.TestCase):
     def testNothing(self):
         pass
 
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve self.server.data, honouring Range requests and optionally hanging up early"""
+
+    def do_GET(self):
+        data = self.server.data
+        if self.path.endswith(".sha256"):
+            self._send(200, hashlib.sha256(self.server.checksummed).hexdigest().encode())
+            return
+
+        self.server.requests.append(self.headers.get("Range"))
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+
+        body = data[start:]
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        if self.server.truncate:        # simulate a dropped connection
+            body = body[:self.server.truncate]
+            self.server.truncate = 0
+        self.wfile.write(body)
+
+    def _send(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class WebTransporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.httpd = http.server.HTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        self.httpd.data = self.httpd.checksummed = os.urandom(300000)
+        self.httpd.truncate = 0
+        self.httpd.requests = []
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+        self.url = "http://127.0.0.1:%d/pkg.tar.gz" % self.httpd.server_port
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "pkg.tar.gz")
+        self.transport = eups.hooks.config.distrib["transport"].copy()
+
+    def tearDown(self):
+        eups.hooks.config.distrib["transport"] = self.transport
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def testResume(self):
+        self.httpd.truncate = 100000
+        eups.hooks.config.distrib["transport"]["checksumSuffix"] = ".sha256"
+
+        WebTransporter(self.url, verbosity=-1).cacheToFile(self.filename)
+
+        with open(self.filename, "rb") as fd:
+            self.assertEqual(fd.read(), self.httpd.data)
+        self.assertEqual(self.httpd.requests, [None, "bytes=100000-"])
+        self.assertEqual(os.listdir(self.tmpdir), ["pkg.tar.gz"])
+
+    def testResumeLater(self):
+        eups.hooks.config.distrib["transport"]["retries"] = 0
+        self.httpd.truncate = 1000
+
+        self.assertRaises(eups.exceptions.EupsException,
+                          WebTransporter(self.url, verbosity=-1).cacheToFile, self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(os.path.getsize(self.filename + WebTransporter.PARTIAL_SUFFIX), 1000)
+
+        WebTransporter(self.url, verbosity=-1).cacheToFile(self.filename)
+        with open(self.filename, "rb") as fd:
+            self.assertEqual(fd.read(), self.httpd.data)
+        self.assertEqual(self.httpd.requests, [None, "bytes=1000-"])
+
+    def testBadChecksum(self):
+        eups.hooks.config.distrib["transport"]["checksumSuffix"] = ".sha256"
+        self.httpd.checksummed = b"something else"
+
+        self.assertRaises(RemoteFileInvalid,
+                          WebTransporter(self.url, verbosity=-1).cacheToFile, self.filename)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def testBadChecksumSuffix(self):
+        for suffix in (".sha256sum", ".shake_128"):
+            eups.hooks.config.distrib["transport"]["checksumSuffix"] = suffix
+
+            self.assertRaises(eups.exceptions.CustomizationError,
+                              WebTransporter(self.url, verbosity=-1).cacheToFile, self.filename)
+        self.assertEqual(self.httpd.requests, [])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+class TarballStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.serverDir = os.path.join(self.tmpdir, "server")
+        os.makedirs(os.path.join(self.tmpdir, "src", "foo", "1.0", "ups"))
+        os.makedirs(self.serverDir)
+        with open(os.path.join(self.tmpdir, "src", "foo", "1.0", "ups", "foo.table"), "w") as fd:
+            print("setupRequired(bar)", file=fd)
+
+        with tarfile.open(os.path.join(self.serverDir, "foo-1.0@Linux.tar.gz"), "w:gz") as tf:
+            tf.add(os.path.join(self.tmpdir, "src", "foo"), "foo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testUnpackStream(self):
+        ds = DistribServer(self.serverDir)
+        distrib = eups.distrib.tarball.Distrib(None, ds, "Linux", options=dict(stream="true"))
+        unpackDir = os.path.join(self.tmpdir, "stack", "Linux")
+
+        stream = ds.openFileForProduct("foo-1.0@Linux.tar.gz", "foo", "1.0", "Linux")
+        try:
+            distrib.unpackStream(stream, unpackDir)
+        finally:
+            stream.close()
+
+        with open(os.path.join(unpackDir, "foo", "1.0", "ups", "foo.table")) as fd:
+            self.assertEqual(fd.read(), "setupRequired(bar)\n")
+
+    def testTruncatedStream(self):
+        """A truncated stream is an error, and what we'd unpacked is removed"""
+        ds = DistribServer(self.serverDir)
+        tarball = os.path.join(self.serverDir, "foo-1.0@Linux.tar.gz")
+        with open(tarball, "rb") as fd:
+            data = fd.read()
+        os.makedirs(os.path.join(self.tmpdir, "build"))
+
+        class Eups:
+            flavor = "Linux"
+            noaction = False
+
+        distrib = eups.distrib.tarball.Distrib(Eups(), ds, "Linux", options=dict(stream="true"), verbosity=-1)
+        unpackDir = os.path.join(self.tmpdir, "stack", "Linux")
+        os.makedirs(os.path.join(unpackDir, "foo", "0.9"))
+
+        for size in (len(data)//2, len(data) - 10): # a broken tar file, and a gzip stream without its trailer
+            self.assertRaises(distrib.STREAM_ERRORS, distrib.unpackStream, io.BytesIO(data[:size]), unpackDir)
+            self.assertEqual(os.listdir(unpackDir), ["foo"])
+            self.assertEqual(os.listdir(os.path.join(unpackDir, "foo")), ["0.9"])
+        #
+        # If the stream's truncated when installing, we fall back to copying the tarball
+        #
+        ds.openFileForProduct = lambda *args, **kwargs: io.BytesIO(data[:len(data)//2])
+        environ0 = os.environ.copy()
+        os.environ["EUPS_DIR"] = testCommon.EUPS_DIR # needed to run tar
+        try:
+            distrib.installPackage("foo-1.0@Linux.tar.gz", "foo", "1.0", os.path.join(self.tmpdir, "stack"),
+                                   buildDir=os.path.join(self.tmpdir, "build"))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ0)
+        with open(os.path.join(unpackDir, "foo", "1.0", "ups", "foo.table")) as fd:
+            self.assertEqual(fd.read(), "setupRequired(bar)\n")
+
+    def testParallelGzip(self):
+        class Eups:
+            noaction = False
+
+        distrib = eups.distrib.tarball.Distrib(Eups(), None, "Linux",
+                                               options=dict(compression="pgzip", compressionJobs="2"))
+        distrib.PGZIP_BLOCKSIZE = 100
+        tarball = distrib.getDistIdForPackage("foo", "1.0")
+        self.assertEqual(tarball, "foo-1.0@Linux.tar.gz")
+        self.assertEqual(distrib.parseDistID(tarball), tarball)
+
+        fullTarball = os.path.join(self.tmpdir, tarball)
+        distrib.writeCompressedTarball(os.path.join(self.tmpdir, "src"), "foo", fullTarball, "pgzip")
+
+        unpackDir = os.path.join(self.tmpdir, "stack")
+        with open(fullTarball, "rb") as stream:
+            distrib.unpackStream(stream, unpackDir)
+        with open(os.path.join(unpackDir, "foo", "1.0", "ups", "foo.table")) as fd:
+            self.assertEqual(fd.read(), "setupRequired(bar)\n")
+
+    def testXz(self):
+        distrib = eups.distrib.tarball.Distrib(None, None, "Linux", options=dict(compression="xz"))
+        self.assertEqual(distrib.getDistIdForPackage("foo", "1.0"), "foo-1.0@Linux.tar.xz")
+        self.assertEqual(distrib.parseDistID("foo-1.0@Linux.tar.xz"), "foo-1.0@Linux.tar.xz")
+
+class BuildCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.installDir = os.path.join(self.tmpdir, "stack", "Linux", "foo", "1.0")
+        os.makedirs(os.path.join(self.installDir, "lib"))
+        with open(os.path.join(self.installDir, "lib", "libfoo.so"), "wb") as fd:
+            fd.write(os.urandom(10000))
+        self.source = os.path.join(self.tmpdir, "foo-1.0.eupspkg")
+        with open(self.source, "w") as fd:
+            print("source", file=fd)
+
+        self.cache = BuildCache(os.path.join(self.tmpdir, "cache"), "25k")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testKey(self):
+        key = BuildCache.makeKey("foo", "1.0", "Linux", self.installDir, self.source,
+                                 ["setup --just --type=build bar 2.0"])
+        self.assertEqual(key, BuildCache.makeKey("foo", "1.0", "Linux", self.installDir, self.source,
+                                                 ["setup --just --type=build bar 2.0"]))
+        self.assertNotEqual(key, BuildCache.makeKey("foo", "1.0", "Linux", self.installDir, self.source,
+                                                    ["setup --just --type=build bar 2.1"]))
+
+    def testStoreRestore(self):
+        key = BuildCache.makeKey("foo", "1.0", "Linux", self.installDir, self.source, [])
+        self.assertFalse(self.cache.restore(key, self.installDir))
+
+        self.cache.store(key, self.installDir, "foo", "1.0", "Linux")
+        with open(os.path.join(self.installDir, "lib", "libfoo.so"), "rb") as fd:
+            contents = fd.read()
+        shutil.rmtree(self.installDir)
+
+        self.assertTrue(self.cache.restore(key, self.installDir))
+        with open(os.path.join(self.installDir, "lib", "libfoo.so"), "rb") as fd:
+            self.assertEqual(fd.read(), contents)
+
+        self.assertEqual([(e["product"], e["version"]) for e in self.cache.entries()], [("foo", "1.0")])
+        self.assertEqual(self.cache.clear("foo"), 1)
+        self.assertEqual(self.cache.entries(), [])
+
+    def testEvict(self):
+        keys = []
+        for v in ("1.0", "2.0", "3.0"):
+            keys.append(BuildCache.makeKey("foo", v, "Linux", self.installDir, self.source, []))
+            self.cache.store(keys[-1], self.installDir, "foo", v, "Linux")
+            if v == "2.0":              # use 1.0 so that 2.0 is the least recently used
+                os.utime(self.cache._info(keys[0]), (time.time() + 10, time.time() + 10))
+
+        self.assertEqual(sorted(e["version"] for e in self.cache.entries()), ["1.0", "3.0"])
+
+    def testCommand(self):
+        import eups.cmd
+        for v in ("1.0", "2.0"):
+            key = BuildCache.makeKey("foo", v, "Linux", self.installDir, self.source, [])
+            self.cache.store(key, self.installDir, "foo", v, "Linux")
+
+        def distribCache(args):
+            out = io.StringIO()
+            stdout, sys.stdout = sys.stdout, out
+            try:
+                cmd = eups.cmd.EupsCmd(args=["distrib", "cache", "--cache-dir", self.cache.cacheDir] + args,
+                                       toolname="eups")
+                status = cmd.run()
+            finally:
+                sys.stdout = stdout
+            return status, out.getvalue().splitlines()
+
+        status, lines = distribCache(["list"])
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(l.split()[:3] for l in lines), [["foo", "1.0", "Linux"], ["foo", "2.0", "Linux"]])
+
+        self.assertEqual(distribCache(["clear", "foo", "1.0"])[0], 0)
+        self.assertEqual([e["version"] for e in self.cache.entries()], ["2.0"])
+
+        self.assertEqual(distribCache(["prune", "--max-size", "0"])[0], 0)
+        self.assertEqual(self.cache.entries(), [])
+
+        errstrm, eups.cmd._errstrm = eups.cmd._errstrm, io.StringIO()
+        try:
+            self.assertEqual(distribCache(["frobnicate"])[0], 2)
+        finally:
+            eups.cmd._errstrm = errstrm
+
+class TimingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        timing.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def instrumented(self):
+        @timing.timed("outer", "name")
+        def outer(name):
+            for i in range(2):
+                with timing.span("inner", i=i):
+                    timing.count("inner calls")
+            return name
+
+        return outer("foo")
+
+    def testDisabled(self):
+        self.assertFalse(timing.isEnabled())
+        self.assertEqual(self.instrumented(), "foo")
+        self.assertEqual(timing.getCounters(), {})
+
+    def testTree(self):
+        timing.enable(name="test")
+        self.assertEqual(self.instrumented(), "foo")
+        self.assertEqual(timing.getCounters(), {"inner calls" : 2})
+
+        out = io.StringIO()
+        timing.report(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([l.split()[1:] for l in lines[2:5]],
+                         [["1", "test"], ["1", "outer", "foo"], ["2", "inner"]])
+        self.assertEqual(lines[-1].split(), ["inner", "calls", "2"])
+
+    def testChromeTrace(self):
+        traceFile = os.path.join(self.tmpdir, "trace.json")
+        eups.debug.parseDebugOption("timing[%s]" % traceFile)
+        self.assertTrue(timing.isEnabled())
+        self.instrumented()
+        timing.report()
+
+        with open(traceFile) as fd:
+            events = json.load(fd)["traceEvents"]
+        spans = [e for e in events if e["ph"] == "X"]
+        root = spans.pop()              # written last, and named after the command line
+        self.assertEqual(root["ts"], min(e["ts"] for e in spans + [root]))
+        self.assertEqual(sorted(e["name"] for e in spans), ["inner", "inner", "outer foo"])
+        self.assertEqual([(e["name"], e["args"]["value"]) for e in events if e["ph"] == "C"],
+                         [("inner calls", 2)])
+        self.assertEqual(sorted(e["args"]["i"] for e in events if e["name"] == "inner"), ["0", "1"])
+
+class FcntlLockTestCase(unittest.TestCase):
+    """Test the "fcntl" lock backend"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = [self.tmpdir]
+        self.config = (eups.hooks.config.site.lockBackend, eups.hooks.config.site.lockTimeout,
+                       eups.hooks.config.site.snapshotReads)
+        eups.hooks.config.site.lockBackend = "fcntl"
+        eups.hooks.config.site.lockTimeout = 0.2
+        eups.hooks.config.site.snapshotReads = False
+        self.environ0 = os.environ.copy()
+        os.environ.pop("EUPS_LOCK_PID", None)
+
+    def tearDown(self):
+        eups.hooks.config.site.lockBackend, eups.hooks.config.site.lockTimeout, \
+            eups.hooks.config.site.snapshotReads = self.config
+        os.environ.clear()
+        os.environ.update(self.environ0)
+        shutil.rmtree(self.tmpdir)
+
+    def lockInChild(self, lockType, wait=False, inherit=False):
+        """
+        Run a process that takes a lock;  if wait, keep it until stdin is closed.
+        If inherit, the child may use our exclusive lock
+        """
+        env = os.environ.copy()
+        if not inherit:
+            env.pop("EUPS_LOCK_PID", None)
+        env["PYTHONPATH"] = os.path.join(testCommon.EUPS_DIR, "python")
+        script = """
+import sys
+from eups import hooks, lock
+hooks.config.site.lockBackend = "fcntl"
+hooks.config.site.lockTimeout = 0.2
+try:
+    lock.takeLocks("test", [%r], %d, verbose=-1)
+except RuntimeError:
+    sys.exit(1)
+print("locked", flush=True)
+if %r:
+    sys.stdin.read()
+""" % (self.tmpdir, lockType, wait)
+        return subprocess.Popen([sys.executable, "-c", script], env=env, universal_newlines=True,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def testSharedAndExclusive(self):
+        locks = lock.takeLocks("test", self.path, lock.LOCK_SH)
+        child = self.lockInChild(lock.LOCK_SH, wait=True)
+        self.assertEqual(child.stdout.readline().strip(), "locked")
+        #
+        # We can't upgrade our lock while the child holds a shared lock
+        #
+        t0 = time.time()
+        self.assertRaises(RuntimeError, lock.takeLocks, "test", self.path, lock.LOCK_EX, verbose=-1)
+        self.assertLess(time.time() - t0, 5)
+
+        child.communicate("")
+        self.assertEqual(child.returncode, 0)
+        self.assertEqual(self.lockInChild(lock.LOCK_EX).wait(), 1) # we kept our shared lock
+        #
+        # Now we can, and the child can't take a lock
+        #
+        locks += lock.takeLocks("test", self.path, lock.LOCK_EX)
+        self.assertEqual(self.lockInChild(lock.LOCK_SH).wait(), 1)
+
+        lock.giveLocks(locks[1:])       # we still hold the first lock
+        self.assertEqual(self.lockInChild(lock.LOCK_SH).wait(), 1)
+
+        lock.giveLocks(locks)
+        lock.giveLocks(locks)           # harmless
+        self.assertEqual(self.lockInChild(lock.LOCK_EX).wait(), 0)
+
+    def testWait(self):
+        """We wait for a lock to be released, and leave SIGALRM as we found it"""
+        eups.hooks.config.site.lockTimeout = 30
+        child = self.lockInChild(lock.LOCK_EX, wait=True)
+        self.assertEqual(child.stdout.readline().strip(), "locked")
+
+        timer = threading.Timer(0.2, child.stdin.close) # releasing the child's lock
+        timer.start()
+        t0 = time.time()
+        locks = lock.takeLocks("test", self.path, lock.LOCK_SH)
+        self.assertLess(time.time() - t0, 10)
+        lock.giveLocks(locks)
+
+        timer.join()
+        child.wait()
+        child.stdout.close()
+        self.assertEqual(signal.getsignal(signal.SIGALRM), signal.SIG_DFL)
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    def testParentLock(self):
+        """A child may use the exclusive lock held by the process named by $EUPS_LOCK_PID"""
+        locks = lock.takeLocks("test", self.path, lock.LOCK_EX)
+        self.assertEqual(os.environ["EUPS_LOCK_PID"], str(os.getpid()))
+        self.assertEqual(self.lockInChild(lock.LOCK_EX, inherit=True).wait(), 0)
+        self.assertEqual(self.lockInChild(lock.LOCK_SH).wait(), 1)
+        lock.giveLocks(locks)
+
+    def testDeadHolder(self):
+        """Locks are released when their holder dies, even if it's killed"""
+        child = self.lockInChild(lock.LOCK_EX, wait=True)
+        self.assertEqual(child.stdout.readline().strip(), "locked")
+        self.assertRaises(RuntimeError, lock.takeLocks, "test", self.path, lock.LOCK_SH, verbose=-1)
+
+        child.kill()
+        child.wait()
+        child.stdin.close()
+        child.stdout.close()
+        lock.giveLocks(lock.takeLocks("test", self.path, lock.LOCK_EX))
+
+class ProductLockTestCase(unittest.TestCase):
+    """Test per-product locks (config.site.productLocks)"""
+    backend = "fcntl"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = [self.tmpdir]
+        self.config = (eups.hooks.config.site.lockBackend, eups.hooks.config.site.lockTimeout,
+                       eups.hooks.config.site.snapshotReads, eups.hooks.config.site.productLocks)
+        eups.hooks.config.site.lockBackend = self.backend
+        eups.hooks.config.site.lockTimeout = 0.2
+        eups.hooks.config.site.snapshotReads = False
+        eups.hooks.config.site.productLocks = True
+        self.environ0 = os.environ.copy()
+        os.environ.pop("EUPS_LOCK_PID", None)
+
+    def tearDown(self):
+        eups.hooks.config.site.lockBackend, eups.hooks.config.site.lockTimeout, \
+            eups.hooks.config.site.snapshotReads, eups.hooks.config.site.productLocks = self.config
+        os.environ.clear()
+        os.environ.update(self.environ0)
+        shutil.rmtree(self.tmpdir)
+
+    def lockInChild(self, lockType, products=[], update=False, wait=False):
+        """
+        Run a process that takes a lock and locks some products;  return its exit status.  If wait,
+        return the process, which waits for stdin to be closed before it updates the stack
+        """
+        env = os.environ.copy()
+        env.pop("EUPS_LOCK_PID", None)
+        env["PYTHONPATH"] = os.path.join(testCommon.EUPS_DIR, "python")
+        script = """
+import sys
+from eups import hooks, lock
+hooks.config.site.lockBackend = %r
+hooks.config.site.lockTimeout = 0.2
+hooks.config.site.productLocks = True
+try:
+    lock.takeLocks("test", [%r], %d, ntry=1, verbose=-1)
+    for p in %r:
+        lock.lockProduct(%r, p)
+    if %r:
+        print("locked", flush=True)
+        sys.stdin.read()
+    if %r:
+        with lock.updatingStack(%r):
+            pass
+except RuntimeError:
+    sys.exit(1)
+""" % (self.backend, self.tmpdir, lockType, products, self.tmpdir, wait, update, self.tmpdir)
+        if wait:
+            return subprocess.Popen([sys.executable, "-c", script], env=env, universal_newlines=True,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return subprocess.call([sys.executable, "-c", script], env=env)
+
+    def testDisjointProducts(self):
+        locks = lock.takeLocks("test", self.path, lock.LOCK_PRODUCT, ntry=1)
+        self.assertTrue(lock.lockProduct(self.tmpdir, "a"))
+        self.assertFalse(lock.lockProduct(self.tmpdir, "a")) # we already hold it
+        self.assertFalse(lock.lockProduct("/no/such/stack", "a")) # not locked by takeLocks
+
+        self.assertEqual(self.lockInChild(lock.LOCK_PRODUCT, ["b"]), 0)
+        self.assertEqual(self.lockInChild(lock.LOCK_PRODUCT, ["b", "a"]), 1)
+        self.assertEqual(self.lockInChild(lock.LOCK_SH), 0)
+        self.assertEqual(self.lockInChild(lock.LOCK_EX), 1)
+
+        with lock.updatingStack(self.tmpdir):
+            self.assertEqual(self.lockInChild(lock.LOCK_PRODUCT, ["b"], update=True), 1)
+        self.assertEqual(self.lockInChild(lock.LOCK_PRODUCT, ["b"], update=True), 0)
+
+        lock.giveLocks(locks)
+        self.assertIsNone(lock._productLocking)
+        self.assertEqual(self.lockInChild(lock.LOCK_PRODUCT, ["a"]), 0)
+        self.assertEqual(self.lockInChild(lock.LOCK_EX), 0)
+
+    def testTransaction(self):
+        """A transaction locks its products before the stack, the order used by distrib install"""
+        os.mkdir(os.path.join(self.tmpdir, "ups_db"))
+        Eups = eups.Eups(path=self.tmpdir, flavor="Linux", userDataDir=self.tmpdir)
+        locks = lock.takeLocks("declare", self.path, lock.LOCK_PRODUCT, ntry=1)
+        try:
+            # The child holds b's lock, and then waits for the stack's
+            child = self.lockInChild(lock.LOCK_PRODUCT, ["b"], update=True, wait=True)
+            self.assertEqual(child.stdout.readline().strip(), "locked")
+            with Eups.transaction(["a", "b"]):
+                self.assertRaises(RuntimeError, Eups.declare, "a", "1.0", "none", tablefile="none")
+                # we didn't lock the stack while we waited for b, so the child can update it
+                child.communicate("")
+                self.assertEqual(child.returncode, 0)
+
+            with Eups.transaction(["a", "b"]):
+                Eups.declare("a", "1.0", "none", tablefile="none")
+                self.assertEqual(self.lockInChild(lock.LOCK_PRODUCT, ["b"]), 1)
+                Eups.declare("b", "1.0", "none", tablefile="none")
+                # c wasn't locked before the stack was
+                self.assertRaises(RuntimeError, Eups.declare, "c", "1.0", "none", tablefile="none")
+            self.assertIsNone(Eups.findProduct("c"))
+        finally:
+            lock.giveLocks(locks)
+
+        self.assertEqual([p.name for p in Eups.findProducts()], ["a", "b"])
+
+    def testListLocks(self):
+        locks = lock.takeLocks("test", self.path, lock.LOCK_PRODUCT, ntry=1)
+        lock.lockProduct(self.tmpdir, "afw")
+
+        out = io.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            lock.listLocks(self.path)
+        finally:
+            sys.stdout = stdout
+            lock.giveLocks(locks)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(self.tmpdir + ":"))
+        self.assertTrue(lines[1].startswith(self.tmpdir + " [afw]:"))
+
+    def testDisabled(self):
+        """Without config.site.productLocks, LOCK_PRODUCT locks the whole stack"""
+        eups.hooks.config.site.productLocks = False
+        locks = lock.takeLocks("test", self.path, lock.LOCK_PRODUCT, ntry=1)
+        self.assertFalse(lock.lockProduct(self.tmpdir, "a"))
+        self.assertEqual(self.lockInChild(lock.LOCK_SH), 1)
+        lock.giveLocks(locks)
+
+class DirectoryProductLockTestCase(ProductLockTestCase):
+    """Test per-product locks with the "directory" lock backend"""
+    backend = "directory"
+
+class AtomicFileTestCase(unittest.TestCase):
+    """Test utils.AtomicFile and utils.fsyncBatch"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpdir, "foo.chain")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        with open(self.fileName) as fd:
+            return fd.read()
+
+    def testAtomic(self):
+        with open(self.fileName, "w") as fd:
+            print("old", file=fd)
+        os.chmod(self.fileName, 0o640)
+
+        with eups.utils.AtomicFile(self.fileName, "w") as fd:
+            print("new", file=fd)
+            fd.flush()
+            self.assertEqual(self.read(), "old\n") # readers see the old file until we're done
+            self.assertEqual([f for f in os.listdir(self.tmpdir) if not f.startswith(".")], ["foo.chain"])
+
+        self.assertEqual(self.read(), "new\n")
+        self.assertEqual(os.listdir(self.tmpdir), ["foo.chain"])
+        self.assertEqual(os.stat(self.fileName).st_mode & 0o777, 0o640)
+
+    def testPermissions(self):
+        umask, eups.utils._umask = eups.utils._umask, 0o022 # the umask is read when eups.utils is imported
+        try:
+            with eups.utils.AtomicFile(self.fileName, "w") as fd:
+                print("new", file=fd)
+        finally:
+            eups.utils._umask = umask
+
+        self.assertEqual(os.stat(self.fileName).st_mode & 0o777, 0o644) # not mkstemp's 0o600
+
+    def testException(self):
+        with open(self.fileName, "w") as fd:
+            print("old", file=fd)
+
+        def write():
+            with eups.utils.AtomicFile(self.fileName, "w") as fd:
+                print("new", file=fd)
+                raise RuntimeError("Failed to write")
+
+        self.assertRaises(RuntimeError, write)
+        self.assertEqual(self.read(), "old\n")
+        self.assertEqual(os.listdir(self.tmpdir), ["foo.chain"])
+
+    def testFsyncBatch(self):
+        synced = []
+        fsync = os.fsync
+
+        def countingFsync(fd):
+            synced.append(fd)
+            fsync(fd)
+
+        os.fsync = countingFsync
+        try:
+            with eups.utils.fsyncBatch():
+                for i in range(3):
+                    with eups.utils.AtomicFile(os.path.join(self.tmpdir, "%d.version" % i), "w") as fd:
+                        print(i, file=fd)
+                    self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "%d.version" % i)))
+                    self.assertEqual(len(synced), i + 1) # each file's synced before it's renamed
+            self.assertEqual(len(synced), 3 + 1) # and their directory when the batch ends
+
+            del synced[:]
+            with eups.utils.AtomicFile(self.fileName, "w") as fd:
+                print("new", file=fd)
+            self.assertEqual(len(synced), 1)
+        finally:
+            os.fsync = fsync
+
+class ImportTestCase(unittest.TestCase):
+    """Check that the setup command doesn't import modules that it doesn't need"""
+
+    def importedModules(self, module):
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.join(testCommon.EUPS_DIR, "python")
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                              env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        return set(line.split("|")[-1].strip() for line in proc.stderr.splitlines()
+                   if line.startswith("import time:"))
+
+    def testSetupImports(self):
+        modules = self.importedModules("eups.setupcmd")
+        self.assertIn("eups.Eups", modules)
+        for mod in ("eups.app", "eups.cmd", "eups.distrib", "eups.distrib.server", "http.client"):
+            self.assertNotIn(mod, modules)
+
+    def testSetupRun(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            env = os.environ.copy()
+            env.update(PYTHONPATH=os.path.join(testCommon.EUPS_DIR, "python"), EUPS_PATH=testEupsStack,
+                       EUPS_FLAVOR="Linux", EUPS_USERDATA=os.path.join(tmpdir, "_userdata_"))
+            script = "import sys, eups.setupcmd; " \
+                     "status = eups.setupcmd.EupsSetup(args=['tcltk']).run(); " \
+                     "print(status, 'eups.cmd' in sys.modules, file=sys.stderr)"
+            proc = subprocess.run([sys.executable, "-c", script], env=env, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertIn("SETUP_TCLTK", proc.stdout)
+        self.assertEqual(proc.stderr.splitlines()[-1], "0 False")
+
+    def testAppImports(self):
+        # eups.setup() imports eups.app
+        modules = self.importedModules("eups.app")
+        self.assertNotIn("concurrent.futures", modules)
+
+    def testLazyAttributes(self):
+        self.assertIs(eups.setup, eups.app.setup)
+        self.assertIs(eups.commandCallbacks, eups.cmd.commandCallbacks)
+        self.assertIn("declare", dir(eups))
+        self.assertTrue(hasattr(eups.distrib, "Repositories"))
+        self.assertRaises(AttributeError, getattr, eups, "noSuchFunction")
+
+    def testPublicNames(self):
+        # the names that "import eups" provided when it imported everything from eups.app,
+        # other than the standard modules that came with it (fnmatch, os, pickle, re)
+        names = """
+            BadTableContent Current CustomizationError Eups EupsException OperationForbidden Product
+            ProductNotFound ProductStack Quiet TableError TableFileNotFound Tag TagNameConflict
+            TagNotRecognized Tags UnderSpecifiedProduct Uses VersionCompare VersionParser app builder
+            cacheVersion checkTagsList clearCache cmd cmp_or_key commandCallbacks db debug declare
+            dirEnvNameFor distrib enableLocking exceptions expandBuildFile expandTableFile findProduct
+            flavor getDependencies getSetupVersion hooks listCache lock osetup printProducts printUses
+            productDir setup setupEnvNameFor stack table tags undeclare unsetup utils version
+        """.split()
+        for name in names:
+            self.assertTrue(hasattr(eups, name), name)
+            self.assertIn(name, dir(eups))
+        self.assertIs(eups.ProductStack, eups.app.ProductStack)
+        self.assertIs(eups.checkTagsList, eups.app.checkTagsList)
+        self.assertEqual(eups.cacheVersion, eups.app.cacheVersion)
+
+class SnapshotReadTestCase(unittest.TestCase):
+    """Test reading stacks without taking locks (config.site.snapshotReads)"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_USERDATA"] = os.path.join(self.tmpdir, "_userdata_")
+        self.dbpath = os.path.join(testEupsStack, "ups_db")
+        self.genfile = os.path.join(self.dbpath, ".generation")
+        self.config = (eups.hooks.config.site.snapshotReads, eups.hooks.config.site.lockBackend)
+        eups.hooks.config.site.snapshotReads = True
+        eups.hooks.config.site.lockBackend = "directory"
+
+    def tearDown(self):
+        eups.hooks.config.site.snapshotReads, eups.hooks.config.site.lockBackend = self.config
+        os.environ.clear()
+        os.environ.update(self.environ0)
+        if os.path.exists(self.genfile):
+            os.remove(self.genfile)
+        shutil.rmtree(self.tmpdir)
+
+    def testNoSharedLocks(self):
+        path = [self.tmpdir]
+        self.assertEqual(lock.takeLocks("test", path, lock.LOCK_SH, verbose=-1), [])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        locks = lock.takeLocks("test", path, lock.LOCK_EX, verbose=-1)
+        self.assertTrue(locks)
+        lock.giveLocks(locks, verbose=-1)
+
+    def buildCaches(self):
+        """Write the caches for all the flavors we need, holding an exclusive lock as eups admin buildCache does"""
+        locks = lock.takeLocks("admin buildCache", [testEupsStack], lock.LOCK_EX, ntry=1)
+        try:
+            for i in range(2):
+                self.assertTrue(eups.Eups().findProduct("python", "2.5.2"))
+        finally:
+            lock.giveLocks(locks)
+
+    def cacheFiles(self):
+        """Return the names and modification times of the cache files and their generation records"""
+        files = {}
+        for d in (self.dbpath, self.tmpdir):
+            for dirpath, dirnames, filenames in os.walk(d):
+                for f in filenames:
+                    if ".pickleDB" in f:
+                        f = os.path.join(dirpath, f)
+                        files[f] = os.stat(f).st_mtime_ns
+
+        return files
+
+    def testGeneration(self):
+        Database(self.dbpath).publishGeneration()
+        self.buildCaches()
+
+        timing.enable(name="test")
+        try:
+            self.assertTrue(eups.Eups().findProduct("python", "2.5.2"))
+            counters = timing.getCounters()
+        finally:
+            timing.disable()
+
+        # the caches were trusted without checking the database
+        self.assertEqual(counters.get("stack cache hits"), 1)
+        self.assertIsNone(counters.get("stack cache misses"))
+        self.assertGreater(counters.get("stack cache generation matches", 0), 0)
+
+    def testNoWrites(self):
+        """Readers that don't hold locks don't write the caches, even if they're missing"""
+        Database(self.dbpath).publishGeneration()
+        files = self.cacheFiles()
+
+        timing.enable(name="test")
+        try:
+            self.assertTrue(eups.Eups().findProduct("python", "2.5.2"))
+            counters = timing.getCounters()
+        finally:
+            timing.disable()
+
+        self.assertGreater(counters.get("stack cache misses", 0), 0)
+        self.assertEqual(self.cacheFiles(), files)
+
+    def testDeclare(self):
+        """Products declared while holding product locks leave the cache trusted"""
+        eups.hooks.config.site.snapshotReads = False
+        productLocks, eups.hooks.config.site.productLocks = eups.hooks.config.site.productLocks, True
+        db = Database(self.dbpath)
+        db.publishGeneration()
+        pdir = os.path.join(self.dbpath, "newprod")
+        self.buildCaches()
+        locks = lock.takeLocks("declare", [testEupsStack], lock.LOCK_PRODUCT, ntry=1)
+        try:
+            Eups = eups.Eups()
+            self.assertTrue(Eups.findProduct("python", "2.5.2"))
+
+            Eups.declare("newprod", "1.0", "none", testEupsStack, tablefile="none")
+            self.assertEqual(Eups.versions[testEupsStack].generation, db.getGeneration())
+            self.assertIn((testEupsStack, "newprod"), lock._productLocking["products"])
+
+            timing.enable(name="test")
+            try:
+                self.assertTrue(eups.Eups().findProduct("newprod", "1.0"))
+                counters = timing.getCounters()
+            finally:
+                timing.disable()
+            self.assertIsNone(counters.get("stack cache misses"))
+            self.assertGreater(counters.get("stack cache generation matches", 0), 0)
+
+            Eups.undeclare("newprod", "1.0")
+            self.assertIsNone(eups.Eups().findProduct("newprod", "1.0"))
+        finally:
+            lock.giveLocks(locks)
+            eups.hooks.config.site.productLocks = productLocks
+            if os.path.isdir(pdir):
+                shutil.rmtree(pdir)
+
+    def testRetry(self):
+        """The database changes while we're reading it"""
+        db = Database(self.dbpath)
+        db.publishGeneration()
+        module = sys.modules["eups.Eups"]
+        ProductStack = module.ProductStack
+        generations = []
+
+        class ChangingProductStack(ProductStack):
+            @staticmethod
+            def fromCache(*args, **kwargs):
+                generations.append(kwargs["generation"])
+                if len(generations) == 1:
+                    db.publishGeneration()
+                return ProductStack.fromCache(*args, **kwargs)
+
+        module.ProductStack = ChangingProductStack
+        try:
+            self.assertTrue(eups.Eups().findProduct("python", "2.5.2"))
+        finally:
+            module.ProductStack = ProductStack
+
+        self.assertEqual(len(generations), 2)
+        self.assertEqual(generations[1], generations[0] + 1)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -32,6 +900,16 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         MiscTestCase,
+        SnapshotReadTestCase,
+        WebTransporterTestCase,
+        TarballStreamTestCase,
+        BuildCacheTestCase,
+        TimingTestCase,
+        FcntlLockTestCase,
+        ProductLockTestCase,
+        DirectoryProductLockTestCase,
+        AtomicFileTestCase,
+        ImportTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -4,11 +4,15 @@ Tests for eups.product
 """
 
 import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
 import testCommon
 from testCommon import testEupsStack
 from eups.Product import Product, TableFileNotFound
+from eups import hooks, utils
 
 class ProductTestCase(unittest.TestCase):
     """test the Product container class"""
@@ -216,10 +220,56 @@ class ProductTransformationTestCase(unittest.TestCase):
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+class DeferredTableTestCase(unittest.TestCase):
+    """test deferring the lookup of products' default table files"""
+
+    def setUp(self):
+        self.deferTableLookup = hooks.config.Eups.deferTableLookup
+        hooks.config.Eups.deferTableLookup = True
+        self.tmpdir = tempfile.mkdtemp()
+        self.tablefile = os.path.join(self.tmpdir, "ups", "magnum.table")
+
+    def tearDown(self):
+        hooks.config.Eups.deferTableLookup = self.deferTableLookup
+        shutil.rmtree(self.tmpdir)
+        utils.clearStatCache()
+
+    def writeTable(self):
+        os.makedirs(os.path.dirname(self.tablefile), exist_ok=True)
+        with open(self.tablefile, "w") as fd:
+            print("setupRequired(python)", file=fd)
+
+    def testDeferred(self):
+        prod = Product("magnum", "1.0", dir=self.tmpdir)
+        self.writeTable()               # too late if the table were looked up when prod was made
+        self.assertEqual(prod.tablefile, self.tablefile)
+        self.assertEqual(prod.tableFileName(), self.tablefile)
+        self.assertIsNotNone(prod.getTable())
+
+    def testNoTable(self):
+        prod = Product("magnum", "1.0", dir=self.tmpdir)
+        self.assertIsNone(prod.clone().tablefile)
+        self.assertRaises(TableFileNotFound, prod.getTable)
+
+    def testPickle(self):
+        prod = pickle.loads(pickle.dumps(Product("magnum", "1.0", dir=self.tmpdir)))
+        self.writeTable()
+        self.assertEqual(prod.tablefile, self.tablefile)
+
+    def testStatCache(self):
+        self.assertFalse(utils.pathExists(self.tablefile))
+        self.writeTable()
+        self.assertTrue(utils.pathExists(self.tablefile))
+        os.unlink(self.tablefile)
+        self.assertTrue(utils.pathExists(self.tablefile))       # remembered
+        utils.clearStatCache()
+        self.assertFalse(utils.pathExists(self.tablefile))
+
 def suite(makeSuite=True):
     """Return a test suite"""
 
-    return testCommon.makeSuite((ProductTestCase, ProductTransformationTestCase), makeSuite)
+    return testCommon.makeSuite((ProductTestCase, ProductTransformationTestCase,
+                                 DeferredTableTestCase), makeSuite)
 
 def run(shouldExit=False):
     """Run the tests"""
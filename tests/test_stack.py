@@ -6,6 +6,7 @@ Tests for eups.stack
 import os
 import unittest
 import time
+import pickle
 import testCommon
 from testCommon import testEupsStack
 from eups.Product import ProductNotFound, Product
@@ -73,6 +74,56 @@ class ProductFamilyTestCase(unittest.TestCase):
         self.assertFalse(self.fam.isTagAssigned("beta"))
         self.assertTrue(self.fam.isTagAssigned("current"))
 
+    def testSortedVersions(self):
+        self.assertIsNone(self.fam.getLatest())
+        for v in ["3.10", "3.2", "3.1"]:
+            self.fam.addVersion(v, "/opt/LInux/magnum/" + v)
+        self.assertEqual(self.fam.getSortedVersions(), ["3.1", "3.2", "3.10"])
+        self.assertEqual(self.fam.getLatest(), "3.10")
+        self.fam.addVersion("3.9", "/opt/LInux/magnum/3.9")
+        self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2b")
+        self.assertEqual(self.fam.getSortedVersions(), ["3.1", "3.2", "3.9", "3.10"])
+        self.fam.removeVersion("3.10")
+        self.assertEqual(self.fam.getLatest(), "3.9")
+
+    def testRemoveTaggedVersion(self):
+        self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
+        self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2")
+        self.fam.assignTag("stable", "3.1")
+        self.fam.assignTag("stable", "3.2")
+        self.assertEqual(self.fam.getProduct("3.1").tags, [])
+        self.assertEqual(self.fam.getProduct("3.2").tags, ["stable"])
+        self.fam.removeVersion("3.2")
+        self.assertFalse(self.fam.isTagAssigned("stable"))
+
+    def testPickle(self):
+        self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
+        self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2")
+        self.fam.assignTag("beta", "3.2")
+        self.assertEqual(self.fam.getLatest(), "3.2")
+        fam = pickle.loads(pickle.dumps(self.fam, protocol=4))
+        self.assertEqual(fam.getLatest(), "3.2")
+        self.assertEqual(fam.getProduct("3.2").tags, ["beta"])
+        fam.assignTag("beta", "3.1")
+        self.assertEqual(fam.getProduct("3.1").tags, ["beta"])
+
+    def testPaths(self):
+        # paths that are, and aren't, stored in compact form
+        self.fam.addVersion("3.1", "/opt/Linux/magnum/3.1", "/opt/Linux/magnum/3.1/ups/magnum.table")
+        self.fam.addVersion("3.2", "/opt/Linux/magnum-3.2", "/opt/Linux/magnum-3.2/ups/magnum.table")
+        self.fam.addVersion("3.3", "/opt/Linux/magnum/3.3", "/opt/tables/magnum.table")
+        self.fam.addVersion("3.4", "none", "none")
+        self.fam.addVersion("3.5", "/opt/Linux/magnum/3.5", None)
+        fam = pickle.loads(pickle.dumps(self.fam, protocol=4))
+        for v, dir, table in [("3.1", "/opt/Linux/magnum/3.1", "/opt/Linux/magnum/3.1/ups/magnum.table"),
+                              ("3.2", "/opt/Linux/magnum-3.2", "/opt/Linux/magnum-3.2/ups/magnum.table"),
+                              ("3.3", "/opt/Linux/magnum/3.3", "/opt/tables/magnum.table"),
+                              ("3.4", "none", "none")]:
+            p = fam.getProduct(v)
+            self.assertEqual(p.dir, dir)
+            self.assertEqual(p.tablefile, table)
+        self.assertEqual(fam.getProduct("3.5").dir, "/opt/Linux/magnum/3.5")
+
     def testExport(self):
         self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
         self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2")
@@ -134,7 +185,7 @@ class ProductStackTestCase(unittest.TestCase):
 
     def testMisc(self):
         self.assertEqual(ProductStack.persistFilename("Linux"),
-                          "Linux.pickleDB1_3_0")
+                          "Linux.pickleDB2_2_16")
         self.assertEqual(self.stack.getDbPath(),
                           os.path.join(testEupsStack, "ups_db"))
 
@@ -435,8 +486,9 @@ class CacheTestCase(unittest.TestCase):
             os.remove(self.cache)
 
     def tearDown(self):
-        if os.path.exists(self.cache):
-            os.remove(self.cache)
+        for f in [self.cache, self.cache + ".generation"]:
+            if os.path.exists(f):
+                os.remove(f)
 
     def testRegen(self):
         ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=True,
@@ -468,6 +520,111 @@ class CacheTestCase(unittest.TestCase):
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assertRaises(CacheOutOfSync, ps2.save)
 
+    def testMerge(self):
+        ps1 = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                     updateCache=True)
+        ps2 = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                     updateCache=True)
+        ps1.reload("Linux")             # so there's nothing to merge into
+        ps2.reload("Linux")
+        time.sleep(0.01)
+        ps1.addProduct(Product("fw", "1.2", "Linux",
+                               "/opt/sw/Linux/fw/1.2", "none"))
+        ps1.save()
+
+        # ps2's changes are replayed on top of ps1's, rather than lost
+        ps2.addProduct(Product("afw", "1.2", "Linux",
+                               "/opt/sw/Linux/afw/1.2", "none"))
+        ps2.assignTag("beta", "afw", "1.2", "Linux")
+        ps2.removeProduct("python", "Linux", "2.5.2")
+        ps2.generation = 3
+        ps2.save(merge=True)
+        self.assertIsNone(ps2.generation)
+        self.assertFalse(ps2.saveNeeded())
+        self.assertEqual(ps2.journal, {})
+
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=False)
+        ps.reload("Linux")
+        self.assertTrue(ps.hasProduct("fw"))
+        self.assertTrue(ps.hasProduct("afw"))
+        self.assertFalse(ps.hasProduct("python", version="2.5.2"))
+        self.assertEqual(ps.getTaggedProduct("afw", "Linux", "beta").version, "1.2")
+
+        # reading a rewritten cache keeps our unsaved changes
+        time.sleep(0.01)
+        ps1.addProduct(Product("tcltk", "8.5", "Linux",
+                               "/opt/sw/Linux/tcltk/8.5", "none"))
+        ps1.ensureInSync()
+        self.assertTrue(ps1.hasProduct("afw"))
+        ps1.save()
+        ps.ensureInSync()
+        self.assertTrue(ps.hasProduct("tcltk"))
+
+        # a product changed in both places must then agree with the database
+        time.sleep(0.01)
+        ps.assignTag("beta", "eigen", "2.0.0", "Linux")
+        ps1.unassignTag("current", "eigen", "Linux")
+        ps1.save()
+        self.assertRaises(CacheOutOfSync, ps.save, merge=True)
+        ps.reload("Linux")
+
+        # changes that no longer make sense can't be merged
+        time.sleep(0.01)
+        ps.assignTag("beta", "tcltk", "8.5", "Linux")
+        ps1.removeProduct("tcltk", "Linux", "8.5")
+        ps1.save()
+        self.assertRaises(CacheOutOfSync, ps.save, merge=True)
+
+    def testMergeAfterRefresh(self):
+        ps1 = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                     updateCache=True)
+        ps1.refreshFromDatabase()
+        self.assertTrue(ps1.cacheIsInSync())
+
+        # a stack read from the database doesn't record its changes, so it
+        # mustn't overwrite a newer cache
+        time.sleep(0.01)
+        ps2 = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                     updateCache=False)
+        ps2.addProduct(Product("fw", "1.2", "Linux",
+                               "/opt/sw/Linux/fw/1.2", "none"))
+        ps2.save()
+
+        ps1.addProduct(Product("afw", "1.2", "Linux",
+                               "/opt/sw/Linux/afw/1.2", "none"))
+        self.assertRaises(CacheOutOfSync, ps1.save, merge=True)
+
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=False)
+        ps.reload("Linux")
+        self.assertTrue(ps.hasProduct("fw"))
+
+    def testGeneration(self):
+        # a cache written from a known generation of the database is trusted
+        # without checking the database's files
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True, generation=7)
+        self.assertTrue(os.path.exists(self.cache + ".generation"))
+        self.assertEqual(ps._cacheGeneration(self.cache), 7)
+
+        future = time.time() + 100
+        pdir = os.path.join(self.dbpath, "python")
+        pmtime = os.stat(pdir).st_mtime
+        os.utime(pdir, (future, future))   # the database looks newer than the cache
+        try:
+            self.assertFalse(ps.cacheIsUpToDate("Linux"))
+            self.assertFalse(ps.cacheIsUpToDate("Linux", generation=8))
+            self.assertTrue(ps.cacheIsUpToDate("Linux", generation=7))
+        finally:
+            os.utime(pdir, (pmtime, pmtime))
+
+        # rewriting the cache without a generation invalidates the record
+        ps.generation = None
+        time.sleep(0.01)
+        ps.persist("Linux")
+        self.assertIsNone(ps._cacheGeneration(self.cache))
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):